@@ -0,0 +1,44 @@
+"""Measure week retrieval throughput for different --concurrency settings against a local mock API.
+
+Usage: python benchmarks/bench_concurrency.py [--weeks 52] [--latency 0.05] [--concurrency 1 2 4 8]"""
+import argparse
+import datetime
+import time
+
+from ekzexport.mockserver import MockServer
+from ekzexport.session import Session
+from ekzexport.util import DataSelection, DayRange, DayRangeSet
+
+
+def run(base_url: str, weeks: int, concurrency: int) -> float:
+    start = datetime.date(2023, 1, 2)
+    requested = DayRangeSet([DayRange(start, start + datetime.timedelta(days=7 * weeks - 1))])
+    with Session('user', 'password', base_url=base_url) as session:
+        data = DataSelection(session, '1000000001', 'PK_VERB_15MIN', None, None, weeks, concurrency)
+        begin = time.perf_counter()
+        points = 0
+        for _, d in data.fetch_consumption_data(requested.get_covering_weeks()):
+            points += len(d['seriesHt']['values']) + len(d['seriesNt']['values'])
+        elapsed = time.perf_counter() - begin
+    assert points == weeks * 7 * 96
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--weeks', type=int, default=52)
+    parser.add_argument('--latency', type=float, default=0.05, help='Simulated API latency in seconds')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with MockServer(latency=args.latency) as server:
+        baseline = None
+        print(f'{"concurrency":>11}  {"seconds":>8}  {"weeks/s":>8}  {"speedup":>7}')
+        for c in args.concurrency:
+            elapsed = run(server.base_url, args.weeks, c)
+            baseline = baseline or elapsed
+            print(f'{c:>11}  {elapsed:>8.2f}  {args.weeks / elapsed:>8.1f}  {baseline / elapsed:>6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
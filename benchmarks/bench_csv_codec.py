@@ -0,0 +1,63 @@
+"""Compare rows/second of the datetime-based CSV parsing and formatting with the integer codec.
+
+Usage: python benchmarks/bench_csv_codec.py [--years 5]"""
+import argparse
+import datetime
+import time
+
+from ekzexport.exporters.csv import decode_rows, encode_rows
+from ekzexport.timeutil import convert_zrh_datetime_sequence, ZRH_TZ, UTC_TZ
+
+
+def synthetic_lines(years: int):
+    start = datetime.datetime(2020, 1, 1, tzinfo=UTC_TZ)
+    for i in range(years * 365 * 96):
+        t = start + datetime.timedelta(minutes=15 * i)
+        ht, nt = (f'{0.1 + i % 13 / 100}', '') if 7 <= t.hour < 20 else ('', f'{0.05 + i % 7 / 100}')
+        yield f'{t.astimezone(ZRH_TZ).strftime("%d.%m.%Y %H:%M")};{ht};{nt}\n'
+
+
+def datetime_decode(lines):
+    # What read_csv used to do for every row
+    return list(convert_zrh_datetime_sequence(
+        (line.strip().split(';') for line in lines),
+        lambda x: x[0],
+        lambda dt, x: {'time': dt, 'ht': float(x[1]) if x[1] else None, 'nt': float(x[2]) if x[2] else None}))
+
+
+def datetime_encode(datapoints):
+    # What write_csv used to do for every row
+    result = []
+    for dp in datapoints:
+        t = dp['time'].astimezone(ZRH_TZ).strftime('%d.%m.%Y %H:%M')
+        result.append(f'{t};{str(dp["ht"]) if dp.get("ht") else ""};{str(dp["nt"]) if dp.get("nt") else ""}\n')
+    return result
+
+
+def measure(fn, arg):
+    begin = time.perf_counter()
+    result = fn(arg)
+    return time.perf_counter() - begin, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--years', type=int, default=5)
+    args = parser.parse_args()
+
+    lines = list(synthetic_lines(args.years))
+    old_decode, datapoints = measure(datetime_decode, lines)
+    new_decode, rows = measure(lambda x: list(decode_rows(x)), lines)
+    old_encode, old_lines = measure(datetime_encode, datapoints)
+    new_encode, new_lines = measure(lambda x: list(encode_rows(x)), rows)
+    assert old_lines == new_lines == lines
+    assert [int(dp['time'].timestamp()) for dp in datapoints] == [r[0] for r in rows]
+
+    print(f'{len(lines)} rows ({args.years} years of 15 minute values)')
+    print(f'{"":>8}  {"datetime rows/s":>16}  {"codec rows/s":>13}  {"speedup":>7}')
+    for name, old, new in (('decode', old_decode, new_decode), ('encode', old_encode, new_encode)):
+        print(f'{name:>8}  {len(lines) / old:>16,.0f}  {len(lines) / new:>13,.0f}  {old / new:>6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Measure complete exports through the CLI against the mock myEKZ server, for each sink.
+
+Every run starts with an empty output and goes through login, fetching all weeks, writing and logout. Reported are
+the wall time and weeks/s, so the effect of --concurrency, simulated latency and the sinks can be compared:
+
+    python benchmarks/bench_e2e.py [--weeks 52] [--latency 0.05] [--concurrency 1 4] [--sinks csv sqlite parquet]"""
+import argparse
+import datetime
+import os
+import os.path
+import tempfile
+import time
+
+from ekzexport.cli import cli
+from ekzexport.mockserver import MockServer
+
+SINK_ARGS = {
+    'csv': lambda directory: ['csv', '-f', os.path.join(directory, 'data.csv')],
+    'sqlite': lambda directory: ['sqlite', '-f', os.path.join(directory, 'data.sqlite')],
+    'parquet': lambda directory: ['parquet', '-d', os.path.join(directory, 'parquet')],
+}
+
+
+def run(server: MockServer, sink: str, weeks: int, concurrency: int) -> float:
+    date_to = server.end
+    date_from = date_to - datetime.timedelta(days=7 * weeks - 1)
+    with tempfile.TemporaryDirectory() as directory:
+        args = ['--user', 'user', '--password', 'password', '--base-url', server.base_url,
+                'installation', server.installations[0], 'data', '--type', 'PK_VERB_15MIN',
+                '--from', str(date_from), '--to', str(date_to), '--limit', str(weeks),
+                '--concurrency', str(concurrency), 'export'] + SINK_ARGS[sink](directory)
+        begin = time.perf_counter()
+        cli.main(args, standalone_mode=False)
+        return time.perf_counter() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weeks', type=int, default=52)
+    parser.add_argument('--latency', type=float, default=0.05, help='Simulated API latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of API calls failing')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--sinks', nargs='+', choices=list(SINK_ARGS), default=list(SINK_ARGS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache:
+        # Keep the fetch planner's learned window sizes from influencing (or being influenced by) the results.
+        os.environ['XDG_CACHE_HOME'] = cache
+        results = []
+        with MockServer(latency=args.latency, error_rate=args.error_rate, end=datetime.date(2024, 12, 29)) as server:
+            for sink in args.sinks:
+                for concurrency in args.concurrency:
+                    results.append((sink, concurrency, run(server, sink, args.weeks, concurrency)))
+
+    print(f'{args.weeks} weeks of 15 minute values, {args.latency * 1000:.0f} ms latency')
+    print(f'{"sink":>8}  {"concurrency":>11}  {"seconds":>8}  {"weeks/s":>8}')
+    for sink, concurrency, elapsed in results:
+        print(f'{sink:>8}  {concurrency:>11}  {elapsed:>8.2f}  {args.weeks / elapsed:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Compare points/second written to an InfluxDB stand-in with Point objects and a write_api per week against
+line protocol through one batching writer.
+
+The stand-in is a local HTTP server that accepts writes and counts the received lines.
+
+Usage: python benchmarks/bench_influxdb.py [--weeks 52] [--batch-size 5000] [--gzip]"""
+import argparse
+import datetime
+import gzip
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from influxdb_client import InfluxDBClient, Point, WritePrecision, WriteOptions
+
+from ekzexport.exporters.influxdb import line_protocol
+from ekzexport.timeseries import TimeSeries
+
+
+class InfluxSink:
+    """Accepts InfluxDB 2.x writes on a random local port and counts the points."""
+    def __init__(self):
+        self.points = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                with sink._lock:
+                    sink.points += body.count(b'\n') + 1 if body else 0
+                    sink.requests += 1
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self._server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def synthetic_weeks(weeks: int):
+    start = int(datetime.datetime(2020, 1, 6, tzinfo=datetime.timezone.utc).timestamp())
+    for week in range(weeks):
+        rows = []
+        for i in range(7 * 96):
+            epoch = start + (week * 7 * 96 + i) * 900
+            rows.append((epoch, 0.1 + i % 13 / 100, None) if i % 96 >= 28 else (epoch, None, 0.05 + i % 7 / 100))
+        yield TimeSeries.from_rows(rows)
+
+
+def write_points(client, weeks, batch_size):
+    # What the exporter used to do
+    for series in weeks:
+        with client.write_api() as writer:
+            for ts, ht, nt in series.rows():
+                for niedertarif, value in ((False, ht), (True, nt)):
+                    if value is not None:
+                        writer.write('bucket', 'org', Point('ekz_energy').time(ts, WritePrecision.S)
+                                     .field('energy_15min', value).field('niedertarif', niedertarif))
+
+
+def write_lines(client, weeks, batch_size):
+    with client.write_api(write_options=WriteOptions(batch_size=batch_size, flush_interval=1000)) as writer:
+        for series in weeks:
+            writer.write('bucket', 'org', list(line_protocol('ekz_energy', 'energy_15min', series)),
+                         write_precision=WritePrecision.S)
+
+
+def measure(fn, weeks, batch_size, use_gzip):
+    with InfluxSink() as sink:
+        with InfluxDBClient(url=sink.url, token='token', org='org', enable_gzip=use_gzip) as client:
+            begin = time.perf_counter()
+            fn(client, weeks, batch_size)
+            elapsed = time.perf_counter() - begin
+    return elapsed, sink.points, sink.requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--weeks', type=int, default=52)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--gzip', action='store_true')
+    args = parser.parse_args()
+
+    weeks = list(synthetic_weeks(args.weeks))
+    expected = sum(len(series) for series in weeks)
+    print(f'{expected} points ({args.weeks} weeks of 15 minute values), gzip: {args.gzip}')
+    print(f'{"":>14}  {"points/s":>10}  {"requests":>8}')
+    for name, fn in (('Point objects', write_points), ('line protocol', write_lines)):
+        elapsed, points, requests = measure(fn, weeks, args.batch_size, args.gzip)
+        assert points == expected, (name, points, expected)
+        print(f'{name:>14}  {points / elapsed:>10,.0f}  {requests:>8}')
+
+
+if __name__ == '__main__':
+    main()
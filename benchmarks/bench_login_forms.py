@@ -0,0 +1,79 @@
+"""Compare finding the login forms with ekzexport.htmlform against BeautifulSoup, which the login used before.
+
+Both run on the Keycloak pages in tests/fixtures, the way the login looks for the forms on each of them. Also
+reported is how long importing each takes in a fresh interpreter:
+
+    python benchmarks/bench_login_forms.py [--repeat 1000]
+
+BeautifulSoup is not a dependency of ekzexport, install it with "pip install beautifulsoup4" for the comparison."""
+import argparse
+import os.path
+import subprocess
+import sys
+import time
+
+from typing import Callable, Optional
+
+from ekzexport.htmlform import find_form
+
+try:
+    from bs4 import BeautifulSoup
+    _HAVE_BS4 = True
+except ImportError:
+    _HAVE_BS4 = False
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'fixtures')
+
+# Fixture -> CSS selector the login used with BeautifulSoup and the ids of the corresponding find_form call
+PAGES = {
+    'login.html': ('form[id=kc-form-login]', {'kc-form-login'}),
+    'otp.html': ('form[id=kc-sms-code-login-form], form[id=kc-otp-login-form]',
+                 {'kc-sms-code-login-form', 'kc-otp-login-form'}),
+    'sms.html': ('form[id=kc-sms-code-login-form], form[id=kc-otp-login-form]',
+                 {'kc-sms-code-login-form', 'kc-otp-login-form'}),
+    'mobile_number.html': ('form', None),
+}
+
+
+def measure(fn: Callable[[], object], repeat: int) -> float:
+    """Average µs per call of the fastest of three rounds of repeat calls."""
+    best = float('inf')
+    for _ in range(3):
+        begin = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        best = min(best, time.perf_counter() - begin)
+    return best / repeat * 1e6
+
+
+def import_ms(statement: str) -> Optional[float]:
+    code = f'import time\nbegin = time.perf_counter()\n{statement}\nprint(time.perf_counter() - begin)'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    return float(result.stdout) * 1000 if result.returncode == 0 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=1000, help='Calls per round.')
+    args = parser.parse_args()
+    if not _HAVE_BS4:
+        print('BeautifulSoup is not installed, only measuring htmlform', file=sys.stderr)
+
+    print(f'{"page":<20}  {"bytes":>7}  {"htmlform µs":>12}  {"bs4 µs":>10}  {"speedup":>8}')
+    for page, (selector, ids) in PAGES.items():
+        with open(os.path.join(FIXTURES, page), encoding='utf-8') as f:
+            text = f.read()
+        ours = measure(lambda: find_form(text, ids), args.repeat)
+        if _HAVE_BS4:
+            theirs = measure(lambda: BeautifulSoup(text, 'html.parser').select(selector), args.repeat)
+            print(f'{page:<20}  {len(text):>7}  {ours:>12.1f}  {theirs:>10.1f}  {theirs / ours:>7.1f}x')
+        else:
+            print(f'{page:<20}  {len(text):>7}  {ours:>12.1f}')
+
+    for name, statement in (('htmlform', 'import ekzexport.htmlform'), ('bs4', 'import bs4')):
+        ms = import_ms(statement)
+        print(f'import {name:<13}  {"not installed" if ms is None else f"{ms:.1f} ms"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""Micro-benchmarks for the hot paths in util, timeutil, timeseries and the CSV exporter.
+
+Synthetic data consists of several years of 15 minute values and sets of many fragmented day ranges. Results are
+written as JSON, by default to benchmarks/results/<commit>.json, so runs of different commits can be compared:
+
+    python benchmarks/bench_micro.py                       # Run everything
+    python benchmarks/bench_micro.py -k dayrangeset        # Only benchmarks containing dayrangeset
+    python benchmarks/bench_micro.py --baseline old.json   # Run and compare against an earlier result
+    python benchmarks/bench_micro.py --compare old.json new.json"""
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List, Tuple
+
+from ekzexport.exporters import csv
+from ekzexport.timeseries import TimeSeries
+from ekzexport.timeutil import (convert_zrh_datetime_sequence, parse_api_timestamp, parse_api_timestamps, ZRH_TZ,
+                                UTC_TZ)
+from ekzexport.util import DayRange, DayRangeSet
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# A benchmark prepares its data and returns the function to time and the number of items it processes.
+Benchmark = Callable[[argparse.Namespace], Tuple[Callable[[], object], int]]
+BENCHMARKS: Dict[str, Benchmark] = {}
+
+
+def benchmark(name: str):
+    def register(fn: Benchmark) -> Benchmark:
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+def fragmented_ranges(count: int, seed: int) -> List[DayRange]:
+    """count ranges of 1-5 days with gaps of 1-5 days in between, shuffled."""
+    rng = random.Random(seed)
+    day = datetime.date(1990, 1, 1)
+    ranges = []
+    for _ in range(count):
+        day += datetime.timedelta(days=rng.randint(1, 5))
+        end = day + datetime.timedelta(days=rng.randint(0, 4))
+        ranges.append(DayRange(day, end))
+        day = end + datetime.timedelta(days=1)
+    rng.shuffle(ranges)
+    return ranges
+
+
+def quarter_hours(years: int) -> List[datetime.datetime]:
+    start = datetime.datetime(2020, 1, 1, tzinfo=UTC_TZ)
+    return [start + datetime.timedelta(minutes=15 * i) for i in range(years * 365 * 96)]
+
+
+def synthetic_rows(years: int) -> List[csv.Row]:
+    start = int(datetime.datetime(2020, 1, 1, tzinfo=UTC_TZ).timestamp())
+    return [(start + i * 900, 0.1 + i % 13 / 100, None) if i % 96 >= 28 else (start + i * 900, None, 0.05 + i % 7 / 100)
+            for i in range(years * 365 * 96)]
+
+
+@benchmark('dayrangeset_construct')
+def bench_dayrangeset_construct(args):
+    ranges = fragmented_ranges(args.fragments, 1)
+    return lambda: DayRangeSet(ranges), len(ranges)
+
+
+@benchmark('dayrangeset_intersect')
+def bench_dayrangeset_intersect(args):
+    a, b = DayRangeSet(fragmented_ranges(args.fragments, 1)), DayRangeSet(fragmented_ranges(args.fragments, 2))
+    return lambda: a.intersect(b), 2 * args.fragments
+
+
+@benchmark('dayrangeset_subtract')
+def bench_dayrangeset_subtract(args):
+    a, b = DayRangeSet(fragmented_ranges(args.fragments, 1)), DayRangeSet(fragmented_ranges(args.fragments, 2))
+    return lambda: a.subtract(b), 2 * args.fragments
+
+
+@benchmark('dayrangeset_union')
+def bench_dayrangeset_union(args):
+    a, b = DayRangeSet(fragmented_ranges(args.fragments, 1)), DayRangeSet(fragmented_ranges(args.fragments, 2))
+    return lambda: a.union(b), 2 * args.fragments
+
+
+@benchmark('dayrangeset_complement')
+def bench_dayrangeset_complement(args):
+    a = DayRangeSet(fragmented_ranges(args.fragments, 1))
+    within = DayRange(a.start - datetime.timedelta(days=7), a.end + datetime.timedelta(days=7))
+    return lambda: a.complement(within), args.fragments
+
+
+@benchmark('dayrangeset_contains')
+def bench_dayrangeset_contains(args):
+    a = DayRangeSet(fragmented_ranges(args.fragments, 1))
+    days = [a.start + datetime.timedelta(days=i) for i in range(0, (a.end - a.start).days, 3)]
+    return lambda: [a.contains(day) for day in days], len(days)
+
+
+@benchmark('dayrangeset_covering_weeks')
+def bench_dayrangeset_covering_weeks(args):
+    a = DayRangeSet(fragmented_ranges(args.fragments, 1))
+    return lambda: list(a.get_covering_weeks()), args.fragments
+
+
+@benchmark('convert_zrh_datetime_sequence')
+def bench_convert_zrh_datetime_sequence(args):
+    times = [t.astimezone(ZRH_TZ).strftime('%d.%m.%Y %H:%M') for t in quarter_hours(args.years)]
+    return lambda: list(convert_zrh_datetime_sequence(times, lambda x: x, lambda dt, x: dt)), len(times)
+
+
+@benchmark('parse_api_timestamp')
+def bench_parse_api_timestamp(args):
+    timestamps = [int(t.strftime('%Y%m%d%H%M%S')) for t in quarter_hours(args.years)]
+    return lambda: [parse_api_timestamp(t) for t in timestamps], len(timestamps)
+
+
+@benchmark('parse_api_timestamps')
+def bench_parse_api_timestamps(args):
+    values = [{'timestamp': int(t.strftime('%Y%m%d%H%M%S')), 'value': 0.1, 'status': 'VALID'}
+              for t in quarter_hours(args.years)]
+    return lambda: parse_api_timestamps(values), len(values)
+
+
+@benchmark('read_csv')
+def bench_read_csv(args):
+    rows = synthetic_rows(args.years)
+    filename = os.path.join(args.tmpdir, 'read.csv')
+    csv.write_rows(filename, rows)
+    return lambda: csv.read_csv(filename), len(rows)
+
+
+@benchmark('write_csv')
+def bench_write_csv(args):
+    rows = synthetic_rows(args.years)
+    datapoints = [csv._to_datapoint(row) for row in rows]
+    filename = os.path.join(args.tmpdir, 'write.csv')
+    return lambda: csv.write_csv(filename, datapoints), len(rows)
+
+
+@benchmark('csv_merge')
+def bench_csv_merge(args):
+    # Backfilling a missing month in the middle of the file, which has to merge and rewrite everything.
+    rows = synthetic_rows(args.years)
+    middle = len(rows) // 2
+    existing, new = rows[:middle] + rows[middle + 30 * 96:], TimeSeries.from_rows(rows[middle:middle + 30 * 96])
+    filename = os.path.join(args.tmpdir, 'merge.csv')
+
+    def merge():
+        csv.write_rows(filename, existing)
+        csv._add_to_file(filename, new, existing[-1][0])
+    return merge, len(rows)
+
+
+def measure(fn: Callable[[], object], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - begin)
+    return best
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old: dict, new: dict):
+    print(f'{"benchmark":<30}  {"old items/s":>14}  {"new items/s":>14}  {"change":>7}')
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before, after = old['results'][name]['per_second'], result['per_second']
+        print(f'{name:<30}  {before:>14,.0f}  {after:>14,.0f}  {after / before:>6.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', '--filter', default='', help='Only run benchmarks whose name contains this.')
+    parser.add_argument('--years', type=int, default=5, help='Years of 15 minute values in synthetic data.')
+    parser.add_argument('--fragments', type=int, default=10000, help='Number of ranges in each DayRangeSet.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark, the fastest one counts.')
+    parser.add_argument('-o', '--output', help='Where to write the JSON results.')
+    parser.add_argument('--baseline', help='Earlier results to compare against.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Only compare two earlier results.')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        return
+
+    commit = git_commit()
+    output = {
+        'commit': commit,
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'years': args.years, 'fragments': args.fragments, 'repeat': args.repeat},
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as args.tmpdir:
+        for name, bench in BENCHMARKS.items():
+            if args.filter not in name:
+                continue
+            fn, items = bench(args)
+            seconds = measure(fn, args.repeat)
+            output['results'][name] = {'seconds': seconds, 'items': items, 'per_second': items / seconds}
+            print(f'{name:<30}  {seconds * 1000:>10.1f} ms  {items / seconds:>14,.0f} items/s', file=sys.stderr)
+
+    filename = args.output or os.path.join(RESULTS_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'Results written to {filename}', file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Measure how long the CLI takes to start, using python -X importtime.
+
+Reported are the time to import ekzexport.cli, the wall time of "ekzexport --help" compared to an empty interpreter
+and the slowest imports below ekzexport.cli. Results are written as JSON, by default to
+benchmarks/results/startup-<commit>.json, and can be compared to an earlier run:
+
+    python benchmarks/bench_startup.py [--repeat 5] [--baseline old.json] [--max-import-ms 150]
+
+With --max-import-ms, the script fails if importing ekzexport.cli takes longer, e.g. to catch regressions in CI."""
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import subprocess
+import sys
+import time
+
+from typing import Dict, List, Tuple
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+MODULE = 'ekzexport.cli'
+
+Import = Tuple[str, int, int, int]  # name, depth, self µs, cumulative µs
+
+
+def parse_importtime(output: str) -> List[Import]:
+    """The imports reported by -X importtime, in the order printed, i.e. children before their parent."""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        stripped = name.lstrip()
+        imports.append((stripped.rstrip(), (len(name) - len(stripped) - 1) // 2, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def children(imports: List[Import], module: str) -> Dict[str, int]:
+    """Cumulative µs of the modules imported directly by the top-level import of module."""
+    index = next(i for i, (name, depth, _, _) in enumerate(imports) if name == module and depth == 0)
+    result = {}
+    for name, depth, _, cumulative in reversed(imports[:index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            result[name] = cumulative
+    return result
+
+
+def measure_import(repeat: int) -> Tuple[float, Dict[str, int]]:
+    """Fastest import of MODULE in ms and the cumulative µs of its children in that run."""
+    best, best_children = float('inf'), {}
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {MODULE}'], capture_output=True,
+                                text=True, check=True).stderr
+        imports = parse_importtime(output)
+        total = next(cumulative for name, depth, _, cumulative in imports if name == MODULE and depth == 0) / 1000
+        if total < best:
+            best, best_children = total, children(imports, MODULE)
+    return best, best_children
+
+
+def measure_wall(args: List[str], repeat: int) -> float:
+    """Fastest wall time in ms of running python with args."""
+    best = float('inf')
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, check=True)
+        best = min(best, time.perf_counter() - begin)
+    return best * 1000
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement, the fastest one counts.')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to show.')
+    parser.add_argument('-o', '--output', help='Where to write the JSON results.')
+    parser.add_argument('--baseline', help='Earlier results to compare against.')
+    parser.add_argument('--max-import-ms', type=float, help=f'Fail if importing {MODULE} takes longer.')
+    args = parser.parse_args()
+
+    import_ms, imports = measure_import(args.repeat)
+    python_ms = measure_wall(['-c', 'pass'], args.repeat)
+    help_ms = measure_wall(['-c', f'from {MODULE} import main; main()', '--help'], args.repeat)
+
+    print(f'{"import " + MODULE:<30}  {import_ms:>8.1f} ms')
+    print(f'{"ekzexport --help":<30}  {help_ms:>8.1f} ms  (python -c pass: {python_ms:.1f} ms)')
+    print(f'Slowest imports below {MODULE}:')
+    for name, cumulative in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'  {name:<28}  {cumulative / 1000:>8.1f} ms')
+
+    commit = git_commit()
+    output = {
+        'commit': commit,
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'import_ms': import_ms,
+        'help_ms': help_ms,
+        'python_ms': python_ms,
+        'imports_ms': {name: cumulative / 1000 for name, cumulative in imports.items()},
+    }
+    filename = args.output or os.path.join(RESULTS_DIR, f'startup-{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'Results written to {filename}', file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            old = json.load(f)
+        for key in ('import_ms', 'help_ms'):
+            print(f'{key:<30}  {old[key]:>8.1f} ms -> {output[key]:>8.1f} ms  {output[key] / old[key]:>6.2f}x')
+
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        sys.exit(f'Importing {MODULE} took {import_ms:.1f} ms, more than the allowed {args.max_import_ms:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import asyncio
+import time
+
+from .apitypes import *
+from .session import BASE_URL, HTML_HEADERS, JSON_HEADERS, endpoint_name, error_reason, login_flow, needs_login
+from .cache import ResponseCache
+from .metrics import ExportMetrics
+from .ratelimit import RateLimiter, RetryPolicy
+from .sessionstore import SessionStore
+from .stats import Stats, count_values
+
+try:
+    import httpx
+    _HAVE_HTTPX = True
+except ImportError:
+    _HAVE_HTTPX = False
+
+
+class AsyncSession:
+    """Represents a session with the EKZ API for use from an asyncio event loop.
+
+    Mirrors Session, but every API call is a coroutine. Use it as an async context manager:
+
+        async with AsyncSession(user, password) as session:
+            data = await session.get_consumption_data(...)
+
+    Calls can be issued concurrently (e.g. with asyncio.gather) and share a single login. Like Session, a
+    SessionStore can be passed to reuse a stored login and a ResponseCache to avoid retrieving final data again, as
+    well as a RateLimiter and RetryPolicy. Waiting for those happens with asyncio.sleep. The same as for Session
+    is recorded in stats and metrics. A transport, e.g. an httpx.MockTransport, replaces the network.
+
+    Accounts with SMS 2FA cannot login, since asking for the code would block the event loop. Use OTP instead."""
+    def __init__(self, username: str, password: str, token='', login_immediately=False, base_url=BASE_URL,
+                 max_connections=10, store: Optional[SessionStore] = None, cache: Optional[ResponseCache] = None,
+                 rate_limiter: Optional[RateLimiter] = None, retry: Optional[RetryPolicy] = None,
+                 stats: Optional[Stats] = None, metrics: Optional[ExportMetrics] = None,
+                 transport: Optional['httpx.AsyncBaseTransport'] = None):
+        if not _HAVE_HTTPX:
+            raise RuntimeError('httpx is not installed. Run "pip install ekzexport[async]" to get it.')
+        self._client = httpx.AsyncClient(headers={'User-Agent': 'ekzexport'}, follow_redirects=True,
+                                         limits=httpx.Limits(max_connections=max_connections), transport=transport)
+        self._username = username
+        self._password = password
+        self._token = token.strip().replace(' ', '')
+        self._login_immediately = login_immediately
+        self._base_url = base_url.rstrip('/')
+        self._logged_in = False
+        self._login_lock = asyncio.Lock()
+        self._login_generation = 0
+        self._installation_selection_data = None
+        self._store = store
+        self._cache = cache
+        self.rate_limiter = rate_limiter
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.stats = stats if stats is not None else Stats()
+        self.metrics = metrics
+        if store is not None and store.load(self._client.cookies.jar):
+            self._logged_in = True
+
+    async def __aenter__(self):
+        if self._login_immediately:
+            await self._ensure_logged_in()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if self._store is not None:
+                if self._logged_in:
+                    self._store.save(self._client.cookies.jar)
+            elif self._logged_in:
+                r = await self._client.post(f'{self._base_url}/logout', headers=HTML_HEADERS,
+                                            data={'_csrf': await self.get_csrf_token()})
+                r.raise_for_status()
+        finally:
+            await self._client.aclose()
+
+    async def _ensure_logged_in(self):
+        if self._logged_in:
+            return
+        async with self._login_lock:
+            if not self._logged_in:
+                await self._login()
+
+    async def _relogin(self, generation: int):
+        async with self._login_lock:
+            if self._login_generation == generation:
+                self._logged_in = False
+                self._client.cookies.clear()
+                await self._login()
+
+    async def _login(self):
+        flow = login_flow(self._base_url, self._username, self._password, self._token)
+        self.stats.count('logins')
+        start = time.perf_counter()
+        try:
+            method, url, data = next(flow)
+            while True:
+                await self._wait_for_rate_limit()
+                with self.stats.phase('login'):
+                    r = await self._client.request(method, url, data=data,
+                                                   headers=HTML_HEADERS if method == 'GET' else None)
+                self.stats.count('requests')
+                self.stats.count('bytes_received', len(r.content))
+                r.raise_for_status()
+                method, url, data = flow.send((str(r.url), r.text))
+        except StopIteration:
+            pass
+        if self.metrics is not None:
+            self.metrics.login_duration.observe(value=time.perf_counter() - start)
+
+        self._login_generation += 1
+        self._logged_in = True
+
+    async def _get_portal_services_json(self, suffix: str):
+        await self._ensure_logged_in()
+        generation = self._login_generation
+        url = f'{self._base_url}/api/portal-services/{suffix}'
+        start = time.perf_counter()
+        try:
+            r = await self._get_json(url)
+            if needs_login(self._base_url, r.status_code, str(r.url), r.headers.get('Content-Type', '')):
+                await self._relogin(generation)
+                r = await self._get_json(url)
+            r.raise_for_status()
+            with self.stats.phase('decode'):
+                return r.json()
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.request_errors.inc(endpoint_name(suffix), error_reason(e))
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.request_duration.observe(endpoint_name(suffix), value=time.perf_counter() - start)
+
+    async def _wait_for_rate_limit(self):
+        if self.rate_limiter is not None:
+            await self._sleep(self.rate_limiter.reserve())
+
+    async def _sleep(self, seconds: float):
+        if seconds > 0:
+            with self.stats.phase('wait'):
+                await asyncio.sleep(seconds)
+
+    async def _get_json(self, url: str) -> 'httpx.Response':
+        attempt = 0
+        while True:
+            await self._wait_for_rate_limit()
+            try:
+                with self.stats.phase('request'):
+                    r = await self._client.get(url, headers=JSON_HEADERS)
+                    self.stats.count('bytes_received', len(r.content))
+                self.stats.count('requests')
+            except httpx.TransportError:
+                delay = self.retry.retry_delay(attempt, None)
+                if delay is None:
+                    raise
+            else:
+                delay = self.retry.retry_delay(attempt, r.status_code, r.headers.get('Retry-After'))
+                if delay is None:
+                    return r
+            self.stats.count('retries')
+            await self._sleep(delay)
+            attempt += 1
+
+    async def get_csrf_token(self):
+        return (await self._get_portal_services_json('csrf/v1/token'))['token']
+
+    async def installation_selection_data(self) -> InstallationSelectionData:
+        # Session exposes this as a cached property, which cannot be awaited, so cache it by hand.
+        if self._installation_selection_data is None:
+            self._installation_selection_data = await self._get_portal_services_json(
+                'consumption-view/v1/installation-selection-data'
+                '?installationVariant=CONSUMPTION')
+        return self._installation_selection_data
+
+    async def get_installation_data(self, installation_id: str) -> InstallationData:
+        return await self._get_portal_services_json(
+            f'consumption-view/v1/installation-data'
+            f'?installationId={installation_id}')
+
+    async def get_consumption_data(self, installation_id: str, data_type: str,
+                                   date_from: str, date_to: str) -> ConsumptionData:
+        if self._cache is not None:
+            cached = self._cache.get(installation_id, data_type, date_from, date_to)
+            if cached is not None:
+                self.stats.count('cache_hits')
+                self.stats.count('points_received', count_values(cached))
+                return cached
+        data = await self._get_portal_services_json(
+            f'consumption-view/v1/consumption-data'
+            f'?installationId={installation_id}&from={date_from}&to={date_to}&type={data_type}'
+        )
+        self.stats.count('points_received', count_values(data))
+        if self._cache is not None:
+            self._cache.put(installation_id, data_type, date_from, date_to, data)
+        return data
+
+    async def get_legs(self) -> List[LegHeader]:
+        return (await self._get_portal_services_json('leg-manager-dashboard/v1/leg-headers'))['legHeaders']
+
+    async def get_leg_detail(self, leg_id: str) -> LegDetails:
+        return (await self._get_portal_services_json(
+            f'leg-manager-dashboard/v1/leg-details/{leg_id}'))['legDetails']
@@ -1,5 +1,7 @@
 from typing import TypedDict, List, Optional
 
+BASE_URL = 'https://my.ekz.ch'
+
 
 class Address(TypedDict):
     addressNumber: str
@@ -110,6 +112,10 @@ class Series(TypedDict):
     values: List[Value]
 
 
+# Keys of ConsumptionData that can contain a Series
+SERIES_KEYS = ('series', 'seriesHt', 'seriesNetz', 'seriesNetzHt', 'seriesNt')
+
+
 class ConsumptionData(TypedDict):
     """Return schema for /consumption-view/v1/consumption-data?installationId=..."""
     series: Optional[Series]
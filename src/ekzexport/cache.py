@@ -0,0 +1,138 @@
+import datetime
+import hashlib
+import json
+import os
+import os.path
+import sqlite3
+import threading
+import time
+import zlib
+
+from typing import Optional, TypedDict
+
+from platformdirs import user_cache_dir
+
+from .apitypes import ConsumptionData, SERIES_KEYS
+from .timeutil import parse_zrh_day
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_IMMUTABLE_AFTER_DAYS = 14
+
+
+class CacheStats(TypedDict):
+    entries: int
+    bytes: int
+    installations: int
+    oldest_day: Optional[str]
+    newest_day: Optional[str]
+
+
+def is_final(data: ConsumptionData, date_to: str, today: datetime.date, immutable_after_days: int) -> bool:
+    """Whether a response is not expected to change anymore.
+
+    That is the case once all values are VALID and the requested range lies far enough in the past, since EKZ
+    sometimes still corrects values for a few days."""
+    if parse_zrh_day(date_to) >= today - datetime.timedelta(days=immutable_after_days):
+        return False
+    values = [v for key in SERIES_KEYS for v in (data.get(key) or {}).get('values', [])]
+    return bool(values) and all(v['status'] == 'VALID' for v in values)
+
+
+class ResponseCache:
+    """On-disk cache for consumption data responses, stored compressed in a SQLite database.
+
+    Only final responses (see is_final) are stored and they never expire. Anything else is simply not cached, so
+    it gets retrieved again next time. Once the database grows beyond max_bytes, the least recently used
+    responses are evicted."""
+    def __init__(self, path: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES,
+                 immutable_after_days: int = DEFAULT_IMMUTABLE_AFTER_DAYS):
+        self.path = path or os.path.join(user_cache_dir('ekzexport'), 'responses.sqlite')
+        self.max_bytes = max_bytes
+        self.immutable_after_days = immutable_after_days
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        # Concurrent week fetches share the cache, so serialize access to the single connection.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                installation TEXT NOT NULL,
+                data_type TEXT NOT NULL,
+                date_from TEXT NOT NULL,
+                date_to TEXT NOT NULL,
+                fetched REAL NOT NULL,
+                accessed REAL NOT NULL,
+                size INTEGER NOT NULL,
+                body BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+        ''')
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def key(installation_id: str, data_type: str, date_from: str, date_to: str) -> str:
+        return hashlib.sha256(f'{installation_id}\0{data_type}\0{date_from}\0{date_to}'.encode('utf-8')).hexdigest()
+
+    def get(self, installation_id: str, data_type: str, date_from: str, date_to: str) -> Optional[ConsumptionData]:
+        key = self.key(installation_id, data_type, date_from, date_to)
+        with self._lock:
+            row = self._db.execute('SELECT body FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, installation_id: str, data_type: str, date_from: str, date_to: str, data: ConsumptionData):
+        """Store data if it is final, otherwise do nothing."""
+        if not is_final(data, date_to, datetime.date.today(), self.immutable_after_days):
+            return
+        body = zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.key(installation_id, data_type, date_from, date_to), installation_id, data_type,
+                 date_from, date_to, now, now, len(body), body))
+            self._evict(self.max_bytes)
+
+    def _evict(self, max_bytes: int) -> int:
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= max_bytes:
+            return 0
+        evicted = 0
+        for key, size in self._db.execute('SELECT key, size FROM responses ORDER BY accessed, rowid').fetchall():
+            if total <= max_bytes:
+                break
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+            evicted += 1
+        return evicted
+
+    def prune(self, max_bytes: Optional[int] = None, unused_days: Optional[int] = None) -> int:
+        """Evict entries beyond max_bytes (defaults to the configured limit) and those unused for unused_days.
+
+        Returns the number of removed entries."""
+        with self._lock:
+            removed = 0
+            if unused_days is not None:
+                removed += self._db.execute('DELETE FROM responses WHERE accessed < ?',
+                                            (time.time() - unused_days * 86400,)).rowcount
+            removed += self._evict(self.max_bytes if max_bytes is None else max_bytes)
+            self._db.execute('VACUUM')
+        return removed
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            entries, size, installations, oldest, newest = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COUNT(DISTINCT installation), '
+                'MIN(date_from), MAX(date_to) FROM responses').fetchone()
+        return {'entries': entries, 'bytes': size, 'installations': installations,
+                'oldest_day': oldest, 'newest_day': newest}
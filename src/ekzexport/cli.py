@@ -1,35 +1,136 @@
-import itertools
+import csv
+import datetime
+import heapq
+import io
 import json
 import os
 import os.path
+import random
+import signal
+import sys
+import threading
+import time
 import traceback
 
 import click
 
-from typing import Dict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional, Tuple, TypedDict
 
-from platformdirs import user_config_dir, site_config_dir
-from rich.console import Console
-from rich.table import Table
-from rich import box
+from platformdirs import user_cache_dir, user_config_dir, site_config_dir
 
-from .apitypes import GpartData, LegMeteringPointStatus
-from .session import Session
-from .timeutil import format_api_date
-from .util import Installation, pass_installation, pass_session, DataSelection, pass_data, Leg, pass_leg
-from .exporters import ALL_EXPORT_COMMANDS
+from .apitypes import BASE_URL, ConsumptionData, GpartData, LegMeteringPointStatus
+from .planner import FetchPlanner
+from .stats import Stats
+from .timeutil import ZRH_TZ, parse_api_timestamps, parse_zrh_day
+from .util import (Installation, pass_installation, pass_session, DataSelection, pass_data, Leg, pass_leg,
+                   pass_cache, LazyGroup)
+from .exporters import EXPORT_COMMANDS
+
+# Modules that take long to import (requests through .session, rich, sqlite3 through .cache and the exporters)
+# are only imported by the commands using them, so that --help and commands like "cache stats" start quickly.
+if TYPE_CHECKING:
+    from rich.table import Table
+    from .cache import ResponseCache
+    from .session import Session
+
+
+def new_table(title: str) -> 'Table':
+    """A rich table in the style of all output."""
+    from rich import box
+    from rich.table import Table
+    return Table(title=title, box=box.MINIMAL_HEAVY_HEAD)
+
+
+def print_tables(*tables: 'Table', stderr: bool = False):
+    from rich.console import Console
+    console = Console(stderr=stderr)
+    for table in tables:
+        console.print(table)
 
 
 @click.group()
 @click.option('--user', default=None, help='Username')
 @click.option('--password', default=None, help='Password')
 @click.option('--otp', default='', help='OTP Secret')
+@click.option('--session-cache/--no-session-cache', default=None,
+              help='Keep the login session on disk and reuse it in later runs instead of logging in every time.')
+@click.option('--cache/--no-cache', 'response_cache', default=None,
+              help='Keep consumption data that will not change anymore on disk instead of downloading it again.')
+@click.option('--cache-size', type=click.IntRange(min=1), default=None, metavar='MB',
+              help='Maximum size of the consumption data cache. Defaults to 256 MB.')
+@click.option('--rate', type=click.FloatRange(min=0, min_open=True), default=None, metavar='REQUESTS',
+              help='Maximum number of requests per second to myEKZ. Unlimited by default.')
+@click.option('--burst', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of requests that may exceed --rate at once.')
+@click.option('--retries', type=click.IntRange(min=0), default=4, show_default=True,
+              help='How often to retry API calls that are throttled or fail on the server side.')
+@click.option('--max-backoff', type=click.FloatRange(min=0), default=60, show_default=True, metavar='SECONDS',
+              help='Maximum time to wait before retrying an API call.')
+@click.option('--base-url', default=BASE_URL, show_default=True, metavar='URL',
+              help='Where myEKZ is, e.g. the URL of a mock server started with python -m ekzexport.mockserver.')
+@click.option('--stats', 'show_stats', is_flag=True, default=False,
+              help='Print time spent per phase, requests, bytes and points at the end.')
+@click.option('--stats-json', type=click.Path(dir_okay=False, writable=True), default=None, metavar='FILE',
+              help='Write the statistics of --stats as JSON to FILE.')
+@click.option('--profile', type=click.Path(dir_okay=False, writable=True), default=None, metavar='FILE',
+              help='Profile the command with cProfile and write the pstats to FILE.')
+@click.option('--metrics-file', type=click.Path(dir_okay=False, writable=True), default=None, metavar='FILE',
+              help='Write Prometheus metrics to FILE at the end, e.g. for node-exporter\'s textfile collector.')
+@click.option('--metrics-port', type=click.IntRange(min=0, max=65535), default=None, metavar='PORT',
+              help='Serve Prometheus metrics on http://HOST:PORT/metrics while running.')
+@click.option('--metrics-host', default='127.0.0.1', show_default=True, metavar='HOST',
+              help='Address to serve metrics on with --metrics-port.')
 @click.pass_context
-def cli(ctx: click.Context, user: str, password: str, otp: str):
+def cli(ctx: click.Context, user: str, password: str, otp: str, session_cache: bool | None,
+        response_cache: bool | None, cache_size: int | None, rate: float | None, burst: int, retries: int,
+        max_backoff: float, base_url: str, show_stats: bool, stats_json: str | None, profile: str | None,
+        metrics_file: str | None, metrics_port: int | None, metrics_host: str):
     """EKZ API client.
 
     The client only supports user/password login; 3rd party login providers are not supported.
-    All dates are expected to be in Y-m-d notation, e.g. 2000-06-30."""
+    All dates are expected to be in Y-m-d notation, e.g. 2000-06-30.
+
+    With --session-cache (or "session_cache": true in the JSON config), the authenticated session is stored in
+    a file only readable by the current user and reused until myEKZ expires it.
+
+    With --cache (or "cache": true in the JSON config), consumption data is cached locally once all values are
+    valid and it is older than two weeks, since it is not expected to change anymore after that.
+
+    API calls that myEKZ throttles or fails with a server error are retried with exponential backoff, see
+    --retries and --max-backoff. Use --rate to limit the number of requests per second in the first place.
+
+    To find out where the time goes, --stats shows how long logging in, requests, decoding, parsing, merging and
+    writing took. --profile records a profile to be inspected with python -m pstats FILE. Only the main thread is
+    profiled, so use it without --concurrency.
+
+    For monitoring, --metrics-file and --metrics-port provide Prometheus metrics about API latency, logins, errors,
+    weeks fetched, points written and the latest data per installation. The daemon updates the file after every
+    run."""
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+
+        def write_profile():
+            profiler.disable()
+            profiler.dump_stats(profile)
+            click.echo(f'Profile written to {profile}', err=True)
+        ctx.call_on_close(write_profile)
+        profiler.enable()
+
+    stats = Stats()
+    if show_stats or stats_json:
+        # Registered before the session, so the logout is included.
+        ctx.call_on_close(lambda: report_stats(stats, show_stats, stats_json))
+
+    metrics = None
+    if metrics_file or metrics_port is not None:
+        from .metrics import ExportMetrics, MetricsServer
+        metrics = ExportMetrics(metrics_file)
+        ctx.call_on_close(metrics.save)
+        if metrics_port is not None:
+            ctx.with_resource(MetricsServer(metrics, metrics_host, metrics_port))
+
     locations = [os.curdir, os.path.expanduser('~'),
                  user_config_dir('ekzexport', roaming=True), site_config_dir('ekzexport')]
 
@@ -41,10 +142,25 @@ def cli(ctx: click.Context, user: str, password: str, otp: str):
                     user = config['user']
                     password = config['password']
                     otp = config.get('otp', '')
+                    if session_cache is None:
+                        session_cache = config.get('session_cache', False)
+                    if response_cache is None:
+                        response_cache = config.get('cache', False)
+                    if cache_size is None:
+                        cache_size = config.get('cache_size')
                     break
             except Exception as e:
                 pass
 
+    cache = None
+    if response_cache or ctx.invoked_subcommand == 'cache':
+        from .cache import ResponseCache, DEFAULT_MAX_BYTES
+        max_bytes = cache_size * 1024 * 1024 if cache_size else DEFAULT_MAX_BYTES
+        cache = ctx.with_resource(ResponseCache(max_bytes=max_bytes))
+    if ctx.invoked_subcommand == 'cache':
+        ctx.obj = cache  # Managing the cache does not need a session
+        return
+
     if user is None or password is None:
         click.echo('Unable to determine username and password. Either use the --user and --password options '
                    'or place them in a JSON file at one of these locations:', err=True)
@@ -52,14 +168,85 @@ def cli(ctx: click.Context, user: str, password: str, otp: str):
             click.echo('  ' + os.path.join(location, 'ekzexport.json'), err=True)
         raise click.UsageError('Missing username or password')
 
-    ctx.obj = ctx.with_resource(Session(user, password, otp))
+    # Only commands talking to myEKZ get here, so only they import requests with the session.
+    from .ratelimit import RateLimiter, RetryPolicy
+    from .session import Session
+    from .sessionstore import SessionStore
+    store = SessionStore(user, base_url) if session_cache else None
+    rate_limiter = RateLimiter(rate, burst) if rate else None
+    retry = RetryPolicy(retries, max_delay=max_backoff)
+    ctx.obj = ctx.with_resource(Session(user, password, otp, base_url=base_url, store=store, cache=cache,
+                                        rate_limiter=rate_limiter, retry=retry, stats=stats, metrics=metrics))
+
+    def report_throttling():
+        waited = retry.waited + (rate_limiter.waited if rate_limiter is not None else 0)
+        if retry.retried or waited >= 1:
+            click.echo(f'Retried {retry.retried} requests, waited {waited:.1f}s due to rate limits and backoff',
+                       err=True)
+    ctx.call_on_close(report_throttling)
+
+
+def report_stats(stats: Stats, show: bool, filename: Optional[str]):
+    summary = stats.summary()
+    if filename:
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if not show:
+        return
+
+    wall = summary['wall_seconds']
+    phases = new_table(f'Time ({wall:.2f}s wall time)')
+    phases.add_column('Phase')
+    phases.add_column('Calls', justify='right')
+    phases.add_column('Seconds', justify='right')
+    phases.add_column('% of wall time', justify='right')
+    for name, phase in sorted(summary['phases'].items(), key=lambda item: -item[1]['seconds']):
+        phases.add_row(name, str(phase['calls']), f'{phase["seconds"]:.3f}',
+                       f'{phase["seconds"] / wall * 100:.1f}' if wall else '')
+
+    counters = new_table('Counters')
+    counters.add_column('Counter')
+    counters.add_column('Value', justify='right')
+    for name, value in sorted(summary['counters'].items()):
+        counters.add_row(name, f'{value:,}')
+
+    print_tables(phases, counters, stderr=True)
+
+
+def record_selection(session: 'Session', data: DataSelection):
+    session.stats.count('weeks_fetched', data.weeks_fetched)
+    session.stats.count('points_written', data.points_written)
+
+
+@contextmanager
+def record_export(session: 'Session', installation_id: str, data: DataSelection, sink: str):
+    """Record the outcome of the export running in the with block in the session's metrics, if it has any."""
+    metrics = session.metrics
+    if metrics is None:
+        yield
+        return
+    try:
+        yield
+    except Exception:
+        metrics.export_errors.inc(installation_id, sink)
+        raise
+    else:
+        metrics.last_success.set(installation_id, sink, value=time.time())
+    finally:
+        metrics.exports.inc(installation_id, sink)
+        metrics.points_written.inc(installation_id, sink, amount=data.points_written)
+        if data.weeks_fetched:
+            metrics.weeks_fetched.inc(installation_id, data.data_type, amount=data.weeks_fetched)
+        # The data type is not looked up here, as that might be what failed.
+        if data.latest_timestamp is not None and data.known_data_type is not None:
+            metrics.latest_data.set(installation_id, data.known_data_type, value=data.latest_timestamp)
 
 
 @cli.command()
 @pass_session
-def overview(session: Session):
+def overview(session: 'Session'):
     """Get an overview over available contracts."""
-    contracts = Table(title='Contracts', box=box.MINIMAL_HEAVY_HEAD)
+    contracts = new_table('Contracts')
     contracts.add_column('Installation ID')
     contracts.add_column('Address')
     contracts.add_column('Move-in Date')
@@ -74,8 +261,7 @@ def overview(session: Session):
                 break
         contracts.add_row(c['anlage'], address, c['einzdat'], c['auszdat'])
 
-    console = Console()
-    console.print(contracts)
+    print_tables(contracts)
 
 
 @cli.group('installation')
@@ -89,9 +275,9 @@ def installation_group(ctx: click.Context, installation_id: str):
 @installation_group.command('properties')
 @pass_installation
 @pass_session
-def installation_properties(session: Session, installation: Installation):
+def installation_properties(session: 'Session', installation: Installation):
     """List installation properties."""
-    table = Table(title='Properties', box=box.MINIMAL_HEAVY_HEAD)
+    table = new_table('Properties')
     table.add_column('Property')
     table.add_column('From')
     table.add_column('Until')
@@ -99,82 +285,391 @@ def installation_properties(session: Session, installation: Installation):
     for p in session.get_installation_data(installation.id)['status']:
         table.add_row(p['property'], p['ab'], p['bis'])
 
-    console = Console()
-    console.print(table)
+    print_tables(table)
+
+
+def data_selection_options(f):
+    """Options selecting which consumption data to retrieve, shared by the data group and export-all."""
+    options = [
+        click.option('--type', 'data_type', default=None, metavar='TYPE',
+                     help='Type of consumption data to fetch. '
+                          'Defaults to PK_VERB_15MIN if available, PK_VERB_TAG_EDM otherwise.'),
+        click.option('--from', 'date_from', default=None, metavar='YYYY-MM-DD',
+                     help='Date from which to start fetching data. Defaults to 7 days before to.'),
+        click.option('--to', 'date_to', default=None, metavar='YYYY-MM-DD',
+                     help='Date until which to fetch data. Defaults to the latest date with data available.'),
+        click.option('-l', '--limit', type=int, default=4,
+                     help='Maximum number of weeks worth of data to download.'),
+        click.option('-j', '--concurrency', type=click.IntRange(min=1), default=1,
+                     help='Number of weeks to download in parallel.'),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def default_planner() -> FetchPlanner:
+    return FetchPlanner(os.path.join(user_cache_dir('ekzexport'), 'windows.json'))
 
 
 @installation_group.group('data')
-@click.option('--type', 'data_type', default=None, metavar='TYPE',
-              help='Type of consumption data to fetch. '
-                   'Defaults to PK_VERB_15MIN if available, PK_VERB_TAG_EDM otherwise.')
-@click.option('--from', 'date_from', default=None, metavar='YYYY-MM-DD',
-              help='Date from which to start fetching data. Defaults to 7 days before to.')
-@click.option('--to', 'date_to', default=None, metavar='YYYY-MM-DD',
-              help='Date until which to fetch data. Defaults to the latest date with data available.')
-@click.option('-l', '--limit', type=int, default=4, help='Maximum number of weeks to download.')
+@data_selection_options
 @pass_installation
 @pass_session
 @click.pass_context
-def installation_data(ctx: click.Context, session: Session, installation: Installation,
-                      data_type: str | None, date_from: str | None, date_to: str | None, limit: int):
+def installation_data(ctx: click.Context, session: 'Session', installation: Installation,
+                      data_type: str | None, date_from: str | None, date_to: str | None, limit: int,
+                      concurrency: int):
     """Data retrieval actions.
 
     You can control the time window of data to be downloaded with the --from and --to options. If they are not
     explicitly specified, the bounds of available data reported by the API will be used. The number of weeks
-    worth of data is limited to prevent unintended large downloads. Use --limit to override."""
-    ctx.obj = DataSelection(session, installation.id, data_type, date_from, date_to, limit)
+    worth of data is limited to prevent unintended large downloads. Use --limit to override.
+
+    With --concurrency, several weeks are downloaded in parallel. Results are still processed in chronological
+    order, but please be considerate of myEKZ and keep the number low."""
+    ctx.obj = DataSelection(session, installation.id, data_type, date_from, date_to, limit, concurrency,
+                            default_planner())
+    ctx.call_on_close(lambda: record_selection(session, ctx.obj))
+
+
+ValueRow = Tuple[int, str, Optional[float], str]  # UNIX timestamp, tariff, kWh and status
+SHOW_FORMATS = ['table', 'jsonl', 'csv', 'tsv']
+SHOW_COLUMNS = ['time', 'kwh', 'tariff', 'status']
+SHOW_DELIMITERS = {'csv': ',', 'tsv': '\t'}
+
+
+def value_rows(data: ConsumptionData) -> Iterator[ValueRow]:
+    """All HT and NT values of an API response in time order, NT first where both have the same timestamp."""
+    def series(key: str, tariff: str) -> List[ValueRow]:
+        values = (data.get(key) or {}).get('values', [])
+        rows = [(epoch, tariff, v['value'], v['status']) for epoch, v in zip(parse_api_timestamps(values), values)]
+        if any(rows[i][0] > rows[i + 1][0] for i in range(len(rows) - 1)):
+            rows.sort(key=lambda row: row[0])
+        return rows
+    # Both series are ordered, so they only have to be merged. Ties keep the order of the arguments.
+    return heapq.merge(series('seriesNt', 'NT'), series('seriesHt', 'HT'), key=lambda row: row[0])
+
+
+def format_rows(rows: Iterable[ValueRow], output_format: str) -> str:
+    """rows as lines of JSON objects, CSV or TSV, with ISO 8601 times in Zurich."""
+    out = io.StringIO()
+    if output_format == 'jsonl':
+        for epoch, tariff, value, status in rows:
+            time = datetime.datetime.fromtimestamp(epoch, ZRH_TZ).isoformat()
+            out.write(json.dumps(dict(zip(SHOW_COLUMNS, (time, value, tariff, status)))) + '\n')
+    else:
+        writer = csv.writer(out, delimiter=SHOW_DELIMITERS[output_format], lineterminator='\n')
+        writer.writerows((datetime.datetime.fromtimestamp(epoch, ZRH_TZ).isoformat(), value, tariff, status)
+                         for epoch, tariff, value, status in rows)
+    return out.getvalue()
 
 
 @installation_data.command('show')
+@click.option('--format', 'output_format', type=click.Choice(SHOW_FORMATS), default='table', show_default=True,
+              help='How to print the values.')
 @pass_data
 @pass_installation
 @pass_session
-def show_installation_data(session: Session, installation: Installation, data: DataSelection):
-    """Show consumption data."""
-    table = Table(title='Consumption Data', box=box.MINIMAL_HEAVY_HEAD)
+def show_installation_data(session: 'Session', installation: Installation, data: DataSelection,
+                           output_format: str):
+    """Show consumption data.
+
+    Except for the table, the formats are written week by week as the data arrives, so even long time ranges can
+    be piped into other tools right away. They have one value per line with its time in ISO 8601, e.g.
+    2024-04-01T00:15:00+02:00, the kWh, the tariff and the status. CSV and TSV start with a header."""
+    windows = data.fetch_consumption_data(data.requested_windows())
+    if output_format != 'table':
+        if output_format in SHOW_DELIMITERS:
+            click.echo(SHOW_DELIMITERS[output_format].join(SHOW_COLUMNS))
+        for window, d in windows:
+            click.echo(format_rows(value_rows(d), output_format), nl=False)
+        return
+
+    table = new_table('Consumption Data')
     table.add_column('Time')
     table.add_column('kWh')
     table.add_column('Tariff')
     table.add_column('Status')
+    for window, d in windows:
+        for epoch, tariff, value, status in value_rows(d):
+            time = datetime.datetime.fromtimestamp(epoch, ZRH_TZ).strftime('%d.%m.%Y %H:%M')
+            table.add_row(time, '' if value is None else str(value), tariff, status)
+    print_tables(table)
+
+
+@installation_data.group('export', cls=LazyGroup, lazy_commands=EXPORT_COMMANDS)
+@pass_data
+@pass_installation
+@pass_session
+@click.pass_context
+def export_group(ctx: click.Context, session: 'Session', installation: Installation, data: DataSelection):
+    """Export consumption data."""
+    ctx.with_resource(record_export(session, installation.id, data, ctx.invoked_subcommand))
 
-    weekly_data = []
-    for week in data.requested_weeks():
-        d = session.get_consumption_data(installation.id, data.data_type,
-                                         format_api_date(week.start), format_api_date(week.end))
-        weekly_data.append((dict(x, tariff='NT') for x in d['seriesNt']['values']))
-        weekly_data.append((dict(x, tariff='HT') for x in d['seriesHt']['values']))
 
-    values = sorted(itertools.chain(*weekly_data), key=lambda x: x['timestamp'])
-    for v in values:
-        table.add_row(f'{v["date"]} {v["time"]}', str(v['value']), v['tariff'], v['status'])
+def export_command(name: str) -> click.Command:
+    """The command of the exporter with the given name, which is imported on first use."""
+    if name not in EXPORT_COMMANDS:
+        raise KeyError(name)
+    return export_group.get_command(click.get_current_context(silent=True), name)
 
-    console = Console()
-    console.print(table)
 
+class ExportResult(TypedDict):
+    installation: str
+    error: Optional[str]
+    weeks_fetched: int
+    points_written: int
+    seconds: float
 
-@installation_data.group('export')
-def export_group():
-    """Export consumption data."""
+
+def run_export(ctx: click.Context, installation_id: str, exporter: click.Command, args: List[str],
+               selection: Dict[str, Any], planner: FetchPlanner) -> ExportResult:
+    """Run an exporter for one installation, as "installation <id> data export <exporter> <args>" would.
+
+    ctx has to provide the session. {installation} in args is replaced by installation_id. Errors are reported in
+    the result instead of being raised."""
+    from .session import Session
+    session = ctx.find_object(Session)
+    data = DataSelection(session, installation_id, selection['data_type'], selection['date_from'],
+                         selection['date_to'], selection['limit'], selection['concurrency'], planner)
+    args = [arg.replace('{installation}', installation_id) for arg in args]
+    start = time.monotonic()
+    error = None
+    try:
+        with click.Context(installation_group, parent=ctx, obj=Installation(installation_id)) as ctx:
+            with click.Context(installation_data, parent=ctx, obj=data) as ctx:
+                with exporter.make_context(exporter.name, args, parent=ctx) as ctx:
+                    with record_export(session, installation_id, data, exporter.name):
+                        exporter.invoke(ctx)
+    except Exception as e:
+        error = e.format_message() if isinstance(e, click.ClickException) else f'{type(e).__name__}: {e}'
+    record_selection(session, data)
+    return {'installation': installation_id, 'error': error, 'weeks_fetched': data.weeks_fetched,
+            'points_written': data.points_written, 'seconds': time.monotonic() - start}
+
+
+def check_exporter_args(exporter: click.Command, args: List[str]):
+    """Fail early if the exporter's arguments are wrong, rather than once for every run."""
+    exporter.make_context(exporter.name, [arg.replace('{installation}', '0') for arg in args]).close()
+
+
+def select_installations(session: 'Session', moved_in_before: Optional[datetime.date] = None,
+                         moved_out_after: Optional[datetime.date] = None) -> List[str]:
+    """IDs of the installations of all contracts, optionally filtered by move-in and move-out dates."""
+    result = []
+    for c in session.installation_selection_data['contracts']:
+        if moved_in_before is not None and c['einzdat'] and parse_zrh_day(c['einzdat']) > moved_in_before:
+            continue
+        if moved_out_after is not None and c['auszdat'] and parse_zrh_day(c['auszdat']) < moved_out_after:
+            continue
+        if c['anlage'] not in result:
+            result.append(c['anlage'])
+    return result
+
+
+@cli.command('export-all', context_settings={'ignore_unknown_options': True})
+@data_selection_options
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of installations to export in parallel.')
+@click.option('--moved-in-before', type=click.DateTime(['%Y-%m-%d']), default=None, metavar='YYYY-MM-DD',
+              help='Only export contracts with a move-in date on or before this day.')
+@click.option('--moved-out-after', type=click.DateTime(['%Y-%m-%d']), default=None, metavar='YYYY-MM-DD',
+              help='Only export contracts without a move-out date or one on or after this day.')
+@click.argument('exporter', type=click.Choice(list(EXPORT_COMMANDS)))
+@click.argument('args', nargs=-1, type=click.UNPROCESSED)
+@pass_session
+@click.pass_context
+def export_all(ctx: click.Context, session: 'Session', data_type: str | None, date_from: str | None,
+               date_to: str | None, limit: int, concurrency: int, workers: int,
+               moved_in_before: datetime.datetime | None, moved_out_after: datetime.datetime | None,
+               exporter: str, args: Tuple[str, ...]):
+    """Run an exporter for every installation of your contracts.
+
+    EXPORTER and ARGS are the same as for "installation <id> data export", with {installation} in ARGS replaced
+    by the installation ID, for example:
+
+        ekzexport export-all --workers 4 csv -f data-{installation}.csv
+
+    Installations are exported in parallel by --workers, all sharing one login session. A summary of every
+    installation is shown at the end. Installations that failed are listed there and make the command fail."""
+    command = export_command(exporter)
+    check_exporter_args(command, list(args))
+
+    installations = select_installations(session, moved_in_before and moved_in_before.date(),
+                                         moved_out_after and moved_out_after.date())
+    selection = {'data_type': data_type, 'date_from': date_from, 'date_to': date_to, 'limit': limit,
+                 'concurrency': concurrency}
+    planner = default_planner()
+    session.ensure_pool_size(workers * concurrency)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda installation_id: run_export(ctx, installation_id, command, list(args), selection, planner),
+            installations))
+
+    from rich.text import Text
+    table = new_table('Export Summary')
+    table.add_column('Installation ID')
+    table.add_column('Weeks Fetched', justify='right')
+    table.add_column('Points Written', justify='right')
+    table.add_column('Time', justify='right')
+    table.add_column('Result')
+    for r in results:
+        table.add_row(r['installation'], str(r['weeks_fetched']), str(r['points_written']), f'{r["seconds"]:.1f}s',
+                      'OK' if r['error'] is None else Text(r['error'], style='red'))
+    print_tables(table)
+
+    failed = [r['installation'] for r in results if r['error'] is not None]
+    if failed:
+        raise click.ClickException(f'Export failed for {len(failed)} of {len(results)} installations')
+
+
+class DaemonJob(TypedDict):
+    installation: str
+    exporter: str
+    args: List[str]
+    selection: Dict[str, Any]  # Same as for run_export
+
+
+def load_daemon_jobs(filename: str) -> List[DaemonJob]:
+    """Read jobs from a JSON file containing a list like
+    [{"installation": "456", "exporter": "csv", "args": ["-f", "data.csv"], "type": ..., "from": ..., "to": ...,
+    "limit": ..., "concurrency": ...}], where only installation and exporter are required."""
+    with open(filename, 'r') as f:
+        config = json.load(f)
+    if not isinstance(config, list):
+        raise click.BadParameter('Expected a list of jobs', param_hint='JOBS')
+
+    jobs = []
+    for i, job in enumerate(config):
+        try:
+            exporter = export_command(job['exporter'])
+            args = [str(arg) for arg in job.get('args', [])]
+            check_exporter_args(exporter, args)
+            jobs.append({
+                'installation': str(job['installation']),
+                'exporter': exporter.name,
+                'args': args,
+                'selection': {'data_type': job.get('type'), 'date_from': job.get('from'), 'date_to': job.get('to'),
+                              'limit': int(job.get('limit', 4)), 'concurrency': int(job.get('concurrency', 1))},
+            })
+        except (KeyError, TypeError, ValueError, click.ClickException) as e:
+            message = e.format_message() if isinstance(e, click.ClickException) else f'{type(e).__name__}: {e}'
+            raise click.BadParameter(f'Invalid job #{i + 1}: {message}', param_hint='JOBS')
+    return jobs
+
+
+def next_run_delay(interval: float, jitter: float, min_interval: float, elapsed: float,
+                   rng: random.Random) -> float:
+    """Seconds to wait after a run that took elapsed seconds.
+
+    Runs start every interval seconds, give or take up to jitter seconds, but never less than min_interval
+    seconds apart."""
+    return max(0.0, max(min_interval, interval + rng.uniform(-jitter, jitter)) - elapsed)
+
+
+@cli.command('daemon')
+@click.argument('jobs_file', metavar='JOBS', type=click.Path(exists=True, dir_okay=False))
+@click.option('--interval', type=click.IntRange(min=1), default=3600, show_default=True, metavar='SECONDS',
+              help='Time between the start of two runs.')
+@click.option('--jitter', type=click.IntRange(min=0), default=300, show_default=True, metavar='SECONDS',
+              help='Randomly start runs up to this much earlier or later.')
+@click.option('--min-interval', type=click.IntRange(min=0), default=900, show_default=True, metavar='SECONDS',
+              help='Minimum time between the start of two runs, regardless of jitter.')
+@click.option('--runs', type=click.IntRange(min=0), default=0, help='Stop after this many runs. 0 runs forever.')
+@pass_session
+@click.pass_context
+def daemon(ctx: click.Context, session: 'Session', jobs_file: str, interval: int, jitter: int, min_interval: int,
+           runs: int):
+    """Periodically run exporters, keeping the login session alive in between.
+
+    JOBS is a JSON file with a list of jobs, each selecting an installation, an exporter and its arguments, e.g.:
+
+    \b
+        [{"installation": "456", "exporter": "csv", "args": ["-f", "data-456.csv"]},
+         {"installation": "789", "exporter": "sqlite", "args": ["-f", "data.sqlite"], "type": "PK_VERB_TAG_EDM"}]
+
+    Jobs also accept "type", "from", "to", "limit" and "concurrency" like "installation <id> data". Since the
+    exporters only retrieve weeks they are missing, most runs only need the latest week. If myEKZ expires the
+    session, the daemon logs in again."""
+    jobs = load_daemon_jobs(jobs_file)
+    planner = default_planner()
+    rng = random.Random()
+    if threading.current_thread() is threading.main_thread():
+        # Make sure the session is cleaned up properly when being stopped by a service manager.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    run = 0
+    while True:
+        run += 1
+        start = time.monotonic()
+        for job in jobs:
+            r = run_export(ctx, job['installation'], export_command(job['exporter']), job['args'],
+                           job['selection'], planner)
+            summary = f'{r["weeks_fetched"]} weeks fetched, {r["points_written"]} points written'
+            click.echo(f'{datetime.datetime.now().isoformat(timespec="seconds")} {r["installation"]} '
+                       f'{job["exporter"]}: {summary if r["error"] is None else r["error"]} '
+                       f'({r["seconds"]:.1f}s)', err=True)
+        if session.metrics is not None:
+            session.metrics.save()
+        if runs and run >= runs:
+            break
+        time.sleep(next_run_delay(interval, jitter, min_interval, time.monotonic() - start, rng))
+
+
+@cli.group('cache')
+def cache_group():
+    """Manage the local consumption data cache."""
     pass
 
 
-for cmd in ALL_EXPORT_COMMANDS:
-    export_group.add_command(cmd)
+@cache_group.command('stats')
+@pass_cache
+def cache_stats(cache: 'ResponseCache'):
+    """Show what is in the cache."""
+    stats = cache.stats()
+    table = new_table('Cache')
+    table.add_column('Property')
+    table.add_column('Value')
+    table.add_row('Location', cache.path)
+    table.add_row('Cached responses', str(stats['entries']))
+    table.add_row('Installations', str(stats['installations']))
+    table.add_row('Size', f"{stats['bytes'] / 1024 / 1024:.1f} MB of {cache.max_bytes / 1024 / 1024:.0f} MB")
+    table.add_row('From', stats['oldest_day'] or 'N/A')
+    table.add_row('Until', stats['newest_day'] or 'N/A')
+
+    print_tables(table)
+
+
+@cache_group.command('prune')
+@click.option('--max-size', type=click.IntRange(min=0), default=None, metavar='MB',
+              help='Evict least recently used data until the cache is at most this large. '
+                   'Defaults to the configured cache size.')
+@click.option('--unused-days', type=click.IntRange(min=0), default=None, metavar='DAYS',
+              help='Remove data that has not been used for this many days.')
+@click.option('--all', 'remove_all', is_flag=True, help='Empty the cache completely.')
+@pass_cache
+def cache_prune(cache: 'ResponseCache', max_size: int | None, unused_days: int | None, remove_all: bool):
+    """Remove data from the cache."""
+    if remove_all:
+        max_size = 0
+    removed = cache.prune(max_size * 1024 * 1024 if max_size is not None else None, unused_days)
+    click.echo(f'Removed {removed} cached responses', err=True)
 
 
 @cli.command('legs')
 @pass_session
-def show_legs(session: Session):
+def show_legs(session: 'Session'):
     """Shows a list of LEGs managed by this account."""
-    legs = Table(title='Legs', box=box.MINIMAL_HEAVY_HEAD)
+    legs = new_table('Legs')
     legs.add_column('LEG ID')
     legs.add_column('Leg Name')
 
     for leg in session.get_legs():
         legs.add_row(leg['legId'], leg['description'])
 
-    console = Console()
-    console.print(legs)
+    print_tables(legs)
 
 
 @cli.group('leg')
@@ -188,11 +683,11 @@ def leg_group(ctx: click.Context, leg_id: str):
 @leg_group.command('show')
 @pass_leg
 @pass_session
-def show_leg(session: Session, leg: Leg):
+def show_leg(session: 'Session', leg: Leg):
     """Show details about a specific LEG."""
     leg = session.get_leg_detail(leg.id)
 
-    stats = Table(title=f'LEG {leg['basisInfo']['description']} Stats', box=box.MINIMAL_HEAVY_HEAD)
+    stats = new_table(f'LEG {leg["basisInfo"]["description"]} Stats')
     stats.add_column('Metric')
     stats.add_column('Value')
     stats.add_row('Participants', str(leg['kpi']['numberOfParticipants']))
@@ -209,7 +704,7 @@ def show_leg(session: Session, leg: Leg):
     for data in leg['gpartCommonData']:
         data_by_gpart[data['gpart']] = data
 
-    mpoints = Table(title='Participating Metering Points', box=box.MINIMAL_HEAVY_HEAD)
+    mpoints = new_table('Participating Metering Points')
     mpoints.add_column('ID')
     mpoints.add_column('Role')
     mpoints.add_column('Power')
@@ -221,7 +716,7 @@ def show_leg(session: Session, leg: Leg):
         role = 'Producer' if point['specifications']['producer'] else 'Consumer'
         power = (str(point['specifications']['modulePower']) if point['specifications']['producer'] else
                  str(point['specifications']['connectionPower']))
-        location = f'{point['ort']['locationStreet']} {point['ort']['locationHousenumber']}'
+        location = f'{point["ort"]["locationStreet"]} {point["ort"]["locationHousenumber"]}'
         name = 'N/A'
         if point['businessPartnerId'] in data_by_gpart:
             name = data_by_gpart[point['businessPartnerId']]['name']['namePerson']['firstNamePerson1'] or 'N/A'
@@ -232,9 +727,7 @@ def show_leg(session: Session, leg: Leg):
             contact = data_by_gpart[point['businessPartnerId']]['communicationData']['email'] or 'N/A'
         mpoints.add_row(point['meteringPointId'], role, power, location, name, contact)
 
-    console = Console()
-    console.print(stats)
-    console.print(mpoints)
+    print_tables(stats, mpoints)
 
 
 def main():
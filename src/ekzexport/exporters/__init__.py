@@ -1,3 +1,7 @@
-from . import influxdb, csv
-
-ALL_EXPORT_COMMANDS = [influxdb.cli, csv.cli]
+# The exporters are only imported once they are used, since some of them import large client libraries.
+EXPORT_COMMANDS = {
+    'csv': 'ekzexport.exporters.csv:cli',
+    'influxdb': 'ekzexport.exporters.influxdb:cli',
+    'parquet': 'ekzexport.exporters.parquet:cli',
+    'sqlite': 'ekzexport.exporters.sqlite:cli',
+}
@@ -1,57 +1,216 @@
-import collections
+import heapq
 import os.path
 
 import click
-from datetime import datetime
-import itertools
-from typing import TypedDict, List, Optional, Dict
+import datetime
+from typing import TypedDict, List, Optional, Iterable, Iterator
 
 from ..session import Session
+from ..timeseries import TimeSeries, Row
 from ..util import pass_installation, pass_data, pass_session, Installation, DataSelection, DayRange, DayRangeSet
-from ..timeutil import convert_zrh_datetime_sequence, format_api_date, parse_api_timestamp, ZRH_TZ
+from ..timeutil import (parse_zrh_day, days_from_civil, civil_from_days, zrh_offset, zrh_offset_span,
+                        zrh_local_to_epoch, ZRH_TZ)
 
 SEP = 'sep=;'
 HEADER = 'Zeitraum;HT [kWh];NT [kWh]'
 
 
 class Datapoint(TypedDict):
-    time: datetime
+    time: datetime.datetime
     ht: Optional[float]
     nt: Optional[float]
 
 
+def _check_header(f):
+    if f.readline().strip() != SEP:
+        raise Exception(f'Expected CSV file to start with {SEP}')
+
+    if f.readline().strip() != HEADER:
+        raise Exception(f'Expected CSV file to have a header like "{HEADER}"')
+
+
+_HHMM = [f'{h:02d}:{m:02d}' for h in range(24) for m in range(60)]
+
+
+def decode_rows(lines: Iterable[str]) -> Iterator[Row]:
+    """Parse rows formatted as dd.mm.yyyy hh:mm;ht;nt into (UNIX timestamp, ht, nt).
+
+    Times are in Zurich local time, with the repeated hour when switching to winter time handled the same way
+    as convert_zrh_datetime_sequence does. Instead of going through datetime, the fixed layout is sliced and
+    converted with integer arithmetic. The UTC offset is determined once per day, unless the day has a DST
+    transition."""
+    prev_date = None
+    day_start = 0  # Local time at midnight of the current day
+    day_offset = None  # Offset valid for the whole current day or None if it has a transition
+    prev_local = None
+    in_fold = False
+    for line in lines:
+        time, ht, nt = line.strip().split(';')
+        if time[:10] != prev_date:
+            prev_date = time[:10]
+            day_start = days_from_civil(int(time[6:10]), int(time[3:5]), int(time[0:2])) * 86400
+            day_offset = zrh_offset(day_start - 86400)
+            if zrh_offset(day_start + 2 * 86400) != day_offset:
+                day_offset = None
+        local = day_start + int(time[11:13]) * 3600 + int(time[14:16]) * 60
+
+        if day_offset is not None:
+            epoch = local - day_offset
+            in_fold = False
+        else:
+            epoch = zrh_local_to_epoch(local)
+            if in_fold or (prev_local is not None and local < prev_local):
+                fold_epoch = zrh_local_to_epoch(local, fold=1)
+                in_fold = fold_epoch != epoch  # Either still or newly in the repeated hour
+                if in_fold:
+                    epoch = fold_epoch
+        prev_local = local
+
+        yield epoch, float(ht) if ht else None, float(nt) if nt else None
+
+
+def encode_rows(rows: Iterable[Row]) -> Iterator[str]:
+    """Format (UNIX timestamp, ht, nt) as CSV rows in Zurich local time, the inverse of decode_rows."""
+    offset, offset_start, offset_end = 0, 0, 0
+    prev_day = None
+    date = ''
+    for epoch, ht, nt in rows:
+        if not offset_start <= epoch < offset_end:
+            offset, offset_start, offset_end = zrh_offset_span(epoch)
+        local = epoch + offset
+        day, seconds = divmod(local, 86400)
+        if day != prev_day:
+            prev_day = day
+            year, month, day_of_month = civil_from_days(day)
+            date = f'{day_of_month:02d}.{month:02d}.{year:04d}'
+        yield f'{date} {_HHMM[seconds // 60]};{ht if ht else ""};{nt if nt else ""}\n'
+
+
+def _to_datapoint(row: Row) -> Datapoint:
+    return {'time': datetime.datetime.fromtimestamp(row[0], ZRH_TZ), 'ht': row[1], 'nt': row[2]}
+
+
+def _to_row(dp: Datapoint) -> Row:
+    return int(dp['time'].timestamp()), dp.get('ht'), dp.get('nt')
+
+
 def read_csv(filename: str) -> List[Datapoint]:
+    return [_to_datapoint(row) for row in read_series(filename).rows()]
+
+
+def read_series(filename: str) -> TimeSeries:
+    return TimeSeries.from_rows(iter_rows(filename))
+
+
+def iter_rows(filename: str) -> Iterator[Row]:
+    """Lazily read the rows of a CSV file, the file is closed once all rows have been consumed."""
     if not os.path.exists(filename):
-        return []
+        return
 
     with open(filename, 'r', newline='\n') as f:
-        if f.readline().strip() != SEP:
-            raise Exception(f'Expected CSV file to start with {SEP}')
+        _check_header(f)
+        yield from decode_rows(f)
 
-        if f.readline().strip() != HEADER:
-            raise Exception(f'Expected CSV file to have a header like "{HEADER}"')
 
-        return list(convert_zrh_datetime_sequence(
-            (line.strip().split(';') for line in f),  # Each row is dd.mm.yyyy hh:mm;ht;nt
-            lambda x: x[0],
-            lambda dt, line_parts: {
-                'time': dt,
-                'ht': float(line_parts[1]) if line_parts[1] else None,
-                'nt': float(line_parts[2]) if line_parts[2] else None,
-            }
-        ))
+def merge_rows(existing: Iterable[Row], new: Iterable[Row]) -> Iterator[Row]:
+    """Merge two streams of rows sorted by time into one, like TimeSeries.upsert but without keeping either in memory.
+
+    Where both have a row for the same time, the values of new replace those of existing, unless they are None."""
+    # The second element makes rows of existing come first for equal timestamps and keeps the rows from being compared.
+    merged = heapq.merge(((row[0], 0, row) for row in existing), ((row[0], 1, row) for row in new))
+    current = None
+    for epoch, _, row in merged:
+        if current is None:
+            current = row
+        elif epoch == current[0]:
+            current = (epoch, current[1] if row[1] is None else row[1], current[2] if row[2] is None else row[2])
+        else:
+            yield current
+            current = row
+    if current is not None:
+        yield current
 
 
-def write_csv(filename: str, data: List[Datapoint]):
-    with open(filename, 'w', newline='\n') as f:
-        f.write(f'{SEP}\n')
-        f.write(f'{HEADER}\n')
+def read_last_row(filename: str, chunk_size: int = 4096) -> Optional[Row]:
+    """Get the last row in a CSV file by only reading the end of the file."""
+    with open(filename, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while True:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            lines = f.read(end - start).decode('utf-8').splitlines()
+            if start > 0:
+                lines = lines[1:]  # Most likely, we started reading in the middle of a line.
+            lines = [line for line in lines if line[:1].isdigit()]  # Skip the header and empty lines
+            if lines or start == 0:
+                break
+            chunk_size *= 2
 
-        for dp in data:
-            time = dp['time'].astimezone(ZRH_TZ).strftime('%d.%m.%Y %H:%M')  # CSV always contains local time.
-            ht = str(dp['ht']) if dp.get('ht') else ''
-            nt = str(dp['nt']) if dp.get('nt') else ''
-            f.write(f'{time};{ht};{nt}\n')
+    # The rows before the last one are needed to tell whether it is in the repeated hour when switching
+    # to winter time. A chunk covers way more than an hour, even for 15 minute data.
+    result = None
+    for result in decode_rows(lines):
+        pass
+    return result
+
+
+def read_present_days(filename: str) -> DayRangeSet:
+    """Get the days for which the CSV file contains any values, without keeping the file in memory."""
+    ranges = []
+    if not os.path.exists(filename):
+        return DayRangeSet(ranges)
+
+    current_range = None
+    prev_day = None
+    with open(filename, 'r', newline='\n') as f:
+        _check_header(f)
+        for line in f:
+            day, ht, nt = line.strip().split(';')
+            day = day[:10]  # Only the date part of dd.mm.yyyy hh:mm
+            if (not ht and not nt) or day == prev_day:
+                continue
+            prev_day = day
+            date = parse_zrh_day(day)
+            if current_range is None:
+                current_range = DayRange(date, date)
+            elif not current_range.append_consecutive(date):
+                ranges.append(current_range)
+                current_range = DayRange(date, date)
+    if current_range is not None:
+        ranges.append(current_range)
+    return DayRangeSet(ranges)
+
+
+def write_csv(filename: str, data: Iterable[Datapoint]):
+    write_rows(filename, (_to_row(dp) for dp in data))
+
+
+def write_rows(filename: str, rows: Iterable[Row]):
+    """Write the complete CSV file.
+
+    The data is written to a temporary file first, which then replaces filename. That way, an interrupted
+    export cannot leave a truncated file behind."""
+    tmp_filename = f'{filename}.tmp'
+    try:
+        with open(tmp_filename, 'w', newline='\n') as f:
+            f.write(f'{SEP}\n')
+            f.write(f'{HEADER}\n')
+            f.writelines(encode_rows(rows))
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+
+
+def append_rows(filename: str, rows: Iterable[Row]):
+    """Append rows to an existing CSV file."""
+    with open(filename, 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        missing_newline = f.read(1) != b'\n'
+    with open(filename, 'a', newline='\n') as f:
+        if missing_newline:
+            f.write('\n')
+        f.writelines(encode_rows(rows))
 
 
 @click.command('csv')
@@ -63,61 +222,49 @@ def cli(session: Session, installation: Installation, data: DataSelection, filen
     """Export data to a CSV file formatted the same as EKZ's CSV export.
 
     If the file already exists, only data for weeks not already present will be retrieved
-    and added to the file."""
-    ranges_with_data = []
-    datapoints = read_csv(filename)
-    current_range = None
-    for dp in datapoints:
-        day = dp['time'].date()
-        if dp['ht'] is not None or dp['nt'] is not None:
-            if current_range is None:
-                current_range = DayRange(day, day)
-            elif not current_range.append_consecutive(day):
-                ranges_with_data.append(current_range)
-                current_range = DayRange(day, day)
-    if current_range is not None:
-        ranges_with_data.append(current_range)
-
-    present_set = DayRangeSet(ranges_with_data)
-    new_datapoints: Dict[int, Datapoint] = collections.defaultdict(dict)
-    for week in itertools.islice(data.requested_ranges.subtract(present_set).get_covering_weeks(), data.limit):
-        d = session.get_consumption_data(installation.id, data.data_type,
-                                         format_api_date(week.start), format_api_date(week.end))
-        for v in d['seriesHt']['values']:
-            if v['status'] == 'VALID':
-                ts = parse_api_timestamp(v['timestamp'])
-                value = float(v['value'])
-                new_datapoints[int(ts.timestamp())]['time'] = ts
-                new_datapoints[int(ts.timestamp())]['ht'] = value
-        for v in d['seriesNt']['values']:
-            if v['status'] == 'VALID':
-                ts = parse_api_timestamp(v['timestamp'])
-                value = float(v['value'])
-                new_datapoints[int(ts.timestamp())]['time'] = ts
-                new_datapoints[int(ts.timestamp())]['nt'] = value
-        click.echo(f'Retrieved: {week.start} - {week.end}', err=True)
-
-    if not new_datapoints:
+    and added to the file. New data after the end of the file is simply appended, the file is
+    only rewritten if missing data from earlier on has to be filled in."""
+    with session.stats.phase('read'):
+        present_set = read_present_days(filename)
+        last = read_last_row(filename) if not present_set.empty else None
+    last_timestamp = last[0] if last is not None else None
+    data.observe_timestamp(last_timestamp)
+
+    new = TimeSeries()
+    missing = data.requested_ranges.subtract(present_set)
+    try:
+        for window, d in data.fetch_consumption_data(data.requested_windows(missing)):
+            # Windows are whole weeks, so they can overlap with what is already in the file. Only keep what is
+            # after the end of the file or on days that are missing in it.
+            with session.stats.phase('parse'):
+                part = TimeSeries.from_consumption_data(d)
+            with session.stats.phase('merge'):
+                new.upsert(part.exclude(present_set, last_timestamp))
+            click.echo(f'Retrieved: {window.start} - {window.end}', err=True)
+    except Exception:
+        # Keep what was retrieved so far, the remaining weeks are still missing in the next run.
+        if new:
+            with session.stats.phase('write'):
+                _add_to_file(filename, new, last_timestamp)
+            data.points_written += new.count()
+        raise
+
+    if not new:
         click.echo('No new valid datapoints found', err=True)
         return
 
-    # The new points have to be merged back with the existing ones in sequence
-    result = []
-    new: List[Datapoint] = sorted(new_datapoints.values(), key=lambda x: x['time'].timestamp())
-    i = 0
-    for dp in datapoints:
-        if i >= len(new) or dp['time'].timestamp() < new[i]['time'].timestamp():
-            result.append(dp)  # Keep old datapoint since it's older or we don't have any new ones anymore
-        elif dp['time'].timestamp() == new[i]['time'].timestamp():
-            result.append(new[i])  # Overwrite old datapoint with fresh values
-            i += 1
-        else:
-            while i < len(new) and dp['time'].timestamp() > new[i]['time'].timestamp():
-                result.append(new[i])  # New datapoint is before the existing one
-                i += 1
-    # We could still have unconsumed new datapoints
-    while i < len(new):
-        result.append(new[i])
-        i += 1
-
-    write_csv(filename, result)
+    with session.stats.phase('write'):
+        _add_to_file(filename, new, last_timestamp)
+    data.points_written += new.count()
+
+
+def _add_to_file(filename: str, new: TimeSeries, last_timestamp: Optional[int]):
+    if last_timestamp is not None and new.epochs[0] > last_timestamp:
+        # All new data is after the existing, so there is no need to rewrite the file.
+        append_rows(filename, new.rows())
+        return
+
+    # The new points have to be merged back with the existing ones in sequence. Fresh values replace old ones.
+    # Rows are streamed from the old file through the merge into the new one, so memory use does not depend on
+    # the size of the file. The old file is closed once it has been read completely, before it gets replaced.
+    write_rows(filename, merge_rows(iter_rows(filename), new.rows()))
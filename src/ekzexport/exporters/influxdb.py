@@ -1,18 +1,78 @@
 import click
 import datetime
-import itertools
+from typing import Iterator
 
 from ..session import Session
-from ..timeutil import format_api_date, parse_api_timestamp
+from ..timeseries import VALUE_INTERVALS, TimeSeries, values_per_day
+from ..timeutil import format_api_date, epoch_to_zrh_date, zrh_day_start
 from ..util import pass_session, pass_data, pass_installation, Installation, DataSelection, DayRange, DayRangeSet
 
 try:
-    from influxdb_client import InfluxDBClient, Point
+    from influxdb_client import InfluxDBClient, WritePrecision, WriteOptions
     _HAVE_INFLUXDB = True
 except ImportError:
     _HAVE_INFLUXDB = False
 
 
+_ESCAPE_MEASUREMENT = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+_ESCAPE_KEY = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+
+
+def _format_float(value: float) -> str:
+    s = repr(value)
+    return s[:-2] if s.endswith('.0') else s
+
+
+def line_protocol(measurement: str, field: str, series: TimeSeries) -> Iterator[str]:
+    """Format the values of series as InfluxDB line protocol with second precision.
+
+    The points are the same as Point(measurement).time(ts).field(field, value).field('niedertarif', ...) would
+    produce, but without creating an object per value."""
+    prefix = f'{measurement.translate(_ESCAPE_MEASUREMENT)} {field.translate(_ESCAPE_KEY)}='
+    for epoch, ht, nt in series.rows():
+        if ht is not None:
+            yield f'{prefix}{_format_float(ht)},niedertarif=false {epoch}'
+        if nt is not None:
+            yield f'{prefix}{_format_float(nt)},niedertarif=true {epoch}'
+
+
+def _flux_time(epoch: int) -> str:
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def read_complete_days(query_api, bucket: str, measurement: str, field: str, data_type: str,
+                       ranges: DayRangeSet) -> DayRangeSet:
+    """Get the days within ranges for which InfluxDB already has all values.
+
+    Points are counted per day in Zurich by InfluxDB, so only one row per day has to be transferred."""
+    if ranges.empty:
+        return DayRangeSet([])
+    tables = query_api.query(
+        'import "timezone"\n'
+        f'from(bucket:"{bucket}") '
+        f'|> range(start: {_flux_time(zrh_day_start(ranges.start))}, '
+        f'stop: {_flux_time(zrh_day_start(ranges.end + datetime.timedelta(days=1)))}) '
+        f'|> filter(fn: (r) => r["_measurement"] == "{measurement}" and r["_field"] == "{field}")'
+        '|> aggregateWindow(every: 1d, fn: count, timeSrc: "_start", createEmpty: false, '
+        'location: timezone.location(name: "Europe/Zurich"))')
+
+    counts = {}
+    for table in tables:
+        for record in table.records:
+            day = epoch_to_zrh_date(int(record.get_time().timestamp()))
+            counts[day] = counts.get(day, 0) + record.get_value()
+
+    result = []
+    current = None
+    for day in sorted(counts):
+        if counts[day] < values_per_day(data_type, day):
+            continue
+        if current is None or not current.append_consecutive(day):
+            current = DayRange(day, day)
+            result.append(current)
+    return DayRangeSet(result)
+
+
 @click.command('influxdb')
 @click.option('-c', '--config', type=str)
 @click.option('-u', '--url', type=str)
@@ -21,12 +81,17 @@ except ImportError:
 @click.option('-b', '--bucket', type=str, required=True)
 @click.option('-m', '--measurement', type=str, default='ekz_energy')
 @click.option('-f', '--field', type=str, default='energy_15min')
+@click.option('--batch-size', type=click.IntRange(min=1), default=5000, show_default=True,
+              help='Number of points to send to InfluxDB per request.')
+@click.option('--flush-interval', type=click.IntRange(min=1), default=1000, show_default=True, metavar='MS',
+              help='Send incomplete batches after this many milliseconds.')
+@click.option('--gzip/--no-gzip', default=False, help='Compress requests to InfluxDB.')
 @pass_data
 @pass_installation
 @pass_session
 def cli(session: Session, installation: Installation, data: DataSelection,
         config: str, url: str, token: str, org: str, bucket: str,
-        measurement: str, field: str):
+        measurement: str, field: str, batch_size: int, flush_interval: int, gzip: bool):
     """Export to InfluxDB.
 
     You can configure the InfluxDB client either via config file by passing --config=filename.ini,
@@ -34,7 +99,9 @@ def cli(session: Session, installation: Installation, data: DataSelection,
 
     --measurement and --field can be used to control the measurement and field name of the inserted points.
 
-    Only data after the latest existing measurement will be exported. If none is found, the complete range is exported.
+    Points of all weeks are written through one batching writer, see --batch-size, --flush-interval and --gzip.
+
+    Only weeks with days that do not have all values in InfluxDB yet are exported, so gaps are filled in as well.
     """
     if not _HAVE_INFLUXDB:
         raise click.UsageError('InfluxDB client is not installed. Run "pip install influxdb-client" to get it.')
@@ -42,51 +109,48 @@ def cli(session: Session, installation: Installation, data: DataSelection,
     try:
         if config:
             if config == 'ENV':
-                client = InfluxDBClient.from_env_properties()
+                client = InfluxDBClient.from_env_properties(enable_gzip=gzip)
             else:
-                client = InfluxDBClient.from_config_file(config)
+                client = InfluxDBClient.from_config_file(config, enable_gzip=gzip)
         else:
             if not url:
                 raise click.UsageError('--url cannot be emtpy if --config is not used')
             if not token:
                 raise click.UsageError('--token cannot be emtpy if --config is not used')
-            client = InfluxDBClient(url=url, token=token, org=org)
+            client = InfluxDBClient(url=url, token=token, org=org, enable_gzip=gzip)
     except Exception as e:
         if isinstance(e, click.ClickException):
             raise
         raise click.BadOptionUsage('config', 'Supplied options insufficient for connecting to InfluxDB')
 
-    query_api = client.query_api()
-    latest_table = query_api.query(
-        f'from(bucket:"{bucket}") |> range(start: 0, stop: now()) '
-        f'|> filter(fn: (r) => r["_measurement"] == "{measurement}" and r["_field"] == "{field}")'
-        '|> tail(n: 1)')
-
-    requested_range = data.requested_ranges
-    if latest_table and latest_table[0].records:
-        latest_time: datetime.datetime = latest_table[0].records[0].values['_time']
-        click.echo(f'Already got data until: {format_api_date(latest_time)}', err=True)
-        requested_range = requested_range.intersect(DayRangeSet([
-            DayRange(latest_time.date(), datetime.date.today())]))
-
+    with session.stats.phase('read'):
+        complete = read_complete_days(client.query_api(), bucket, measurement, field, data.data_type,
+                                      data.requested_ranges)
+    if not complete.empty:
+        # Values are only counted per day, so take the last value of the latest complete day as the newest one.
+        interval = VALUE_INTERVALS.get(data.data_type)
+        data.observe_timestamp(zrh_day_start(complete.end + datetime.timedelta(days=1)) - interval if interval
+                               else zrh_day_start(complete.end))
+    requested_range = data.requested_ranges.subtract(complete)
     if requested_range.empty:
-        click.echo(f'Requested data until {format_api_date(data.requested_ranges.end)} leaves nothing to get', err=True)
+        click.echo(f'All requested data until {format_api_date(data.requested_ranges.end)} is already present',
+                   err=True)
         return
 
-    for week in itertools.islice(requested_range.get_covering_weeks(), data.limit):
-        d = session.get_consumption_data(installation.id, data.data_type,
-                                         format_api_date(week.start), format_api_date(week.end))
-        with client.write_api() as writer:
-            for v in d['seriesHt']['values']:
-                if v['status'] == 'VALID':
-                    ts = parse_api_timestamp(v['timestamp'])
-                    value = float(v['value'])
-                    writer.write(bucket, org,
-                                 Point(measurement).time(ts).field(field, value).field('niedertarif', False))
-            for v in d['seriesNt']['values']:
-                if v['status'] == 'VALID':
-                    ts = parse_api_timestamp(v['timestamp'])
-                    value = float(v['value'])
-                    writer.write(bucket, org,
-                                 Point(measurement).time(ts).field(field, value).field('niedertarif', True))
-        click.echo(f'Retrieved: {week.start} - {week.end}', err=True)
+    # The writer sends batches in the background, so failures can only be reported once it is closed.
+    errors = []
+    write_options = WriteOptions(batch_size=batch_size, flush_interval=flush_interval)
+    with client.write_api(write_options=write_options,
+                          error_callback=lambda conf, lines, e: errors.append(e)) as writer:
+        for window, d in data.fetch_consumption_data(data.requested_windows(requested_range)):
+            with session.stats.phase('parse'):
+                series = TimeSeries.from_consumption_data(d)
+            with session.stats.phase('merge'):
+                series = series.exclude(complete)
+            with session.stats.phase('write'):
+                lines = list(line_protocol(measurement, field, series))
+                writer.write(bucket, org, lines, write_precision=WritePrecision.S)
+            data.points_written += len(lines)
+            click.echo(f'Retrieved: {window.start} - {window.end}', err=True)
+    if errors:
+        raise click.ClickException(f'Writing {len(errors)} batches to InfluxDB failed: {errors[0]}')
@@ -0,0 +1,187 @@
+import datetime
+import glob
+import json
+import os
+import os.path
+
+import click
+from array import array
+from typing import List, Iterator, Optional, Tuple, TypedDict
+
+from ..session import Session
+from ..timeseries import TimeSeries
+from ..timeutil import epoch_to_zrh_date, zrh_day_start, format_api_date
+from ..util import pass_installation, pass_data, pass_session, Installation, DataSelection, DayRange, DayRangeSet
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    _HAVE_PYARROW = True
+except ImportError:
+    _HAVE_PYARROW = False
+
+FILE_NAME = 'data.parquet'
+# Days with values in a partition, stored in the file's key-value metadata as a list of [start, end] dates.
+PRESENT_DAYS_KEY = b'ekzexport.present_days'
+_UNITS_PER_SECOND = {'s': 1, 'ms': 1000, 'us': 1000000, 'ns': 1000000000}
+
+
+class PartitionInfo(TypedDict):
+    path: str
+    rows: int
+    min_time: Optional[int]  # UNIX timestamps
+    max_time: Optional[int]
+    present_days: DayRangeSet
+
+
+def partition_path(directory: str, year: int, month: int) -> str:
+    """Where data for a month in Zurich is stored, using Hive-style partitioning."""
+    return os.path.join(directory, f'year={year:04d}', f'month={month:02d}', FILE_NAME)
+
+
+def list_partitions(directory: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(glob.escape(directory), 'year=*', 'month=*', FILE_NAME)))
+
+
+def split_months(series: TimeSeries) -> Iterator[Tuple[int, int, TimeSeries]]:
+    """Split series into (year, month, part) by months in Zurich."""
+    if not series:
+        return
+    day = epoch_to_zrh_date(series.epochs[0])
+    month = datetime.date(day.year, day.month, 1)
+    while True:
+        next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+        part = series.between(zrh_day_start(month), zrh_day_start(next_month))
+        if part:
+            yield month.year, month.month, part
+        if zrh_day_start(next_month) > series.epochs[-1]:
+            break
+        month = next_month
+
+
+def _to_array(typecode: str, values) -> array:
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    result = array(typecode)
+    view = memoryview(values.buffers()[1])
+    result.frombytes(view[values.offset * result.itemsize:(values.offset + len(values)) * result.itemsize])
+    return result
+
+
+def read_partition(path: str) -> TimeSeries:
+    table = pq.read_table(path, columns=['time', 'ht', 'nt'])
+    result = TimeSeries()
+    result.epochs = _to_array('q', table.column('time').cast(pa.timestamp('s', tz='UTC')).cast(pa.int64()))
+    result.ht = _to_array('d', pc.fill_null(table.column('ht'), float('nan')))
+    result.nt = _to_array('d', pc.fill_null(table.column('nt'), float('nan')))
+    return result
+
+
+def read_partition_info(path: str) -> PartitionInfo:
+    """Describe a partition using only its Parquet footer if possible.
+
+    Row count and min/max timestamps come from the column statistics, the days with values from the metadata written
+    by write_partition. Only files written by other tools have to be read completely."""
+    metadata = pq.read_metadata(path)
+    # Parquet has no unit for seconds, so the timestamps are stored with a finer one.
+    per_second = _UNITS_PER_SECOND.get(metadata.schema.to_arrow_schema().field('time').type.unit, 1)
+    min_time, max_time = None, None
+    for i in range(metadata.num_row_groups):
+        statistics = metadata.row_group(i).column(0).statistics
+        if statistics is None or not statistics.has_min_max:
+            min_time = max_time = None
+            break
+        low, high = statistics.min_raw // per_second, statistics.max_raw // per_second
+        min_time = low if min_time is None else min(min_time, low)
+        max_time = high if max_time is None else max(max_time, high)
+
+    present_days = None
+    try:
+        present_days = DayRangeSet([
+            DayRange(datetime.date.fromisoformat(start), datetime.date.fromisoformat(end))
+            for start, end in json.loads((metadata.metadata or {})[PRESENT_DAYS_KEY])])
+    except (KeyError, ValueError, TypeError):
+        pass
+
+    if present_days is None or (metadata.num_rows and max_time is None):
+        series = read_partition(path)
+        present_days = series.days()
+        min_time, max_time = (series.epochs[0], series.epochs[-1]) if series else (None, None)
+    return {'path': path, 'rows': metadata.num_rows, 'min_time': min_time, 'max_time': max_time,
+            'present_days': present_days}
+
+
+def write_partition(path: str, series: TimeSeries, compression: str = 'zstd'):
+    """Write a complete partition, replacing the file atomically."""
+    present_days = [[format_api_date(r.start), format_api_date(r.end)] for r in series.days().ranges]
+    epochs = pa.Array.from_buffers(pa.int64(), len(series), [None, pa.py_buffer(series.epochs)])
+    table = pa.table({
+        'time': epochs.cast(pa.timestamp('s', tz='UTC')),
+        # from_pandas turns NaN into nulls
+        'ht': pa.array(series.ht, type=pa.float64(), from_pandas=True),
+        'nt': pa.array(series.nt, type=pa.float64(), from_pandas=True),
+    }).replace_schema_metadata({PRESENT_DAYS_KEY: json.dumps(present_days)})
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    try:
+        pq.write_table(table, tmp_path, compression=compression)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+@click.command('parquet')
+@click.option('-d', '--directory', type=str, required=True, help='Directory of the partitioned dataset.')
+@click.option('--compression', type=click.Choice(['zstd', 'snappy', 'gzip', 'brotli', 'lz4', 'none']),
+              default='zstd', show_default=True)
+@pass_data
+@pass_installation
+@pass_session
+def cli(session: Session, installation: Installation, data: DataSelection, directory: str, compression: str):
+    """Export data to Parquet files partitioned by year and month.
+
+    Each month is stored in DIRECTORY/year=YYYY/month=MM/data.parquet with a UTC time column and HT and NT
+    columns. Which days are already present is determined from the partitions' metadata, so only missing weeks
+    are retrieved. Only the partitions receiving new data are rewritten."""
+    if not _HAVE_PYARROW:
+        raise click.UsageError('pyarrow is not installed. Run "pip install pyarrow" to get it.')
+
+    with session.stats.phase('read'):
+        partitions = [read_partition_info(path) for path in list_partitions(directory)]
+    present_set = DayRangeSet([r for p in partitions for r in p['present_days'].ranges])
+    last_timestamp = max((p['max_time'] for p in partitions if p['max_time'] is not None), default=None)
+    data.observe_timestamp(last_timestamp)
+
+    new = TimeSeries()
+    missing = data.requested_ranges.subtract(present_set)
+    try:
+        for window, d in data.fetch_consumption_data(data.requested_windows(missing)):
+            with session.stats.phase('parse'):
+                part = TimeSeries.from_consumption_data(d)
+            with session.stats.phase('merge'):
+                new.upsert(part.exclude(present_set, last_timestamp))
+            click.echo(f'Retrieved: {window.start} - {window.end}', err=True)
+    except Exception:
+        # Keep what was retrieved so far, the remaining weeks are still missing in the next run.
+        with session.stats.phase('write'):
+            _add_to_partitions(directory, new, compression, data)
+        raise
+
+    if not new:
+        click.echo('No new valid datapoints found', err=True)
+        return
+    with session.stats.phase('write'):
+        _add_to_partitions(directory, new, compression, data)
+
+
+def _add_to_partitions(directory: str, new: TimeSeries, compression: str, data: DataSelection):
+    for year, month, part in split_months(new):
+        path = partition_path(directory, year, month)
+        series = read_partition(path) if os.path.exists(path) else TimeSeries()
+        series.upsert(part)
+        write_partition(path, series, None if compression == 'none' else compression)
+        data.points_written += part.count()
+        click.echo(f'Wrote {len(part)} datapoints to {path}', err=True)
@@ -0,0 +1,113 @@
+import sqlite3
+
+import click
+from typing import Iterator, Optional, Tuple
+
+from ..session import Session
+from ..timeseries import TimeSeries
+from ..timeutil import epoch_day_to_date, zrh_offset_span
+from ..util import pass_installation, pass_data, pass_session, Installation, DataSelection, DayRange, DayRangeSet
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS consumption (
+        installation TEXT NOT NULL,
+        data_type TEXT NOT NULL,
+        epoch INTEGER NOT NULL,  -- UNIX timestamp
+        tariff TEXT NOT NULL,  -- HT or NT
+        day INTEGER NOT NULL,  -- Day in Zurich as days since 1970-01-01
+        value REAL NOT NULL,
+        PRIMARY KEY (installation, data_type, epoch, tariff)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS consumption_day ON consumption (installation, data_type, day);
+'''
+
+UPSERT = '''
+    INSERT INTO consumption (installation, data_type, epoch, tariff, day, value) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (installation, data_type, epoch, tariff) DO UPDATE SET value = excluded.value
+'''
+
+# Consecutive days form islands with a constant difference between the day and its rank.
+PRESENT_DAYS = '''
+    SELECT MIN(day), MAX(day) FROM (
+        SELECT day, day - ROW_NUMBER() OVER (ORDER BY day) AS island FROM (
+            SELECT DISTINCT day FROM consumption WHERE installation = ? AND data_type = ?
+        )
+    ) GROUP BY island ORDER BY 1
+'''
+
+Record = Tuple[str, str, int, str, int, float]
+
+
+def connect(filename: str) -> sqlite3.Connection:
+    db = sqlite3.connect(filename, isolation_level=None)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.executescript(SCHEMA)
+    return db
+
+
+def read_present_days(db: sqlite3.Connection, installation_id: str, data_type: str) -> DayRangeSet:
+    """Get the days for which the database contains any values, computed by SQLite using the day index."""
+    return DayRangeSet([
+        DayRange(epoch_day_to_date(start), epoch_day_to_date(end))
+        for start, end in db.execute(PRESENT_DAYS, (installation_id, data_type))])
+
+
+def read_last_timestamp(db: sqlite3.Connection, installation_id: str, data_type: str) -> Optional[int]:
+    return db.execute('SELECT MAX(epoch) FROM consumption WHERE installation = ? AND data_type = ?',
+                      (installation_id, data_type)).fetchone()[0]
+
+
+def records(installation_id: str, data_type: str, series: TimeSeries) -> Iterator[Record]:
+    offset, offset_start, offset_end = 0, 0, 0
+    for epoch, ht, nt in series.rows():
+        if not offset_start <= epoch < offset_end:
+            offset, offset_start, offset_end = zrh_offset_span(epoch)
+        day = (epoch + offset) // 86400
+        if ht is not None:
+            yield installation_id, data_type, epoch, 'HT', day, ht
+        if nt is not None:
+            yield installation_id, data_type, epoch, 'NT', day, nt
+
+
+@click.command('sqlite')
+@click.option('-f', '--file', 'filename', type=str, required=True)
+@pass_data
+@pass_installation
+@pass_session
+def cli(session: Session, installation: Installation, data: DataSelection, filename: str):
+    """Export data to a SQLite database.
+
+    Values are stored in the consumption table, one row per installation, data type, UNIX timestamp and tariff.
+    Only weeks with days missing in the database are retrieved. The values of each window are written in a
+    transaction of their own, so an interrupted export keeps the windows retrieved so far."""
+    db = connect(filename)
+    try:
+        with session.stats.phase('read'):
+            present_set = read_present_days(db, installation.id, data.data_type)
+            last_timestamp = read_last_timestamp(db, installation.id, data.data_type)
+        data.observe_timestamp(last_timestamp)
+
+        written = 0
+        missing = data.requested_ranges.subtract(present_set)
+        for window, d in data.fetch_consumption_data(data.requested_windows(missing)):
+            with session.stats.phase('parse'):
+                part = TimeSeries.from_consumption_data(d)
+            with session.stats.phase('merge'):
+                part = part.exclude(present_set, last_timestamp)
+            with session.stats.phase('write'):
+                db.execute('BEGIN')
+                cursor = db.executemany(UPSERT, records(installation.id, data.data_type, part))
+                db.execute('COMMIT')
+            written += cursor.rowcount
+            data.points_written += cursor.rowcount
+            click.echo(f'Retrieved: {window.start} - {window.end}', err=True)
+    except BaseException:
+        if db.in_transaction:
+            db.execute('ROLLBACK')
+        raise
+    finally:
+        db.close()
+
+    if not written:
+        click.echo('No new valid datapoints found', err=True)
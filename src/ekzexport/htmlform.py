@@ -0,0 +1,38 @@
+"""Finding forms in the pages of the myEKZ login without building a document tree."""
+from html.parser import HTMLParser
+from typing import Collection, Dict, Optional
+
+FormAttributes = Dict[str, Optional[str]]
+
+
+class _Found(Exception):
+    pass
+
+
+class _FormFinder(HTMLParser):
+    def __init__(self, ids: Optional[Collection[str]]):
+        super().__init__()
+        self.ids = ids
+        self.form: Optional[FormAttributes] = None
+
+    def handle_starttag(self, tag: str, attrs):
+        if tag != 'form':
+            return
+        attributes = dict(attrs)
+        if self.ids is None or attributes.get('id') in self.ids:
+            self.form = attributes
+            raise _Found()  # Nothing after the form is of interest, so stop parsing right away.
+
+
+def find_form(html: str, ids: Optional[Collection[str]] = None) -> Optional[FormAttributes]:
+    """The attributes of the first form in html with one of the given ids, or of the first form at all if ids is
+    None. Returns None if there is no such form.
+
+    Attribute values have character references resolved, e.g. &amp; in the action URL becomes &."""
+    finder = _FormFinder(ids)
+    try:
+        finder.feed(html)
+        finder.close()
+    except _Found:
+        pass
+    return finder.form
@@ -0,0 +1,188 @@
+"""Metrics of export runs in the Prometheus text format, written to a file for node-exporter's textfile collector or
+served over HTTP."""
+import bisect
+import math
+import os
+import os.path
+import threading
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LOGIN_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _labels(self, values: LabelValues, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = tuple(zip(self.labels, values)) + extra
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        with self._lock:
+            samples = self._samples()
+        return ''.join([f'# HELP {self.name} {self.documentation}\n', f'# TYPE {self.name} {self.kind}\n'] +
+                       [sample + '\n' for sample in samples])
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def _samples(self) -> List[str]:
+        return [f'{self.name}{self._labels(k)} {_format_value(v)}' for k, v in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, *labels: str, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = REQUEST_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}  # -> (counts per bucket, [sum])
+
+    def observe(self, *labels: str, value: float):
+        with self._lock:
+            counts, total = self._values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def count(self, *labels: str) -> int:
+        return sum(self._values.get(labels, ([0], [0.0]))[0])
+
+    def _samples(self) -> List[str]:
+        samples = []
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(f'{self.name}_bucket{self._labels(labels, (("le", _format_value(bound)),))} '
+                               f'{cumulative}')
+            samples.append(f'{self.name}_sum{self._labels(labels)} {_format_value(total[0])}')
+            samples.append(f'{self.name}_count{self._labels(labels)} {cumulative}')
+        return samples
+
+
+class ExportMetrics:
+    """The metrics recorded by Session and the export commands.
+
+    If textfile is set, save() writes them there atomically, so node-exporter never sees a partial file."""
+    def __init__(self, textfile: Optional[str] = None):
+        self.textfile = textfile
+        self.request_duration = Histogram('ekzexport_request_duration_seconds',
+                                          'Duration of myEKZ API calls, including retries.', ['endpoint'])
+        self.request_errors = Counter('ekzexport_request_errors_total',
+                                      'myEKZ API calls that failed, by HTTP status or exception.',
+                                      ['endpoint', 'reason'])
+        self.login_duration = Histogram('ekzexport_login_duration_seconds', 'Duration of logins to myEKZ.',
+                                        buckets=LOGIN_BUCKETS)
+        self.exports = Counter('ekzexport_exports_total', 'Export runs.', ['installation', 'sink'])
+        self.export_errors = Counter('ekzexport_export_errors_total', 'Export runs that failed.',
+                                     ['installation', 'sink'])
+        self.last_success = Gauge('ekzexport_last_success_timestamp_seconds',
+                                  'When an export last finished successfully.', ['installation', 'sink'])
+        self.weeks_fetched = Counter('ekzexport_weeks_fetched_total', 'Weeks of data retrieved from myEKZ.',
+                                     ['installation', 'data_type'])
+        self.points_written = Counter('ekzexport_points_written_total', 'Values written to sinks.',
+                                      ['installation', 'sink'])
+        self.latest_data = Gauge('ekzexport_latest_data_timestamp_seconds',
+                                 'Latest timestamp of data received from myEKZ.', ['installation', 'data_type'])
+
+    def all(self) -> List[_Metric]:
+        return [m for m in vars(self).values() if isinstance(m, _Metric)]
+
+    def render(self) -> str:
+        return ''.join(m.render() for m in self.all())
+
+    def save(self):
+        if self.textfile is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.textfile))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{self.textfile}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            os.replace(tmp_path, self.textfile)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+class MetricsServer:
+    """Serves metrics on http://host:port/metrics from a background thread. Use as a context manager."""
+    def __init__(self, metrics: ExportMetrics, host: str = '127.0.0.1', port: int = 9180):
+        # Only imported here, since the session records metrics without needing a server.
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.url = f'http://{host}:{self._server.server_port}/metrics'
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
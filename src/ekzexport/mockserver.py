@@ -0,0 +1,471 @@
+"""A local stand-in for myEKZ, for testing and benchmarking without touching the real portal.
+
+It implements the parts of the Keycloak login that Session goes through, including the OTP and mobile number
+prompts, the CSRF token and logout as well as the consumption-view and leg-manager-dashboard endpoints. The
+consumption data is synthetic but deterministic, so the same request always gets the same values. Latency, errors
+and throttling of API calls can be simulated.
+
+Run it with python -m ekzexport.mockserver and point ekzexport at it with --base-url."""
+import datetime
+import html
+import json
+import math
+import random
+import secrets
+import threading
+import time
+
+import click
+import pyotp
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from .apitypes import ConsumptionData, InstallationData, InstallationSelectionData, LegDetails, LegHeader, Series
+from .timeutil import civil_from_days, epoch_to_zrh_local, format_api_date, parse_zrh_day, zrh_day_start
+
+REALM = '/auth/realms/myEKZ'
+CLIENT_ID = 'cos-myekz-webapp'
+SESSION_COOKIE = 'MOCKEKZ_SESSION'
+LEG_ID = '0' * 24 + 'mock-leg'
+
+_PAGE = '<!DOCTYPE html><html><head><title>{title}</title></head><body>{body}</body></html>'
+_LOGIN_FORM = '''<form id="kc-form-login" action="{action}" method="post">
+<input id="username" name="username" type="text"><input id="password" name="password" type="password">
+<input type="submit" name="login" value="Anmelden"></form>'''
+_OTP_FORM = '''<form id="kc-otp-login-form" action="{action}" method="post">
+<input id="otp" name="otp" type="text" autocomplete="off"><input type="submit" value="Anmelden"></form>'''
+_MOBILE_FORM = '''<form action="{action}" method="post">
+<input id="mobile_number" name="mobile_number" type="tel"><input type="submit" name="submit" value="Speichern">
+<input type="submit" name="cancel" value="Sp&auml;ter einrichten"></form>'''
+
+
+def installation_ids(count: int) -> List[str]:
+    return [f'{1000000001 + i}' for i in range(count)]
+
+
+def _value(installation_id: str, epoch: int, local: int, interval: int) -> float:
+    """A plausible consumption in kWh, derived only from the arguments."""
+    x = (epoch // 900 * 2654435761 + int(installation_id) * 40503) & 0xffffffff
+    hour = local // 3600 % 24
+    base = 0.25 if 7 <= hour < 22 else 0.08
+    return round((base + (x % 1000) / 10000) * interval / 900, 3)
+
+
+def _is_ht(local: int) -> bool:
+    """High tariff applies on weekdays from 7:00 to 20:00, 1970-01-01 was a Thursday."""
+    return (local // 86400 + 3) % 7 < 5 and 7 <= local // 3600 % 24 < 20
+
+
+def synthetic_consumption_data(installation_id: str, data_type: str, first: datetime.date, last: datetime.date,
+                               available: Tuple[datetime.date, datetime.date]) -> ConsumptionData:
+    """Values for the days from first to last, restricted to the available days."""
+    interval = 900 if data_type == 'PK_VERB_15MIN' else 86400
+    series: Dict[str, Series] = {}
+    for tariff in ('HT', 'NT'):
+        series[tariff] = {'level': 'V', 'energyType': None, 'sourceType': None, 'tariffType': tariff,
+                          'ab': format_api_date(first), 'bis': format_api_date(last), 'values': []}
+
+    first_day, last_day = max(first, available[0]), min(last, available[1])
+    if interval == 86400:
+        days = (last_day - first_day).days + 1
+        epochs = [zrh_day_start(first_day + datetime.timedelta(days=i)) for i in range(days)]
+    else:
+        epochs = range(zrh_day_start(first_day), zrh_day_start(last_day + datetime.timedelta(days=1)), interval)
+    for epoch in epochs:
+        local = epoch_to_zrh_local(epoch)
+        tariffs = ('HT', 'NT') if interval == 86400 else ('HT',) if _is_ht(local) else ('NT',)
+        year, month, day = civil_from_days(local // 86400)
+        utc_year, utc_month, utc_day = civil_from_days(epoch // 86400)
+        timestamp = ((utc_year * 100 + utc_month) * 100 + utc_day) * 1000000 + epoch // 3600 % 24 * 10000 + \
+            epoch // 60 % 60 * 100
+        for tariff in tariffs:
+            value = _value(installation_id, epoch, local, interval) / (2 if len(tariffs) == 2 else 1)
+            series[tariff]['values'].append({
+                'value': round(value, 3),
+                'timestamp': timestamp,
+                'date': f'{day:02d}.{month:02d}.{year:04d}',
+                'time': f'{local // 3600 % 24:02d}:{local // 60 % 60:02d}',
+                'status': 'VALID',
+            })
+    return {'series': None, 'seriesHt': series['HT'], 'seriesNetz': None, 'seriesNetzHt': None,
+            'seriesNt': series['NT']}
+
+
+class MockServer:
+    """Serves the mock portal from a background thread, use it as a context manager. base_url points to it.
+
+    Only username and password are accepted. If otp_secret is set, a TOTP code is asked for after the password,
+    with ask_mobile_number myEKZ's prompt to configure a mobile number is shown instead. Logins expire after
+    session_lifetime seconds.
+
+    API calls take latency seconds, fail with a 503 with probability error_rate and get a 429 with Retry-After once
+    they exceed rate requests per second (with bursts of burst requests). Data is available from start to end, which
+    defaults to yesterday. The number of requests of each kind is counted in requests."""
+    def __init__(self, username: str = 'user', password: str = 'password', otp_secret: str = '',
+                 ask_mobile_number: bool = False, installations: int = 1,
+                 start: datetime.date = datetime.date(2020, 1, 1), end: Optional[datetime.date] = None,
+                 latency: float = 0.0, error_rate: float = 0.0, rate: Optional[float] = None, burst: int = 1,
+                 session_lifetime: Optional[float] = None, seed: int = 0, host: str = '127.0.0.1', port: int = 0):
+        self.username = username
+        self.password = password
+        self.otp_secret = otp_secret
+        self.ask_mobile_number = ask_mobile_number
+        self.installations = installation_ids(installations)
+        self.start = start
+        self.end = end or datetime.date.today() - datetime.timedelta(days=1)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.session_lifetime = session_lifetime
+        self.requests = Counter()
+
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._pending: Dict[str, str] = {}  # session_code -> step of a login in progress
+        self._sessions: Dict[str, Tuple[float, str]] = {}  # session cookie -> (expiry, CSRF token)
+
+        handler = type('Handler', (_Handler,), {'mock': self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self.base_url = f'http://{host}:{self._server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self):
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def count(self, kind: str):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def throttle_delay(self) -> float:
+        """Take a token from the bucket, returning 0 on success or how long to wait for the next one."""
+        if self.rate is None:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def fail_randomly(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def start_login(self, step: str) -> str:
+        code = secrets.token_urlsafe(16)
+        with self._lock:
+            self._pending[code] = step
+        return code
+
+    def finish_login_step(self, code: str) -> Optional[str]:
+        with self._lock:
+            return self._pending.pop(code, None)
+
+    def create_session(self) -> str:
+        session = secrets.token_urlsafe(24)
+        expiry = time.monotonic() + self.session_lifetime if self.session_lifetime is not None else math.inf
+        with self._lock:
+            self._sessions[session] = (expiry, secrets.token_hex(16))
+        return session
+
+    def csrf_token(self, session: Optional[str]) -> Optional[str]:
+        """The CSRF token of a session that is logged in, None otherwise."""
+        with self._lock:
+            expiry, token = self._sessions.get(session, (0, None))
+            if expiry < time.monotonic():
+                self._sessions.pop(session, None)
+                return None
+            return token
+
+    def end_session(self, session: str):
+        with self._lock:
+            self._sessions.pop(session, None)
+
+    def installation_selection_data(self) -> InstallationSelectionData:
+        contracts, eanl = [], []
+        for i, anlage in enumerate(self.installations):
+            contracts.append({'gpart': 'mock-gpart', 'vkonto': f'{200000000 + i}', 'vertrag': f'{300000000 + i}',
+                              'anlage': anlage, 'vstelle': f'{400000000 + i}', 'haus': f'{500000000 + i}',
+                              'einzdat': format_api_date(self.start), 'auszdat': None, 'sparte': '10'})
+            eanl.append({'anlage': anlage, 'sparte': '10', 'vstelle': f'{400000000 + i}', 'anlart': '1000',
+                         'spebene': '7', 'zzenergietraeger': None, 'zzevgstat': None, 'zzevganlage': None,
+                         'eanlhTariftyp': 'DT', 'eanlhAbleinh': 'ZH'})
+        return {'contracts': contracts, 'eanl': eanl, 'evbs': [], 'fkkvkp': [], 'commonData': None}
+
+    def installation_data(self) -> InstallationData:
+        return {'status': [{'property': prop, 'ab': format_api_date(self.start), 'bis': format_api_date(self.end)}
+                           for prop in ('VERB_15MIN', 'VERB_TAG_EDM')]}
+
+    def leg_header(self) -> LegHeader:
+        return {'legId': LEG_ID, 'descriptiveId': '000001', 'description': 'Mock LEG',
+                'manager': {'managerId': 'mock-gpart', 'managerName': 'Mock Manager', 'secondManagerName': '',
+                            'secondManagerEmail': '', 'SecondManagerPhone': ''},
+                'zone': {'zoneId': None, 'name': None, 'gemeindeName': None, 'unterwerk': None, 'uwName': None,
+                         'uwGemeinde': None},
+                'gridLevel': '7', 'expectedActivationDate': format_api_date(self.start),
+                'expectedInactivationDate': None, 'expectedDissolutionDate': None,
+                'legStatus': [{'statusId': 'AKTIV', 'statusDate': format_api_date(self.start)}]}
+
+    def leg_details(self) -> LegDetails:
+        points, statuses = [], []
+        for i, anlage in enumerate(self.installations):
+            point_id = f'CH{i + 1:031d}'
+            points.append({
+                'meteringPointId': point_id, 'businessPartnerId': 'mock-gpart',
+                'specifications': {'zoneId': '1', 'modulePower': 10.0 * (i % 2), 'connectionPower': 25.0,
+                                   'trafostation': 'T1', 'gridLevel': '7', 'producer': i % 2 == 1,
+                                   'smartMeter': True, 'validRateCategory': True, 'legId': LEG_ID},
+                'ort': {'vstelle': f'{400000000 + i}', 'anlage': anlage, 'anlageart': '1000',
+                        'locationStreet': 'Mockstrasse', 'locationHousenumber': str(i + 1),
+                        'locationHousenumber2': None, 'locationPostal': '8000', 'locationCity': 'Zürich',
+                        'locationCountry': 'CH'}})
+            statuses.append({'meteringPointId': point_id, 'businessPartnerId': 'mock-gpart', 'legId': LEG_ID,
+                             'participantStatus': 'AKTIV', 'participantStatusDate': format_api_date(self.start),
+                             'progAktivierungsDatum': format_api_date(self.start), 'progDeaktivierungsDatum': None})
+        return {
+            'legId': LEG_ID,
+            'kpi': {'numberOfParticipants': len(points), 'numberOfMeteringPoints': len(points),
+                    'sumModulePower': sum(p['specifications']['modulePower'] for p in points),
+                    'sumConnectionPower': sum(p['specifications']['connectionPower'] for p in points),
+                    'minimumQuota': 10.0, 'reductionRateOfGridFees': 40.0, 'qualified': True},
+            'basisInfo': self.leg_header(),
+            'meteringPointList': points, 'meteringPointStatusList': statuses,
+            'managerMeteringPointList': [], 'managerMeteringPointStatusList': [], 'invitations': [],
+            'gpartCommonData': [{'gpart': 'mock-gpart', 'type': 'PERSON', 'address': None,
+                                 'name': {'salutation': '', 'type': 'PERSON', 'nameOrga': {}, 'nameGroup': {},
+                                          'namePerson': {'firstNamePerson1': 'Mock', 'lastNamePerson1': 'User'}},
+                                 'communicationData': {'email': 'mock@example.com', 'phone': None, 'fax': None,
+                                                       'mobile': None}}],
+            'timeLimits': {'legActivationDate': format_api_date(self.start), 'legDeactivationDate': '9999-12-31',
+                           'legDissolutionDate': '9999-12-31',
+                           'meteringPointActivationDate': format_api_date(self.start)},
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Headers and body are written separately, which would add delayed ACKs
+    mock: MockServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: str = '', content_type: str = 'text/html; charset=utf-8',
+              headers: Optional[Dict[str, str]] = None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _page(self, title: str, body: str, status: int = 200):
+        self._send(status, _PAGE.format(title=title, body=body))
+
+    def _json(self, data, status: int = 200):
+        self._send(status, json.dumps(data), 'application/json')
+
+    def _redirect(self, location: str, cookie: Optional[str] = None):
+        headers = {'Location': location}
+        if cookie is not None:
+            headers['Set-Cookie'] = cookie
+        self._send(302, headers=headers)
+
+    def _url(self, path: str, **query) -> str:
+        return f'http://{self.headers["Host"]}{path}' + (f'?{urlencode(query)}' if query else '')
+
+    def _session(self) -> Optional[str]:
+        for cookie in self.headers.get('Cookie', '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == SESSION_COOKIE:
+                return value
+        return None
+
+    def _login_page(self, error: str = ''):
+        action = self._url(f'{REALM}/login-actions/authenticate', session_code=self.mock.start_login('password'),
+                           execution='mock-password', client_id=CLIENT_ID, tab_id='mock')
+        error = f'<span id="input-error">{html.escape(error)}</span>' if error else ''
+        self._page('Anmelden bei myEKZ', error + _LOGIN_FORM.format(action=html.escape(action)))
+
+    def _otp_page(self, error: str = ''):
+        action = self._url(f'{REALM}/login-actions/authenticate', session_code=self.mock.start_login('otp'),
+                           execution='mock-otp', client_id=CLIENT_ID, tab_id='mock')
+        error = f'<span id="input-error">{html.escape(error)}</span>' if error else ''
+        self._page('Anmelden bei myEKZ', error + _OTP_FORM.format(action=html.escape(action)))
+
+    def _logged_in(self):
+        session = self.mock.create_session()
+        self._redirect(self._url('/nutzerdaten/'), f'{SESSION_COOKIE}={session}; Path=/; HttpOnly')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        session = self._session()
+        logged_in = self.mock.csrf_token(session) is not None
+
+        if url.path == '/nutzerdaten/':
+            self.mock.count('page')
+            if logged_in:
+                self._page('Nutzerdaten', '<h1>Nutzerdaten</h1>')
+            else:
+                self._redirect(self._url(f'{REALM}/protocol/openid-connect/auth', client_id=CLIENT_ID))
+        elif url.path == f'{REALM}/protocol/openid-connect/auth':
+            self.mock.count('login_page')
+            self._login_page()
+        elif url.path == f'{REALM}/login-actions/required-action':
+            action = self._url(url.path, session_code=self.mock.start_login('mobile_number'),
+                               execution='ensu_mobile_number_config', client_id=CLIENT_ID, tab_id='mock')
+            self._page('Mobilnummer', _MOBILE_FORM.format(action=html.escape(action)))
+        elif url.path.startswith('/api/portal-services/'):
+            self._api(url.path[len('/api/portal-services/'):], query, session, logged_in)
+        else:
+            self._page('Nicht gefunden', 'Es tut uns leid, die Seite wurde nicht gefunden.', 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length', 0))
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True).items()}
+        step = self.mock.finish_login_step(query.get('session_code', ''))
+
+        if url.path == f'{REALM}/login-actions/authenticate' and step == 'password':
+            self.mock.count('login')
+            if form.get('username') != self.mock.username or form.get('password') != self.mock.password:
+                self._login_page('Ungültiger Benutzername oder Passwort.')
+            elif self.mock.otp_secret:
+                self._otp_page()
+            elif self.mock.ask_mobile_number:
+                self._redirect(self._url(f'{REALM}/login-actions/required-action',
+                                         execution='ensu_mobile_number_config', client_id=CLIENT_ID, tab_id='mock'))
+            else:
+                self._logged_in()
+        elif url.path == f'{REALM}/login-actions/authenticate' and step == 'otp':
+            self.mock.count('otp')
+            if pyotp.TOTP(self.mock.otp_secret).verify(form.get('otp', ''), valid_window=1):
+                self._logged_in()
+            else:
+                self._otp_page('Ungültiger Code.')
+        elif url.path == f'{REALM}/login-actions/required-action' and step == 'mobile_number':
+            self.mock.count('mobile_number')
+            if 'cancel' in form:
+                self._logged_in()
+            else:
+                self._page('Mobilnummer', 'Mobile numbers cannot be configured on the mock server.', 400)
+        elif url.path == '/logout':
+            self.mock.count('logout')
+            session = self._session()
+            token = self.mock.csrf_token(session)
+            if token is None or form.get('_csrf') != token:
+                self._page('Forbidden', 'Invalid CSRF token', 403)
+                return
+            self.mock.end_session(session)
+            self._page('Abgemeldet', 'Sie wurden abgemeldet.')
+        elif step is None and url.path.startswith(f'{REALM}/login-actions/'):
+            # Keycloak shows this when a login form is submitted twice or too late.
+            self._page('Anmelden bei myEKZ', 'Es tut uns leid, diese Seite ist abgelaufen.', 400)
+        else:
+            self._page('Nicht gefunden', 'Es tut uns leid, die Seite wurde nicht gefunden.', 404)
+
+    def _api(self, endpoint: str, query: Dict[str, str], session: Optional[str], logged_in: bool):
+        self.mock.count('api')
+        if not logged_in:
+            # Like myEKZ, send clients without a session to the login page.
+            self._redirect(self._url(f'{REALM}/protocol/openid-connect/auth', client_id=CLIENT_ID))
+            return
+
+        delay = self.mock.throttle_delay()
+        if delay:
+            self.mock.count('throttled')
+            self._send(429, json.dumps({'error': 'Too Many Requests'}), 'application/json',
+                       {'Retry-After': str(math.ceil(delay))})
+            return
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        if self.mock.fail_randomly():
+            self.mock.count('failed')
+            self._json({'error': 'Service Unavailable'}, 503)
+            return
+
+        if endpoint == 'csrf/v1/token':
+            self._json({'token': self.mock.csrf_token(session)})
+        elif endpoint == 'consumption-view/v1/installation-selection-data':
+            self._json(self.mock.installation_selection_data())
+        elif endpoint == 'consumption-view/v1/installation-data' and query.get('installationId') in \
+                self.mock.installations:
+            self._json(self.mock.installation_data())
+        elif endpoint == 'consumption-view/v1/consumption-data' and query.get('installationId') in \
+                self.mock.installations:
+            self.mock.count('consumption_data')
+            try:
+                first, last = parse_zrh_day(query['from']), parse_zrh_day(query['to'])
+            except (KeyError, ValueError):
+                self._json({'error': 'Bad Request'}, 400)
+                return
+            self._json(synthetic_consumption_data(query['installationId'], query.get('type', 'PK_VERB_15MIN'),
+                                                  first, last, (self.mock.start, self.mock.end)))
+        elif endpoint == 'leg-manager-dashboard/v1/leg-headers':
+            self._json({'legHeaders': [self.mock.leg_header()]})
+        elif endpoint == f'leg-manager-dashboard/v1/leg-details/{LEG_ID}':
+            self._json({'legDetails': self.mock.leg_details()})
+        else:
+            self._json({'error': 'Not Found'}, 404)
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', type=int, default=8080, show_default=True)
+@click.option('--user', 'username', default='user', show_default=True, help='The only accepted username.')
+@click.option('--password', default='password', show_default=True, help='The only accepted password.')
+@click.option('--otp', 'otp_secret', default='', help='Ask for a TOTP code generated with this secret.')
+@click.option('--ask-mobile-number', is_flag=True, help='Ask to configure a mobile number after the login.')
+@click.option('--installations', type=click.IntRange(min=1), default=1, show_default=True)
+@click.option('--start', default='2020-01-01', show_default=True, metavar='YYYY-MM-DD',
+              help='First day with data.')
+@click.option('--end', default=None, metavar='YYYY-MM-DD', help='Last day with data. Defaults to yesterday.')
+@click.option('--latency', type=click.FloatRange(min=0), default=0, show_default=True, metavar='SECONDS',
+              help='Time each API call takes.')
+@click.option('--error-rate', type=click.FloatRange(min=0, max=1), default=0, show_default=True,
+              help='Probability of an API call failing with a 503.')
+@click.option('--rate', type=click.FloatRange(min=0, min_open=True), default=None, metavar='REQUESTS',
+              help='API calls per second before responding with 429. Unlimited by default.')
+@click.option('--burst', type=click.IntRange(min=1), default=1, show_default=True)
+@click.option('--session-lifetime', type=click.FloatRange(min=0), default=None, metavar='SECONDS',
+              help='Time after which logins expire. Never by default.')
+def main(host: str, port: int, username: str, password: str, otp_secret: str, ask_mobile_number: bool,
+         installations: int, start: str, end: str | None, latency: float, error_rate: float, rate: float | None,
+         burst: int, session_lifetime: float | None):
+    """Run a mock myEKZ server with synthetic data."""
+    server = MockServer(username, password, otp_secret, ask_mobile_number, installations, parse_zrh_day(start),
+                        parse_zrh_day(end) if end else None, latency, error_rate, rate, burst, session_lifetime,
+                        host=host, port=port)
+    click.echo(f'Serving mock myEKZ on {server.base_url} for installations {", ".join(server.installations)}',
+               err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import json
+import os
+import os.path
+import threading
+import time
+
+from typing import Callable, Dict, Optional, Tuple
+
+# How many weeks to try to get with a single request, per data type. Daily values are small, so we try to get
+# up to a year at once. 15 minute values are requested per week like the myEKZ website does.
+MAX_WINDOW_WEEKS: Dict[str, int] = {
+    'PK_VERB_15MIN': 1,
+}
+DEFAULT_MAX_WINDOW_WEEKS = 52
+
+# Responses that indicate the window was too large. Anything else, e.g. authentication errors or a server that
+# is down, says nothing about the window size.
+WINDOW_TOO_LARGE_STATUS_CODES = frozenset({400, 413, 422})
+
+# How long a learned window size is used before the maximum is tried again, in seconds.
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+
+class FetchPlanner:
+    """Remembers how many weeks of data can be requested at once for each data type.
+
+    Initially, the maximum for a data type is assumed. Whenever the API rejects a window or returns less
+    than requested, the window is shrunk and the smaller size remembered. If a path is given, what has been
+    learned is stored there and used in later runs. Learned sizes expire after max_age seconds, so the
+    maximum is probed again in case the limit was temporary."""
+    def __init__(self, path: Optional[str] = None, max_age: float = DEFAULT_MAX_AGE,
+                 clock: Callable[[], float] = time.time):
+        self._path = path
+        self._max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._window_weeks: Dict[str, Tuple[int, float]] = {}  # data type -> (weeks, time learned)
+        if path is not None:
+            try:
+                with open(path, 'r') as f:
+                    self._window_weeks = {k: (int(v['weeks']), float(v['learned'])) for k, v in json.load(f).items()}
+            except (OSError, ValueError, AttributeError, KeyError, TypeError):
+                pass
+
+    def window_weeks(self, data_type: str) -> int:
+        """Number of weeks to request at once for data_type."""
+        maximum = MAX_WINDOW_WEEKS.get(data_type, DEFAULT_MAX_WINDOW_WEEKS)
+        weeks, learned = self._window_weeks.get(data_type, (maximum, 0.0))
+        if self._clock() - learned > self._max_age:
+            weeks = maximum
+        return max(1, min(weeks, maximum))
+
+    def shrink(self, data_type: str, weeks: int):
+        """Remember that at most weeks can be requested at once for data_type."""
+        weeks = max(1, weeks)
+        with self._lock:
+            if weeks >= self.window_weeks(data_type):
+                return
+            self._window_weeks[data_type] = (weeks, self._clock())
+            self._save()
+
+    def _save(self):
+        if self._path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            learned = {k: {'weeks': weeks, 'learned': at} for k, (weeks, at) in self._window_weeks.items()}
+            with open(self._path, 'w') as f:
+                json.dump(learned, f)
+        except OSError:
+            pass  # Not being able to remember the window size is no reason to fail the export.
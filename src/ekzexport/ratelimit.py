@@ -0,0 +1,89 @@
+import datetime
+import email.utils
+import random
+import threading
+import time
+
+from typing import Callable, Optional
+
+# Responses that indicate myEKZ is overloaded or throttling us, so trying again later can succeed.
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+class RateLimiter:
+    """Token bucket limiting requests to rate per second, allowing bursts of up to burst requests.
+
+    reserve() does not sleep itself but returns how long the caller has to wait, so it works for both threads and
+    coroutines. Tokens are reserved even if they are not available yet, which makes concurrent callers queue up
+    instead of all waking at the same time."""
+    def __init__(self, rate: float, burst: int = 1, clock: Callable[[], float] = time.monotonic):
+        if rate <= 0:
+            raise ValueError('rate has to be positive')
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._last = clock()
+        self.waited = 0.0  # Total seconds callers were asked to wait
+
+    def reserve(self) -> float:
+        """Take a token and return the number of seconds to wait before using it."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.waited += delay
+            return delay
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter for throttled or failed requests.
+
+    The delay before retry n (starting at 0) is random between 0 and min(max_delay, base_delay * 2**n), unless the
+    server asks for a specific delay with Retry-After."""
+    def __init__(self, retries: int = 4, base_delay: float = 1.0, max_delay: float = 60.0,
+                 rng: Optional[random.Random] = None):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self.retried = 0  # Number of retries so far
+        self.waited = 0.0  # Total seconds spent backing off
+
+    def retry_delay(self, attempt: int, status_code: Optional[int], retry_after: Optional[str] = None,
+                    now: Optional[float] = None) -> Optional[float]:
+        """Seconds to wait before retrying after attempt failed, or None to give up.
+
+        status_code is None if the request failed without a response, e.g. due to a connection error."""
+        if attempt >= self.retries or (status_code is not None and status_code not in RETRY_STATUS_CODES):
+            return None
+        delay = parse_retry_after(retry_after, now)
+        if delay is None:
+            with self._lock:
+                delay = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        else:
+            delay = min(delay, self.max_delay)
+        with self._lock:
+            self.retried += 1
+            self.waited += delay
+        return delay
+
+
+def parse_retry_after(value: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    """Seconds to wait according to a Retry-After header, which is either a number of seconds or an HTTP date."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, date.timestamp() - (time.time() if now is None else now))
@@ -1,10 +1,22 @@
+import threading
+import time
+
 from functools import cached_property
+from typing import TYPE_CHECKING, Callable, Generator, Optional, Tuple
 
 import requests
-import pyotp
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 from .apitypes import *
+from .htmlform import find_form
+from .ratelimit import RateLimiter, RetryPolicy
+from .sessionstore import SessionStore
+from .stats import Stats, count_values
+
+if TYPE_CHECKING:
+    # Only needed with --cache and the metrics options, which import them.
+    from .cache import ResponseCache
+    from .metrics import ExportMetrics
 
 HTML_HEADERS = {
     'Accept': 'text/html,application/xhtml+xml,application/xml'
@@ -13,17 +25,147 @@ JSON_HEADERS = {
     'Accept': 'application/json, text/plain, */*'
 }
 
+LoginFlow = Generator[Tuple[str, str, Optional[dict]], Tuple[str, str], None]
+
+
+def prompt_sms_code() -> str:
+    return input('Enter 2FA code (wait for SMS): ')
+
+
+def needs_login(base_url: str, status_code: int, url: str, content_type: str) -> bool:
+    """Whether a portal-services response indicates our session is not (or no longer) logged in.
+
+    Expired sessions either get a 401 or are redirected to the login page instead of receiving JSON."""
+    return (status_code == 401 or not url.startswith(f'{base_url}/api/') or
+            (status_code == 200 and 'json' not in content_type))
+
+
+def login_flow(base_url: str, username: str, password: str, token: str,
+               sms_code: Optional[Callable[[], str]] = None) -> LoginFlow:
+    """The myEKZ login dance, independent of the HTTP client used to perform it.
+
+    The generator yields (method, url, form data) tuples for each request that has to be made and expects
+    to be sent (final url, text) of the corresponding response after following redirects. It finishes once
+    the login succeeded and raises if it did not.
+
+    If myEKZ asks for a code sent by SMS, sms_code is called to get it. Without sms_code, SMS 2FA fails."""
+    # We need to use a page that works for everyone and is reasonably fast to load.
+    # /startseite appears to be really slow for some accounts, so that is not a good choice.
+    # /verbrauch used to be what we used but for pure LEG managers without a metering point that returns 403
+    # so /nutzerdaten it is, even if we don't actually care about the user data.
+    url, text = yield 'GET', f'{base_url}/nutzerdaten/', None
+
+    # Find the login form and get the action URL, so we can submit credentials.
+    loginform = find_form(text, {'kc-form-login'})
+    if not loginform:
+        if 'Es tut uns leid' in text or 'Systemunterbruch' in text:
+            raise Exception('myEKZ appears to be offline for maintenance')
+        else:
+            raise Exception('Login form not found on page')
+    authurl = loginform['action']
+
+    url, text = yield 'POST', authurl, {'username': username, 'password': password}
+
+    # There are a few options what can happen at this point:
+    # - If 2FA is enabled, we will have been redirected to a page which will ask for the second factor
+    # - If 2FA is disabled, every once in a while myEKZ will ask for our mobile number on:
+    #   https://login.ekz.ch/auth/realms/myEKZ/login-actions/required-action?
+    #     execution=ensu_mobile_number_config&client_id=cos-myekz-webapp&tab_id=<alnum>
+    #   To skip, mobile_number=&cancel=Sp%C3%A4ter+einrichten is POSTed to
+    #   https://login.ekz.ch/auth/realms/myEKZ/login-actions/required-action?
+    #     session_code=<alnum>&execution=ensu_mobile_number_config&client_id=cos-myekz-webapp&tab_id=<alnum>
+
+    if 'ensu_mobile_number_config' in url:
+        # Just get the form action and submit the cancellation to skip...
+        mobileform = find_form(text)
+        if not mobileform:
+            raise Exception('Didn\'t find mobile phone number entry on: ' + url)
+        mobileurl = mobileform['action']
+        if 'ensu_mobile_number_config' not in mobileurl:
+            raise Exception('Unexpected mobile phone number entry URL: ' + mobileurl)
+        url, text = yield 'POST', mobileurl, {'mobile_number': '', 'cancel': 'Später einrichten'}
+
+    elif 'auth/realms/myEKZ/login-actions/authenticate' in url:
+        # If we did not get redirected away now, we're being asked for
+        # a second factor, either SMS code or OTP.
+        form = find_form(text, {'kc-sms-code-login-form', 'kc-otp-login-form'})
+        if form and form['id'] == 'kc-sms-code-login-form':
+            if sms_code is None:
+                raise Exception('myEKZ asks for a code sent by SMS, which is not supported here. '
+                                'Set up OTP with an authenticator app and provide its secret instead.')
+            authurl = form['action']
+            url, text = yield 'POST', authurl, {'code': sms_code()}
+        elif form:
+            if not token:
+                raise Exception('OTP is enabled but no token was provided')
+            authurl = form['action']
+            import pyotp  # Only needed for accounts with OTP, so it is not imported up front.
+            url, text = yield 'POST', authurl, {'otp': pyotp.TOTP(token).now()}
+        elif 'Es tut uns leid' in text or 'Systemunterbruch' in text:
+            raise Exception('myEKZ appears to be offline for maintenance')
+        else:
+            raise Exception('myEKZ auth expects something we can\'t handle.')
+
+    # Finally, if we're successfully logged in, we should be back at the original URL we requested
+    if url != f'{base_url}/nutzerdaten/':
+        raise Exception(f'Unable to login. Ended up at {url} instead of {base_url}/nutzerdaten/')
+
+
+def endpoint_name(suffix: str) -> str:
+    """The API endpoint of a portal-services URL suffix, without query and IDs."""
+    path = suffix.split('?')[0]
+    if path.startswith('leg-manager-dashboard/v1/leg-details/'):
+        return 'leg-manager-dashboard/v1/leg-details'
+    return path
+
+
+def error_reason(e: Exception) -> str:
+    response = getattr(e, 'response', None)
+    return str(response.status_code) if response is not None else type(e).__name__
+
 
 class Session:
-    """Represents a session with the EKZ API."""
-    def __init__(self, username: str, password: str, token='', login_immediately=False):
+    """Represents a session with the EKZ API.
+
+    If a SessionStore is passed, a previously stored session is reused instead of logging in again. The session is
+    then stored on exit instead of logging out. Should the stored session have expired, a fresh login happens
+    transparently on the first API call.
+
+    With a ResponseCache, consumption data that is not going to change anymore is only retrieved once.
+
+    All requests wait for the RateLimiter, if any. API calls that are throttled or fail on the server side are
+    retried according to the RetryPolicy, which defaults to a few retries with exponential backoff.
+
+    Time spent on logging in, requests, waiting and decoding responses as well as the number of requests, bytes and
+    points received are recorded in stats. If metrics are passed, API call and login durations as well as failed API
+    calls are recorded there.
+
+    For accounts with SMS 2FA, sms_code is called to get the code, by default asking for it on the terminal."""
+    def __init__(self, username: str, password: str, token='', login_immediately=False, base_url=BASE_URL,
+                 store: Optional[SessionStore] = None, cache: Optional['ResponseCache'] = None,
+                 rate_limiter: Optional[RateLimiter] = None, retry: Optional[RetryPolicy] = None,
+                 stats: Optional[Stats] = None, metrics: Optional['ExportMetrics'] = None,
+                 sms_code: Optional[Callable[[], str]] = prompt_sms_code):
         self._session = requests.Session()
         self._session.headers.update({'User-Agent': 'ekzexport'})
         self._username = username
         self._password = password
         self._token = token.strip().replace(' ', '')
+        self._sms_code = sms_code
         self._login_immediately = login_immediately
+        self._base_url = base_url.rstrip('/')
         self._logged_in = False
+        self._login_lock = threading.Lock()
+        self._login_generation = 0
+        self._pool_size = 0
+        self._store = store
+        self._cache = cache
+        self.rate_limiter = rate_limiter
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.stats = stats if stats is not None else Stats()
+        self.metrics = metrics
+        if store is not None and store.load(self._session.cookies):
+            self._logged_in = True  # Optimistically, needs_login() catches it if the session expired.
 
     def __enter__(self):
         if self._login_immediately:
@@ -31,88 +173,114 @@ class Session:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self._logged_in:
-            r = self._session.post('https://my.ekz.ch/logout', headers=HTML_HEADERS,
+        if self._store is not None:
+            if self._logged_in:
+                self._store.save(self._session.cookies)
+        elif self._logged_in:
+            r = self._session.post(f'{self._base_url}/logout', headers=HTML_HEADERS,
                                    data={'_csrf': self.get_csrf_token()})
             r.raise_for_status()
 
+    def ensure_pool_size(self, size: int):
+        """Make sure at least size connections can be kept open, so concurrent requests don't have to wait."""
+        if size <= self._pool_size:
+            return
+        # requests' default pool keeps 10 connections per host, which would throttle larger worker pools.
+        adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._pool_size = size
+
     def _ensure_logged_in(self):
         if self._logged_in:
             return
-        # We need to use a page that works for everyone and is reasonably fast to load.
-        # /startseite appears to be really slow for some accounts, so that is not a good choice.
-        # /verbrauch used to be what we used but for pure LEG managers without a metering point that returns 403
-        # so /nutzerdaten it is, even if we don't actually care about the user data.
-        r = self._session.get('https://my.ekz.ch/nutzerdaten/', headers=HTML_HEADERS)
-        r.raise_for_status()
-
-        # Find the login form and get the action URL, so we can submit credentials.
-        soup = BeautifulSoup(r.text, 'html.parser')
-        loginform = soup.select('form[id=kc-form-login]')
-        if not loginform:
-            if 'Es tut uns leid' in r.text or 'Systemunterbruch' in r.text:
-                raise Exception('myEKZ appears to be offline for maintenance')
-            else:
-                raise Exception('Login form not found on page')
-        authurl = loginform[0]['action']
-
-        r = self._session.post(authurl, data={'username': self._username, 'password': self._password})
-        r.raise_for_status()
-
-        # There are a few options what can happen at this point:
-        # - If 2FA is enabled, we will have been redirected to a page which will ask for the second factor
-        # - If 2FA is disabled, every once in a while myEKZ will ask for our mobile number on:
-        #   https://login.ekz.ch/auth/realms/myEKZ/login-actions/required-action?
-        #     execution=ensu_mobile_number_config&client_id=cos-myekz-webapp&tab_id=<alnum>
-        #   To skip, mobile_number=&cancel=Sp%C3%A4ter+einrichten is POSTed to
-        #   https://login.ekz.ch/auth/realms/myEKZ/login-actions/required-action?
-        #     session_code=<alnum>&execution=ensu_mobile_number_config&client_id=cos-myekz-webapp&tab_id=<alnum>
-
-        if 'ensu_mobile_number_config' in r.url:
-            # Just get the form action and submit the cancellation to skip...
-            soup = BeautifulSoup(r.text, 'html.parser')
-            mobileform = soup.select('form')
-            if not mobileform:
-                raise Exception('Didn\'t find mobile phone number entry on: ' + r.url)
-            mobileurl = mobileform[0]['action']
-            if 'ensu_mobile_number_config' not in mobileurl:
-                raise Exception('Unexpected mobile phone number entry URL: ' + mobileurl)
-            r = self._session.post(mobileurl, data={'mobile_number': '', 'cancel': 'Später einrichten'})
-            r.raise_for_status()
+        # Concurrent fetches share this session, so only the first one gets to do the login dance.
+        with self._login_lock:
+            if not self._logged_in:
+                self._login()
 
-        elif 'auth/realms/myEKZ/login-actions/authenticate' in r.url:
-            # If we did not get redirected away now, we're being asked for
-            # a second factor, either SMS code or OTP.
-            soup = BeautifulSoup(r.text, 'html.parser')
-            smsform = soup.select('form[id=kc-sms-code-login-form]')
-            otpform = soup.select('form[id=kc-otp-login-form]')
-            if smsform:
-                authurl = smsform[0]['action']
-                code = input('Enter 2FA code (wait for SMS): ')
-                r = self._session.post(authurl, data={'code': code})
-                r.raise_for_status()
-            elif otpform:
-                if not self._token:
-                    raise Exception('OTP is enabled but no token was provided')
-                authurl = otpform[0]['action']
-                r = self._session.post(authurl, data={'otp': pyotp.TOTP(self._token).now()})
+    def _relogin(self, generation: int):
+        """Login again, unless another thread already did so since the login generation observed by the caller."""
+        with self._login_lock:
+            if self._login_generation == generation:
+                self._logged_in = False
+                self._session.cookies.clear()
+                self._login()
+
+    def _login(self):
+        flow = login_flow(self._base_url, self._username, self._password, self._token, self._sms_code)
+        self.stats.count('logins')
+        start = time.perf_counter()
+        try:
+            method, url, data = next(flow)
+            while True:
+                self._wait_for_rate_limit()
+                with self.stats.phase('login'):
+                    r = self._session.request(method, url, data=data,
+                                              headers=HTML_HEADERS if method == 'GET' else None)
+                self.stats.count('requests')
+                self.stats.count('bytes_received', len(r.content))
                 r.raise_for_status()
-            elif 'Es tut uns leid' in r.text or 'Systemunterbruch' in r.text:
-                raise Exception('myEKZ appears to be offline for maintenance')
-            else:
-                raise Exception('myEKZ auth expects something we can\'t handle.')
+                method, url, data = flow.send((r.url, r.text))
+        except StopIteration:
+            pass
+        if self.metrics is not None:
+            self.metrics.login_duration.observe(value=time.perf_counter() - start)
 
-        # Finally, if we're successfully logged in, we should be back at the original URL we requested
-        if r.url != 'https://my.ekz.ch/nutzerdaten/':
-            raise Exception('Unable to login. Ended up at ' + r.url + ' instead of https://my.ekz.ch/nutzerdaten/')
-        
+        self._login_generation += 1
         self._logged_in = True
 
     def _get_portal_services_json(self, suffix: str):
         self._ensure_logged_in()
-        r = self._session.get(f'https://my.ekz.ch/api/portal-services/{suffix}', headers=JSON_HEADERS)
-        r.raise_for_status()
-        return r.json()
+        generation = self._login_generation
+        url = f'{self._base_url}/api/portal-services/{suffix}'
+        start = time.perf_counter()
+        try:
+            r = self._get_json(url)
+            if needs_login(self._base_url, r.status_code, r.url, r.headers.get('Content-Type', '')):
+                self._relogin(generation)
+                r = self._get_json(url)
+            r.raise_for_status()
+            with self.stats.phase('decode'):
+                return r.json()
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.request_errors.inc(endpoint_name(suffix), error_reason(e))
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.request_duration.observe(endpoint_name(suffix), value=time.perf_counter() - start)
+
+    def _wait_for_rate_limit(self):
+        if self.rate_limiter is not None:
+            self._sleep(self.rate_limiter.reserve())
+
+    def _sleep(self, seconds: float):
+        if seconds > 0:
+            with self.stats.phase('wait'):
+                time.sleep(seconds)
+
+    def _get_json(self, url: str) -> requests.Response:
+        """GET url, retrying if myEKZ throttles us or fails temporarily."""
+        attempt = 0
+        while True:
+            self._wait_for_rate_limit()
+            try:
+                with self.stats.phase('request'):
+                    r = self._session.get(url, headers=JSON_HEADERS)
+                    self.stats.count('bytes_received', len(r.content))
+                self.stats.count('requests')
+            except requests.ConnectionError:
+                delay = self.retry.retry_delay(attempt, None)
+                if delay is None:
+                    raise
+            else:
+                delay = self.retry.retry_delay(attempt, r.status_code, r.headers.get('Retry-After'))
+                if delay is None:
+                    return r
+            self.stats.count('retries')
+            self._sleep(delay)
+            attempt += 1
 
     def get_csrf_token(self):
         return self._get_portal_services_json('csrf/v1/token')['token']
@@ -130,10 +298,20 @@ class Session:
 
     def get_consumption_data(self, installation_id: str, data_type: str,
                              date_from: str, date_to: str) -> ConsumptionData:
-        return self._get_portal_services_json(
+        if self._cache is not None:
+            cached = self._cache.get(installation_id, data_type, date_from, date_to)
+            if cached is not None:
+                self.stats.count('cache_hits')
+                self.stats.count('points_received', count_values(cached))
+                return cached
+        data = self._get_portal_services_json(
             f'consumption-view/v1/consumption-data'
             f'?installationId={installation_id}&from={date_from}&to={date_to}&type={data_type}'
         )
+        self.stats.count('points_received', count_values(data))
+        if self._cache is not None:
+            self._cache.put(installation_id, data_type, date_from, date_to, data)
+        return data
 
     def get_legs(self) -> List[LegHeader]:
         return self._get_portal_services_json('leg-manager-dashboard/v1/leg-headers')['legHeaders']
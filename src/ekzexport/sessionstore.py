@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import os.path
+import stat
+import time
+
+from http.cookiejar import Cookie, CookieJar
+from typing import Optional
+
+from platformdirs import user_cache_dir
+
+
+class SessionStore:
+    """Persists the cookies of an authenticated session on disk, so later runs can skip the login.
+
+    There is one file per account and base URL. Since the cookies are as good as the password for as long as the
+    session lives, the file is only ever readable by its owner and files with laxer permissions are ignored."""
+    def __init__(self, username: str, base_url: str, directory: Optional[str] = None):
+        self._directory = directory or os.path.join(user_cache_dir('ekzexport'), 'sessions')
+        key = hashlib.sha256(f'{base_url}\0{username}'.encode('utf-8')).hexdigest()[:32]
+        self.path = os.path.join(self._directory, f'{key}.json')
+
+    def load(self, jar: CookieJar) -> bool:
+        """Add the stored cookies to jar. Returns False if there is no usable stored session."""
+        try:
+            with open(self.path, 'r') as f:
+                if stat.S_IMODE(os.fstat(f.fileno()).st_mode) & 0o077:
+                    return False  # Somebody else could have read or written it, so don't trust it.
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        now = time.time()
+        cookies = [c for c in stored.get('cookies', []) if c['expires'] is None or c['expires'] > now]
+        if not cookies:
+            return False
+        for c in cookies:
+            jar.set_cookie(Cookie(
+                version=c['version'], name=c['name'], value=c['value'],
+                port=c['port'], port_specified=c['port'] is not None,
+                domain=c['domain'], domain_specified=c['domain_specified'],
+                domain_initial_dot=c['domain'].startswith('.'),
+                path=c['path'], path_specified=c['path_specified'],
+                secure=c['secure'], expires=c['expires'], discard=False,
+                comment=None, comment_url=None, rest=c['rest']))
+        return True
+
+    def save(self, jar: CookieJar):
+        """Store all cookies in jar, including session cookies."""
+        cookies = [{
+            'version': c.version, 'name': c.name, 'value': c.value, 'port': c.port,
+            'domain': c.domain, 'domain_specified': c.domain_specified,
+            'path': c.path, 'path_specified': c.path_specified,
+            'secure': c.secure, 'expires': c.expires, 'rest': c._rest,
+        } for c in jar]
+
+        os.makedirs(self._directory, mode=0o700, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'saved': time.time(), 'cookies': cookies}, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def clear(self):
+        """Forget the stored session, if any."""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,62 @@
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, TypedDict
+
+from .apitypes import ConsumptionData, SERIES_KEYS
+
+
+class PhaseStats(TypedDict):
+    calls: int
+    seconds: float
+
+
+class StatsSummary(TypedDict):
+    wall_seconds: float
+    phases: Dict[str, PhaseStats]
+    counters: Dict[str, int]
+
+
+class Stats:
+    """Timings of the phases of a run (login, requests, decoding, parsing, merging, writing, ...) and counters such
+    as requests made, bytes received and points written.
+
+    Phases running in parallel threads add up, so their total can exceed the wall time. Nested phases are counted
+    in both, so they should be avoided."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._phases: Dict[str, List[float]] = {}  # name -> [calls, seconds]
+        self.counters = Counter()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            phase = self._phases.setdefault(name, [0, 0.0])
+            phase[0] += 1
+            phase[1] += seconds
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def summary(self) -> StatsSummary:
+        with self._lock:
+            return {'wall_seconds': time.perf_counter() - self._start,
+                    'phases': {name: {'calls': int(calls), 'seconds': seconds}
+                               for name, (calls, seconds) in self._phases.items()},
+                    'counters': dict(self.counters)}
+
+
+def count_values(data: ConsumptionData) -> int:
+    """Number of values in all series of an API response."""
+    return sum(len((data.get(key) or {}).get('values', [])) for key in SERIES_KEYS)
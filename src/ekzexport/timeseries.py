@@ -0,0 +1,192 @@
+import bisect
+import datetime
+
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from .apitypes import ConsumptionData, Value
+from .timeutil import parse_api_timestamps, zrh_day_start, epoch_day_to_date, epoch_to_zrh_date, zrh_offset_span
+from .util import DayRange, DayRangeSet
+
+NAN = float('nan')
+
+Row = Tuple[int, Optional[float], Optional[float]]  # UNIX timestamp, HT and NT values
+
+# Seconds between values per data type. Data types not listed have daily values.
+VALUE_INTERVALS = {
+    'PK_VERB_15MIN': 15 * 60,
+}
+
+
+def values_per_day(data_type: str, day: datetime.date) -> int:
+    """How many values a complete day has, which differs on days with DST transitions."""
+    seconds = zrh_day_start(day + datetime.timedelta(days=1)) - zrh_day_start(day)
+    return max(1, seconds // VALUE_INTERVALS.get(data_type, 86400))
+
+
+def _value(v: float) -> Optional[float]:
+    return None if v != v else v  # Only NaN is not equal to itself
+
+
+class TimeSeries:
+    """HT and NT values ordered by time, stored column-wise.
+
+    Timestamps are UNIX timestamps in an array('q'), the values of both tariffs are in array('d') with NaN where a
+    tariff has no value."""
+    __slots__ = ('epochs', 'ht', 'nt')
+
+    def __init__(self, epochs: Iterable[int] = (), ht: Iterable[float] = (), nt: Iterable[float] = ()):
+        self.epochs = array('q', epochs)
+        self.ht = array('d', ht)
+        self.nt = array('d', nt)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Row]) -> 'TimeSeries':
+        """Create from (UNIX timestamp, ht, nt) rows in time order, with None for missing values."""
+        result = cls()
+        for epoch, ht, nt in rows:
+            result.epochs.append(epoch)
+            result.ht.append(NAN if ht is None else ht)
+            result.nt.append(NAN if nt is None else nt)
+        return result
+
+    @classmethod
+    def from_consumption_data(cls, data: ConsumptionData) -> 'TimeSeries':
+        """Create from the HT and NT series of an API response, leaving out values that are not VALID."""
+        ht = cls._from_values((data.get('seriesHt') or {}).get('values', []), False)
+        nt = cls._from_values((data.get('seriesNt') or {}).get('values', []), True)
+        ht.upsert(nt)
+        return ht
+
+    @classmethod
+    def _from_values(cls, values: List[Value], niedertarif: bool) -> 'TimeSeries':
+        values = [v for v in values if v['status'] == 'VALID']
+        epochs = parse_api_timestamps(values)
+        order = range(len(values))
+        if any(epochs[i] > epochs[i + 1] for i in range(len(epochs) - 1)):
+            order = sorted(order, key=epochs.__getitem__)
+
+        result = cls()
+        values_column, other_column = (result.nt, result.ht) if niedertarif else (result.ht, result.nt)
+        for i in order:
+            v = values[i]
+            result.epochs.append(epochs[i])
+            values_column.append(NAN if v['value'] is None else float(v['value']))
+            other_column.append(NAN)
+        return result
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    def __bool__(self) -> bool:
+        return len(self.epochs) > 0
+
+    def count(self) -> int:
+        """Number of values over both tariffs."""
+        return sum(1 for v in self.ht if v == v) + sum(1 for v in self.nt if v == v)
+
+    def rows(self) -> Iterator[Row]:
+        """Iterate over (UNIX timestamp, ht, nt) with None for missing values."""
+        for epoch, ht, nt in zip(self.epochs, self.ht, self.nt):
+            yield epoch, _value(ht), _value(nt)
+
+    def _take(self, start: int, end: int) -> 'TimeSeries':
+        result = TimeSeries()
+        result.epochs = self.epochs[start:end]
+        result.ht = self.ht[start:end]
+        result.nt = self.nt[start:end]
+        return result
+
+    def between(self, start: Optional[int] = None, end: Optional[int] = None) -> 'TimeSeries':
+        """The part with start <= timestamp < end."""
+        i = 0 if start is None else bisect.bisect_left(self.epochs, start)
+        j = len(self.epochs) if end is None else bisect.bisect_left(self.epochs, end)
+        return self._take(i, max(i, j))
+
+    def slice(self, day_range: DayRange) -> 'TimeSeries':
+        """The part within day_range, using days in Zurich."""
+        return self.between(zrh_day_start(day_range.start),
+                            zrh_day_start(day_range.end + datetime.timedelta(days=1)))
+
+    def select(self, days: DayRangeSet) -> 'TimeSeries':
+        """The parts within any of the ranges of days."""
+        result = TimeSeries()
+        for r in days.ranges:
+            result.upsert(self.slice(r))
+        return result
+
+    def exclude(self, present: DayRangeSet, after: Optional[int] = None) -> 'TimeSeries':
+        """The part on days not in present, plus everything with a timestamp greater than after.
+
+        Exporters use this to drop fetched values that an export target already has, since data is retrieved in
+        whole weeks."""
+        if not self:
+            return self
+        first_day = epoch_to_zrh_date(self.epochs[0])
+        last_day = epoch_to_zrh_date(self.epochs[-1])
+        result = self.select(present.complement(DayRange(first_day, last_day)))
+        if after is not None:
+            result.upsert(self.between(after + 1))
+        return result
+
+    def days(self) -> DayRangeSet:
+        """The days in Zurich for which there is any value."""
+        ranges = []
+        current = None
+        offset, offset_start, offset_end = 0, 0, 0
+        prev_day = None
+        for epoch, ht, nt in zip(self.epochs, self.ht, self.nt):
+            if ht != ht and nt != nt:
+                continue
+            if not offset_start <= epoch < offset_end:
+                offset, offset_start, offset_end = zrh_offset_span(epoch)
+            day = (epoch + offset) // 86400
+            if day == prev_day:
+                continue
+            prev_day = day
+            date = epoch_day_to_date(day)
+            if current is None or not current.append_consecutive(date):
+                current = DayRange(date, date)
+                ranges.append(current)
+        return DayRangeSet(ranges)
+
+    def gaps(self, within: DayRange) -> DayRangeSet:
+        """The days within the given range for which there are no values."""
+        return self.slice(within).days().complement(within)
+
+    def upsert(self, other: 'TimeSeries'):
+        """Merge the values of other into this series.
+
+        Where both have a value for the same timestamp and tariff, the one from other wins. Missing values in other
+        never remove existing ones."""
+        if not other:
+            return
+        if not self or other.epochs[0] > self.epochs[-1]:
+            # Common case of data arriving in order, which doesn't require merging.
+            self.epochs.extend(other.epochs)
+            self.ht.extend(other.ht)
+            self.nt.extend(other.nt)
+            return
+
+        epochs, ht, nt = array('q'), array('d'), array('d')
+        a, b = self.epochs, other.epochs
+        i = j = 0
+        while i < len(a) or j < len(b):
+            if j >= len(b) or (i < len(a) and a[i] < b[j]):
+                epochs.append(a[i])
+                ht.append(self.ht[i])
+                nt.append(self.nt[i])
+                i += 1
+            elif i >= len(a) or b[j] < a[i]:
+                epochs.append(b[j])
+                ht.append(other.ht[j])
+                nt.append(other.nt[j])
+                j += 1
+            else:
+                epochs.append(a[i])
+                other_ht, other_nt = other.ht[j], other.nt[j]
+                ht.append(self.ht[i] if other_ht != other_ht else other_ht)
+                nt.append(self.nt[i] if other_nt != other_nt else other_nt)
+                i += 1
+                j += 1
+        self.epochs, self.ht, self.nt = epochs, ht, nt
@@ -1,13 +1,23 @@
+import bisect
 import datetime
+import functools
 
-from typing import Iterable, Callable, TypeVar
+from array import array
+from typing import Iterable, Callable, TypeVar, List, Tuple
 from zoneinfo import ZoneInfo
 
+from .apitypes import Value
+
 ZRH_TZ = ZoneInfo(key='Europe/Zurich')
 UTC_TZ = ZoneInfo(key='UTC')
 Input = TypeVar('Input')
 Output = TypeVar('Output')
 
+# Range of years for which UTC offsets are looked up in a precomputed table instead of via zoneinfo
+ZRH_TABLE_YEARS = (1970, 2100)
+_UNIX_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=UTC_TZ)
+_UNIX_EPOCH_ORDINAL = _UNIX_EPOCH.toordinal()
+
 
 def parse_zrh_day(day: str) -> datetime.date:
     """Convert a day string into a date.
@@ -30,7 +40,30 @@ def format_api_date(dt: datetime.date) -> str:
 
 def parse_api_timestamp(timestamp: int) -> datetime.datetime:
     """Parse UTC timestamp from API."""
-    return datetime.datetime.strptime(str(timestamp), '%Y%m%d%H%M%S')
+    date, time = divmod(timestamp, 1000000)
+    return datetime.datetime(date // 10000, date // 100 % 100, date % 100, time // 10000, time // 100 % 100, time % 100)
+
+
+def api_timestamp_to_epoch(timestamp: int) -> int:
+    """Convert a UTC timestamp from the API, an integer like 20240131231500, to a UNIX timestamp."""
+    date, time = divmod(timestamp, 1000000)
+    return (days_from_civil(date // 10000, date // 100 % 100, date % 100) * 86400 +
+            time // 10000 * 3600 + time // 100 % 100 * 60 + time % 100)
+
+
+def parse_api_timestamps(values: Iterable[Value]) -> array:
+    """Convert the timestamps of all values of a series to UNIX timestamps at once."""
+    result = array('q')
+    prev_date = None
+    day_start = 0
+    for v in values:
+        # Values are mostly ordered, so the date part rarely changes and only needs converting once per day.
+        date, time = divmod(v['timestamp'], 1000000)
+        if date != prev_date:
+            prev_date = date
+            day_start = days_from_civil(date // 10000, date // 100 % 100, date % 100) * 86400
+        result.append(day_start + time // 10000 * 3600 + time // 100 % 100 * 60 + time % 100)
+    return result
 
 
 def convert_zrh_datetime_sequence(input: Iterable[Input], key: Callable[[Input], str],
@@ -66,3 +99,108 @@ def convert_zrh_datetime_sequence(input: Iterable[Input], key: Callable[[Input],
 
         prev_dt = dt
         yield output(dt, item)
+
+
+def days_from_civil(year: int, month: int, day: int) -> int:
+    """Number of days since 1970-01-01 for the given date in the proleptic Gregorian calendar."""
+    year -= month <= 2
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month - 3 if month > 2 else month + 9) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def civil_from_days(days: int) -> Tuple[int, int, int]:
+    """Inverse of days_from_civil, returns (year, month, day)."""
+    days += 719468
+    era = days // 146097
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    return yoe + era * 400 + (month <= 2), month, day
+
+
+def _zoneinfo_zrh_offset(epoch: int) -> int:
+    return int((_UNIX_EPOCH + datetime.timedelta(seconds=epoch)).astimezone(ZRH_TZ).utcoffset().total_seconds())
+
+
+@functools.lru_cache(maxsize=None)
+def _zrh_transitions() -> Tuple[List[int], List[int]]:
+    """Returns (transitions, offsets): offsets[i] is the UTC offset in seconds from transitions[i] onwards."""
+    # Zurich changes its offset at most once a month, so sample monthly and then bisect to the exact second.
+    samples = [days_from_civil(year, month, 1) * 86400
+               for year in range(ZRH_TABLE_YEARS[0], ZRH_TABLE_YEARS[1] + 1) for month in range(1, 13)]
+    transitions = [samples[0]]
+    offsets = [_zoneinfo_zrh_offset(samples[0])]
+    for lo, hi in zip(samples, samples[1:]):
+        if _zoneinfo_zrh_offset(hi) == offsets[-1]:
+            continue
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if _zoneinfo_zrh_offset(mid) == offsets[-1]:
+                lo = mid
+            else:
+                hi = mid
+        transitions.append(hi)
+        offsets.append(_zoneinfo_zrh_offset(hi))
+    transitions.append(days_from_civil(ZRH_TABLE_YEARS[1] + 1, 1, 1) * 86400)  # End of the table
+    return transitions, offsets
+
+
+def zrh_offset_span(epoch: int) -> Tuple[int, int, int]:
+    """UTC offset in seconds of Zurich local time at the given UNIX timestamp.
+
+    Returns (offset, start, end) where the offset is valid for all timestamps from start up to but excluding end."""
+    transitions, offsets = _zrh_transitions()
+    i = bisect.bisect_right(transitions, epoch) - 1
+    if i < 0 or i >= len(offsets):
+        return _zoneinfo_zrh_offset(epoch), epoch, epoch + 1
+    return offsets[i], transitions[i], transitions[i + 1]
+
+
+def zrh_offset(epoch: int) -> int:
+    """UTC offset in seconds of Zurich local time at the given UNIX timestamp."""
+    return zrh_offset_span(epoch)[0]
+
+
+def zrh_local_to_epoch(local: int, fold: int = 0) -> int:
+    """Convert Zurich local time, given as seconds since 1970-01-01 00:00 local time, to a UNIX timestamp.
+
+    Ambiguous and non-existent times are resolved like zoneinfo does for datetime objects with the given fold."""
+    before = zrh_offset(local - 86400)
+    after = zrh_offset(local + 86400)
+    if before == after:
+        return local - before
+    # There is a transition nearby. Interpreting the local time with the offset before or after it can
+    # be valid (the usual case), both (the repeated hour) or neither (the skipped hour).
+    epoch_before = local - before
+    epoch_after = local - after
+    valid_before = zrh_offset(epoch_before) == before
+    valid_after = zrh_offset(epoch_after) == after
+    if valid_before == valid_after:
+        return epoch_after if fold else epoch_before
+    return epoch_before if valid_before else epoch_after
+
+
+def epoch_day_to_date(day: int) -> datetime.date:
+    """The date of a day counted since 1970-01-01, e.g. a local timestamp // 86400."""
+    return datetime.date.fromordinal(_UNIX_EPOCH_ORDINAL + day)
+
+
+def epoch_to_zrh_date(epoch: int) -> datetime.date:
+    """The day in Zurich at the given UNIX timestamp."""
+    return epoch_day_to_date((epoch + zrh_offset(epoch)) // 86400)
+
+
+def epoch_to_zrh_local(epoch: int) -> int:
+    """Convert a UNIX timestamp to Zurich local time as seconds since 1970-01-01 00:00 local time."""
+    return epoch + zrh_offset(epoch)
+
+
+def zrh_day_start(day: datetime.date) -> int:
+    """UNIX timestamp of midnight in Zurich at the start of day."""
+    return zrh_local_to_epoch((day.toordinal() - _UNIX_EPOCH_ORDINAL) * 86400)
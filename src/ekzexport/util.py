@@ -1,18 +1,33 @@
+import bisect
+import collections
+import functools
+import heapq
+import importlib
 import itertools
 
 import click
 import datetime
 
 from functools import cached_property
-from typing import Optional, List, Dict, Iterable
+from typing import TYPE_CHECKING, Optional, List, Dict, Iterable, Iterator, Callable, Tuple, TypeVar
 
-from .session import Session
-from .apitypes import IDProperty
-from .timeutil import parse_zrh_day, format_api_date
+from .planner import WINDOW_TOO_LARGE_STATUS_CODES, FetchPlanner
+from .apitypes import IDProperty, ConsumptionData, SERIES_KEYS
+from .timeutil import parse_zrh_day, format_api_date, api_timestamp_to_epoch, epoch_to_zrh_date
+
+if TYPE_CHECKING:
+    # Imports requests and sqlite3, which only commands using them should pay for.
+    from .cache import ResponseCache
+    from .session import Session
+
+Item = TypeVar('Item')
+Result = TypeVar('Result')
 
 
 class DayRange:
     """A range of days, including both start and end dates."""
+    __slots__ = ('start', 'end')
+
     def __init__(self, start: datetime.date, end: datetime.date):
         assert isinstance(start, datetime.date)
         assert isinstance(end, datetime.date)
@@ -36,7 +51,7 @@ class DayRange:
 
 
 def normalize_ranges(ranges: List[DayRange]) -> List[DayRange]:
-    """Merges overlapping and consecutive ranges into a single range."""
+    """Merges overlapping and consecutive ranges into a single range. The ranges must be sorted by start."""
     if not ranges:
         return ranges
 
@@ -44,7 +59,8 @@ def normalize_ranges(ranges: List[DayRange]) -> List[DayRange]:
     current_range = DayRange(ranges[0].start, ranges[0].end)
     for r in ranges[1:]:
         if current_range.end + datetime.timedelta(days=1) >= r.start:
-            current_range.end = r.end
+            # r could be contained in the current range, which must not shrink then
+            current_range.end = max(current_range.end, r.end)
         else:
             result.append(current_range)
             current_range = DayRange(r.start, r.end)
@@ -52,109 +68,204 @@ def normalize_ranges(ranges: List[DayRange]) -> List[DayRange]:
     return result
 
 
+def group_weeks(weeks: Iterable[DayRange], max_weeks: int) -> Iterator[DayRange]:
+    """Combine consecutive weeks into ranges of at most max_weeks weeks."""
+    current = None
+    weeks_in_current = 0
+    for week in weeks:
+        consecutive = current is not None and current.end + datetime.timedelta(days=1) == week.start
+        if consecutive and weeks_in_current < max_weeks:
+            current.end = week.end
+            weeks_in_current += 1
+        else:
+            if current is not None:
+                yield current
+            current = DayRange(week.start, week.end)
+            weeks_in_current = 1
+    if current is not None:
+        yield current
+
+
+def _append_range(starts: List[int], ends: List[int], start: int, end: int):
+    """Append a range of ordinals that starts no earlier than the last one, merging it if they overlap or touch."""
+    if ends and start <= ends[-1] + 1:
+        if end > ends[-1]:
+            ends[-1] = end
+    else:
+        starts.append(start)
+        ends.append(end)
+
+
 class DayRangeSet:
-    def __init__(self, ranges: Iterable[DayRange]):
-        self.ranges = normalize_ranges(sorted(ranges, key=lambda r: r.start))
+    """A set of days, stored as sorted, disjoint and non-consecutive ranges of day ordinals (date.toordinal()).
+
+    union(), intersect() and subtract() take time linear in the number of ranges of both sets, contains() is a
+    binary search."""
+    __slots__ = ('_starts', '_ends')
+
+    def __init__(self, ranges: Iterable[DayRange] = ()):
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+        for start, end in sorted((r.start.toordinal(), r.end.toordinal()) for r in ranges):
+            if start <= end:
+                _append_range(self._starts, self._ends, start, end)
+
+    @classmethod
+    def _from_ordinals(cls, starts: List[int], ends: List[int]) -> 'DayRangeSet':
+        result = cls.__new__(cls)
+        result._starts = starts
+        result._ends = ends
+        return result
+
+    @property
+    def ranges(self) -> List[DayRange]:
+        """The ranges of days in increasing order. Changing them does not change the set."""
+        return [DayRange(datetime.date.fromordinal(start), datetime.date.fromordinal(end))
+                for start, end in zip(self._starts, self._ends)]
 
     @property
     def empty(self):
-        return not self.ranges
+        return not self._starts
 
     @property
     def start(self):
-        return self.ranges[0].start if not self.empty else None
+        return datetime.date.fromordinal(self._starts[0]) if not self.empty else None
 
     @property
     def end(self):
-        return self.ranges[-1].end if not self.empty else None
+        return datetime.date.fromordinal(self._ends[-1]) if not self.empty else None
+
+    def contains(self, day: datetime.date) -> bool:
+        """Whether day is part of any of the ranges."""
+        ordinal = day.toordinal()
+        i = bisect.bisect_right(self._starts, ordinal) - 1
+        return i >= 0 and ordinal <= self._ends[i]
 
     def get_days(self):
         """Iterate over every day in the included ranges in increasing order."""
-        cur = datetime.date(1900, 1, 1)
-        for r in self.ranges:
-            # Ranges can overlap, so we only jump to the start if it is in the future
-            if r.start > cur:
-                cur = r.start
-            while cur <= r.end:
-                yield cur
-                cur += datetime.timedelta(days=1)
+        for start, end in zip(self._starts, self._ends):
+            for ordinal in range(start, end + 1):
+                yield datetime.date.fromordinal(ordinal)
 
     def get_covering_weeks(self):
         """Get DayRanges from Monday to Sunday to cover all days in all ranges."""
-        prev_monday = datetime.date(1900, 1, 1)
-        for r in self.ranges:
-            monday = r.start - datetime.timedelta(days=r.start.weekday())
-            if monday == prev_monday:
-                # We already had this week, skip ahead
-                monday = monday + datetime.timedelta(days=7)
-                if monday > r.end:
-                    # Already covered the whole range
-                    continue
-
-            while True:
-                sunday = monday + datetime.timedelta(days=6)
-                yield DayRange(monday, sunday)
-                prev_monday = monday
-                monday += datetime.timedelta(days=7)
-                if sunday >= r.end:
-                    break
+        covered = 0  # Ordinal of the last Sunday yielded
+        for start, end in zip(self._starts, self._ends):
+            # Ordinal 1 (0001-01-01) is a Monday
+            monday = max(start - (start - 1) % 7, covered + 1)
+            while monday <= end:
+                covered = monday + 6
+                yield DayRange(datetime.date.fromordinal(monday), datetime.date.fromordinal(covered))
+                monday += 7
+
+    def union(self, other: 'DayRangeSet') -> 'DayRangeSet':
+        """Return a DayRangeSet that contains the days present in either set."""
+        starts, ends = [], []
+        for start, end in heapq.merge(zip(self._starts, self._ends), zip(other._starts, other._ends)):
+            _append_range(starts, ends, start, end)
+        return DayRangeSet._from_ordinals(starts, ends)
 
     def intersect(self, other: 'DayRangeSet') -> 'DayRangeSet':
-        """Return a DateRangeSet that contains only days present in both sets."""
-        ranges = []
+        """Return a DayRangeSet that contains only days present in both sets."""
+        starts, ends = [], []
         i, j = 0, 0
-        while i < len(self.ranges) and j < len(other.ranges):
-            if self.ranges[i].end < other.ranges[j].start:
-                i += 1  # our range is completely before the other
-            elif self.ranges[i].start > other.ranges[j].end:
-                j += 1  # our range is completely after the other
+        while i < len(self._starts) and j < len(other._starts):
+            start = max(self._starts[i], other._starts[j])
+            end = min(self._ends[i], other._ends[j])
+            if start <= end:
+                # Both sets have gaps between their ranges, so the overlaps do as well.
+                starts.append(start)
+                ends.append(end)
+            # The range that ends earlier can't overlap anything else
+            if self._ends[i] < other._ends[j]:
+                i += 1
             else:
-                # We have some sort of overlap.
-                start = max(self.ranges[i].start, other.ranges[j].start)
-                end = min(self.ranges[i].end, other.ranges[j].end)
-                ranges.append(DayRange(start, end))
-                # The range that ends earlier gets fully consumed
-                if self.ranges[i].end < other.ranges[j].end:
-                    i += 1
-                elif self.ranges[i].end > other.ranges[j].end:
-                    j += 1
-                else:  # Both end on the same day -> both consumed
-                    i += 1
-                    j += 1
-        return DayRangeSet(ranges)
+                j += 1
+        return DayRangeSet._from_ordinals(starts, ends)
 
     def subtract(self, other: 'DayRangeSet') -> 'DayRangeSet':
-        """Return a DateRangeSet that contains only days present in this set but not other."""
-        ranges = []
-        i, j = 0, 0
-        while i < len(self.ranges) and j < len(other.ranges):
-            if self.ranges[i].end < other.ranges[j].start:
-                ranges.append(self.ranges[i])  # our range is completely before the other --> keep it
-                i += 1
-            elif self.ranges[i].start > other.ranges[j].end:
-                j += 1  # our range is completely after the other
-            else:
-                # We have some sort of overlap.
-                start = self.ranges[i].start
-                for r in other.ranges[j:]:
-                    if start < r.start:
-                        # Keep part before overlapping range
-                        ranges.append(DayRange(start, r.start - datetime.timedelta(days=1)))
-                    start = r.end + datetime.timedelta(days=1)
-                    if start > self.ranges[i].end:
-                        break
-                if start <= self.ranges[i].end:
-                    # Keep any reminder
-                    ranges.append(DayRange(start, self.ranges[i].end))
-                i += 1  # our range is consumed, but the other range could still overlap the next one.
-        # Any ranges we haven't consumed yet can be kept
-        ranges.extend(self.ranges[i:])
-        return DayRangeSet(ranges)
+        """Return a DayRangeSet that contains only days present in this set but not other."""
+        starts, ends = [], []
+        j, count = 0, len(other._starts)
+        for start, end in zip(self._starts, self._ends):
+            while j < count and other._ends[j] < start:
+                j += 1  # The other range is completely before ours
+            while j < count and other._starts[j] <= end:
+                if start < other._starts[j]:
+                    # Keep the part before the overlapping range
+                    starts.append(start)
+                    ends.append(other._starts[j] - 1)
+                start = other._ends[j] + 1
+                if start > end:
+                    break  # The other range could still overlap our next one
+                j += 1
+            if start <= end:
+                # Keep any remainder
+                starts.append(start)
+                ends.append(end)
+        return DayRangeSet._from_ordinals(starts, ends)
+
+    def complement(self, within: DayRange) -> 'DayRangeSet':
+        """Return a DayRangeSet with the days within the given range that are not in this set."""
+        return DayRangeSet([within]).subtract(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, DayRangeSet):
+            return NotImplemented
+        return self._starts == other._starts and self._ends == other._ends
+
+    def __hash__(self):
+        return hash((tuple(self._starts), tuple(self._ends)))
 
     def __repr__(self):
         return f'DayRangeSet({repr(self.ranges)})'
 
 
+def ordered_map(fn: Callable[[Item], Result], items: Iterable[Item], concurrency: int = 1) -> Iterator[Result]:
+    """Like map(), but calls fn for up to concurrency items in parallel threads.
+
+    Results are still yielded in the order of the input. Only a bounded number of items is in flight at any time,
+    so a slow consumer or a huge input does not cause all results to pile up in memory."""
+    if concurrency <= 1:
+        yield from map(fn, items)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = collections.deque()
+        try:
+            for item in items:
+                # Keep twice as many items queued as there are workers, so the pool stays busy while
+                # we wait for the oldest one to complete.
+                if len(pending) >= 2 * concurrency:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(fn, item))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class LazyGroup(click.Group):
+    """A group that imports its commands only once they are used.
+
+    lazy_commands maps command names to "module:attribute" of the command. Listing the commands, e.g. for --help,
+    imports all of them."""
+    def __init__(self, *args, lazy_commands: Optional[Dict[str, str]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx: click.Context, name: str) -> Optional[click.Command]:
+        if name in self.lazy_commands and name not in self.commands:
+            module_name, attribute = self.lazy_commands[name].split(':')
+            self.add_command(getattr(importlib.import_module(module_name), attribute), name)
+        return super().get_command(ctx, name)
+
+
 class Installation:
     """CLI context for tracking the selected installation."""
     id: str
@@ -165,21 +276,31 @@ class Installation:
 
 class DataSelection:
     """CLI context for tracking the time-range of interest and available data."""
-    _session: Session
+    _session: 'Session'
     _installation_id: str
     _data_type: Optional[str]
     _date_from: Optional[str]
     _date_to: Optional[str]
     limit: int
-
-    def __init__(self, session: Session, installation_id: str, data_type: Optional[str],
-                 date_from: Optional[str], date_to: Optional[str], limit: int):
+    concurrency: int
+    weeks_fetched: int  # Weeks retrieved by fetch_consumption_data so far
+    points_written: int  # Values stored by the exporter
+    latest_timestamp: Optional[int]  # UNIX timestamp of the latest value retrieved or already exported
+
+    def __init__(self, session: 'Session', installation_id: str, data_type: Optional[str],
+                 date_from: Optional[str], date_to: Optional[str], limit: int, concurrency: int = 1,
+                 planner: Optional[FetchPlanner] = None):
         self._session = session
         self._installation_id = installation_id
         self._data_type = data_type
         self._date_from = date_from
         self._date_to = date_to
         self.limit = limit
+        self.concurrency = concurrency
+        self._planner = planner or FetchPlanner()
+        self.weeks_fetched = 0
+        self.points_written = 0
+        self.latest_timestamp = None
 
     @cached_property
     def _properties(self) -> List[IDProperty]:
@@ -199,6 +320,11 @@ class DataSelection:
         else:
             return 'PK_VERB_TAG_EDM'
 
+    @property
+    def known_data_type(self) -> Optional[str]:
+        """data_type if it is known without asking myEKZ, i.e. it was given or has been looked up already."""
+        return self._data_type or self.__dict__.get('data_type')
+
     @cached_property
     def property_key(self) -> str:
         # The type used in the API and the property key seem to differ by a PK_ prefix...
@@ -256,18 +382,83 @@ class DataSelection:
             return DayRangeSet([DayRange(parse_zrh_day(self.date_from), parse_zrh_day(self.date_to))])
 
         result = self.available_ranges
-        if result.ranges:
-            result = DayRangeSet(result.ranges +
-                                 # Make sure the corrections in date_to are also applied here.
-                                 [DayRange(result.end, parse_zrh_day(self.date_to))])
+        if not result.empty:
+            # Make sure the corrections in date_to are also applied here.
+            result = result.union(DayRangeSet([DayRange(result.end, parse_zrh_day(self.date_to))]))
         return result
 
-    def requested_weeks(self) -> Iterable[DayRange]:
-        """Convenience wrapper to iterate over the weeks in requested_ranges."""
-        if (len(self.requested_ranges.ranges) == 1 and
-                (self.requested_ranges.ranges[0].end - self.requested_ranges.ranges[0].start).days <= 7):
-            return [self.requested_ranges.ranges[0]]  # Requested a week or less, so just return that.
-        return itertools.islice(self.requested_ranges.get_covering_weeks(), self.limit)
+    def requested_windows(self, ranges: Optional[DayRangeSet] = None) -> Iterable[DayRange]:
+        """The windows to request to cover ranges, which defaults to requested_ranges.
+
+        Windows consist of whole weeks, up to as many as the FetchPlanner deems possible for the data type.
+        At most limit weeks are covered in total."""
+        if ranges is None:
+            ranges = self.requested_ranges
+            if len(ranges.ranges) == 1 and (ranges.ranges[0].end - ranges.ranges[0].start).days <= 7:
+                return [ranges.ranges[0]]  # Requested a week or less, so just return that.
+        return group_weeks(itertools.islice(ranges.get_covering_weeks(), self.limit),
+                           self._planner.window_weeks(self.data_type))
+
+    def fetch_consumption_data(self, windows: Iterable[DayRange]) -> Iterator[Tuple[DayRange, ConsumptionData]]:
+        """Retrieve consumption data for each of the windows, yielding (range, data) in chronological order.
+
+        Up to concurrency windows are retrieved in parallel over the shared session. If the API refuses or
+        truncates a window, it is split up and the parts are yielded individually."""
+        data_type = self.data_type  # Resolve before spawning workers, it might need an API call itself.
+        if self.concurrency > 1:
+            self._session.ensure_pool_size(self.concurrency)
+
+        def fetch(window: DayRange) -> List[Tuple[DayRange, ConsumptionData]]:
+            return self._fetch_window(data_type, window)
+
+        for window, d in itertools.chain.from_iterable(ordered_map(fetch, windows, self.concurrency)):
+            self.weeks_fetched += ((window.end - window.start).days + 7) // 7
+            self.observe_timestamp(_latest_timestamp(d))
+            yield window, d
+
+    def observe_timestamp(self, timestamp: Optional[int]):
+        """Update latest_timestamp with a UNIX timestamp of data that is available.
+
+        Exporters pass the latest timestamp they already have, so it is known even if nothing new is fetched."""
+        if timestamp is not None and (self.latest_timestamp is None or timestamp > self.latest_timestamp):
+            self.latest_timestamp = timestamp
+
+    def _fetch_window(self, data_type: str, window: DayRange) -> List[Tuple[DayRange, ConsumptionData]]:
+        import requests  # Already loaded by the session
+        weeks = (window.end - window.start).days // 7 + 1
+        try:
+            d = self._session.get_consumption_data(self._installation_id, data_type,
+                                                   format_api_date(window.start), format_api_date(window.end))
+        except requests.HTTPError as e:
+            status_code = e.response.status_code if e.response is not None else None
+            if weeks <= 1 or status_code not in WINDOW_TOO_LARGE_STATUS_CODES:
+                raise
+            # Presumably the window was too large, so try again with smaller ones.
+            self._planner.shrink(data_type, weeks // 2)
+            parts = group_weeks(DayRangeSet([window]).get_covering_weeks(), self._planner.window_weeks(data_type))
+            return [result for part in parts for result in self._fetch_window(data_type, part)]
+
+        last_day = _last_day_with_data(d)
+        if (weeks > 1 and last_day is not None and last_day < window.end - datetime.timedelta(days=6) and
+                window.end < datetime.date.today() - datetime.timedelta(days=7)):
+            # Data ends more than a week early for a window in the past. Either the API truncated the
+            # response or there simply is no data. Asking for the rest tells us which.
+            rest_start = last_day + datetime.timedelta(days=7 - last_day.weekday())
+            rest = self._fetch_window(data_type, DayRange(rest_start, window.end))
+            if any(_last_day_with_data(part) is not None for _, part in rest):
+                self._planner.shrink(data_type, (rest_start - window.start).days // 7)
+            return [(DayRange(window.start, rest_start - datetime.timedelta(days=1)), d)] + rest
+        return [(window, d)]
+
+
+def _latest_timestamp(data: ConsumptionData) -> Optional[int]:
+    timestamps = [v['timestamp'] for key in SERIES_KEYS for v in (data.get(key) or {}).get('values', [])]
+    return api_timestamp_to_epoch(max(timestamps)) if timestamps else None
+
+
+def _last_day_with_data(data: ConsumptionData) -> Optional[datetime.date]:
+    latest = _latest_timestamp(data)
+    return epoch_to_zrh_date(latest) if latest is not None else None
 
 
 class Leg:
@@ -278,7 +469,26 @@ class Leg:
         self.id = leg_id
 
 
-pass_session = click.make_pass_decorator(Session)
+def lazy_pass_decorator(module: str, name: str):
+    """Like click.make_pass_decorator, but the type is the attribute name of module, which is only imported when
+    the command runs."""
+    def decorator(f):
+        @functools.wraps(f)
+        def new_func(*args, **kwargs):
+            object_type = getattr(importlib.import_module(module, __package__), name)
+            ctx = click.get_current_context()
+            obj = ctx.find_object(object_type)
+            if obj is None:
+                raise RuntimeError(f'Managed to invoke callback without a context object of type {name} existing.')
+            return ctx.invoke(f, obj, *args, **kwargs)
+        return new_func
+    return decorator
+
+
+pass_session = lazy_pass_decorator('.session', 'Session')
+
+
 pass_installation = click.make_pass_decorator(Installation)
 pass_data = click.make_pass_decorator(DataSelection)
 pass_leg = click.make_pass_decorator(Leg)
+pass_cache = lazy_pass_decorator('.cache', 'ResponseCache')
@@ -0,0 +1,73 @@
+import datetime
+
+import click
+import pytest
+import requests
+
+from ekzexport.session import Session
+from ekzexport.timeutil import ZRH_TZ, UTC_TZ
+from ekzexport.util import DataSelection, Installation
+
+
+class FakeSession(Session):
+    """Serves hourly NT values of 1.0 for every requested day."""
+    def __init__(self):
+        super().__init__('user', 'password')
+        self.requests = []
+
+    def get_consumption_data(self, installation_id, data_type, date_from, date_to):
+        self.requests.append((date_from, date_to))
+        start = datetime.datetime.fromisoformat(date_from).replace(tzinfo=ZRH_TZ).astimezone(UTC_TZ)
+        end = (datetime.datetime.fromisoformat(date_to) + datetime.timedelta(days=1)).replace(tzinfo=ZRH_TZ)
+        values = []
+        while start < end:
+            values.append({'timestamp': int(start.strftime('%Y%m%d%H%M%S')), 'value': 1.0, 'status': 'VALID'})
+            start += datetime.timedelta(hours=1)
+        return {'seriesHt': {'values': []}, 'seriesNt': {'values': values}}
+
+
+class FailingSession(FakeSession):
+    """Like FakeSession, but fails with a 503 error for requests starting at fail_from."""
+    def __init__(self, fail_from: str):
+        super().__init__()
+        self.fail_from = fail_from
+
+    def get_consumption_data(self, installation_id, data_type, date_from, date_to):
+        if date_from == self.fail_from:
+            response = requests.Response()
+            response.status_code = 503
+            raise requests.HTTPError('503 Server Error', response=response)
+        return super().get_consumption_data(installation_id, data_type, date_from, date_to)
+
+
+@pytest.fixture
+def fake_session_class():
+    """FakeSession, for tests that need to change some of its answers."""
+    return FakeSession
+
+
+@pytest.fixture
+def fake_session():
+    return FakeSession()
+
+
+@pytest.fixture
+def failing_session():
+    """A FakeSession that fails when asked for the week starting 2024-01-15."""
+    return FailingSession('2024-01-15')
+
+
+def _run_exporter(cli: click.Command, session: Session, date_from: str, date_to: str,
+                  data_type: str = 'PK_VERB_TAG_EDM', installation_id: str = '1', limit: int = 100, **kwargs):
+    data = DataSelection(session, installation_id, data_type, date_from, date_to, limit)
+    with click.Context(cli, obj=session) as ctx:
+        with click.Context(cli, parent=ctx, obj=Installation(installation_id)) as ctx:
+            with click.Context(cli, parent=ctx, obj=data) as ctx:
+                ctx.invoke(cli, **kwargs)
+
+
+@pytest.fixture
+def run_exporter():
+    """Invoke an installation data command like the CLI does, i.e. with the session, installation and data
+    selection in its context. Further keyword arguments are passed to the command."""
+    return _run_exporter
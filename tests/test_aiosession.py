@@ -0,0 +1,117 @@
+import asyncio
+
+import pyotp
+import pytest
+
+httpx = pytest.importorskip('httpx')
+
+from ekzexport.aiosession import AsyncSession
+from ekzexport.sessionstore import SessionStore
+
+BASE = 'https://my.ekz.ch'
+AUTH = 'https://login.ekz.ch/auth/realms/myEKZ/login-actions/authenticate'
+SECRET = pyotp.random_base32()
+
+
+def _mock_myekz(requests, second_factor='otp'):
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append((request.method, request.url.path))
+        logged_in = 'session=1' in request.headers.get('cookie', '')
+        if request.url.path == '/nutzerdaten/':
+            if logged_in:
+                return httpx.Response(200, text='Nutzerdaten')
+            return httpx.Response(200, text=f'<form id="kc-form-login" action="{AUTH}?step=1"></form>')
+        if str(request.url) == f'{AUTH}?step=1':
+            return httpx.Response(200, text=f'<form id="kc-{second_factor}-login-form" action="{AUTH}?step=2"></form>')
+        if str(request.url) == f'{AUTH}?step=2':
+            assert pyotp.TOTP(SECRET).verify(dict(httpx.QueryParams(request.content.decode()))['otp'])
+            return httpx.Response(302, headers={'Location': f'{BASE}/callback'})
+        if request.url.path == '/callback':
+            return httpx.Response(302, headers={'Location': f'{BASE}/nutzerdaten/', 'Set-Cookie': 'session=1'})
+        if request.url.path.startswith('/api/portal-services/') and logged_in:
+            if request.url.path.endswith('/csrf/v1/token'):
+                return httpx.Response(200, json={'token': 'abc'})
+            if request.url.path.endswith('/leg-headers'):
+                return httpx.Response(200, json={'legHeaders': [{'legId': '1', 'description': 'LEG'}]})
+            return httpx.Response(200, json={'from': request.url.params.get('from')})
+        if request.url.path.startswith('/api/portal-services/'):
+            return httpx.Response(302, headers={'Location': 'https://login.ekz.ch/auth/realms/myEKZ/protocol'})
+        if request.url.path == '/auth/realms/myEKZ/protocol':
+            return httpx.Response(200, text=f'<form id="kc-form-login" action="{AUTH}?step=1"></form>')
+        if request.url.path == '/logout':
+            return httpx.Response(200)
+        return httpx.Response(404)
+    return httpx.MockTransport(handler)
+
+
+def test_concurrent_calls_share_login():
+    requests = []
+
+    async def run():
+        async with AsyncSession('user', 'password', SECRET, transport=_mock_myekz(requests)) as session:
+            results = await asyncio.gather(*(
+                session.get_consumption_data('1', 'PK_VERB_15MIN', f'2024-01-0{i}', f'2024-01-0{i}')
+                for i in range(1, 6)))
+            legs = await session.get_legs()
+        return results, legs
+
+    results, legs = asyncio.run(run())
+    assert [r['from'] for r in results] == [f'2024-01-0{i}' for i in range(1, 6)]
+    assert legs == [{'legId': '1', 'description': 'LEG'}]
+    # A single login: login page, credentials, OTP and the redirects back to the original page
+    assert [r for r in requests if not r[1].startswith('/api/')][:5] == [
+        ('GET', '/nutzerdaten/'),
+        ('POST', '/auth/realms/myEKZ/login-actions/authenticate'),
+        ('POST', '/auth/realms/myEKZ/login-actions/authenticate'),
+        ('GET', '/callback'),
+        ('GET', '/nutzerdaten/'),
+    ]
+    assert len(requests) == 5 + 5 + 1 + 2  # login, consumption data, legs, csrf token and logout
+    assert requests[-1] == ('POST', '/logout')
+
+
+def test_missing_otp_token():
+    async def run():
+        async with AsyncSession('user', 'password', transport=_mock_myekz([])) as session:
+            await session.get_legs()
+
+    with pytest.raises(Exception, match='no token was provided'):
+        asyncio.run(run())
+
+
+def test_sms_2fa_is_refused():
+    async def run():
+        async with AsyncSession('user', 'password', transport=_mock_myekz([], 'sms-code')) as session:
+            await session.get_legs()
+
+    with pytest.raises(Exception, match='code sent by SMS, which is not supported'):
+        asyncio.run(run())
+
+
+def test_stored_session_reused_and_renewed(tmp_path):
+    requests = []
+    store = SessionStore('user', BASE, str(tmp_path))
+
+    async def run():
+        async with AsyncSession('user', 'password', SECRET, store=store, transport=_mock_myekz(requests)) as session:
+            await session.get_legs()
+
+    asyncio.run(run())
+    assert ('GET', '/nutzerdaten/') in requests and ('POST', '/logout') not in requests
+
+    # The second run reuses the stored session without any login
+    requests.clear()
+    asyncio.run(run())
+    assert requests == [('GET', '/api/portal-services/leg-manager-dashboard/v1/leg-headers')]
+
+    # If the session expired, the API call ends up on the login page and we transparently login again
+    with open(store.path) as f:
+        expired = f.read().replace('"value": "1"', '"value": "0"')
+    with open(store.path, 'w') as f:
+        f.write(expired)
+    requests.clear()
+    asyncio.run(run())
+    assert requests[:3] == [('GET', '/api/portal-services/leg-manager-dashboard/v1/leg-headers'),
+                            ('GET', '/auth/realms/myEKZ/protocol'),
+                            ('GET', '/nutzerdaten/')]
+    assert requests[-1] == ('GET', '/api/portal-services/leg-manager-dashboard/v1/leg-headers')
@@ -0,0 +1,55 @@
+import datetime
+
+from ekzexport.cache import ResponseCache, is_final
+
+
+def _data(status='VALID', n=4):
+    values = [{'value': i / 10, 'timestamp': 20240101000000 + i * 1500, 'date': '01.01.2024',
+               'time': '00:00', 'status': status} for i in range(n)]
+    return {'seriesHt': {'values': values}, 'seriesNt': {'values': []}}
+
+
+def test_is_final():
+    today = datetime.date(2024, 3, 1)
+    assert is_final(_data(), '2024-01-07', today, 14)
+    assert not is_final(_data(), '2024-02-25', today, 14)  # Too recent, could still be corrected
+    assert not is_final(_data('ESTIMATED'), '2024-01-07', today, 14)
+    assert not is_final(_data(n=0), '2024-01-07', today, 14)  # Data might still appear
+
+
+def test_only_final_responses_are_cached(tmp_path):
+    with ResponseCache(str(tmp_path / 'cache.sqlite')) as cache:
+        cache.put('1', 'PK_VERB_15MIN', '2024-01-01', '2024-01-07', _data())
+        assert cache.get('1', 'PK_VERB_15MIN', '2024-01-01', '2024-01-07') == _data()
+        assert cache.get('2', 'PK_VERB_15MIN', '2024-01-01', '2024-01-07') is None
+        assert cache.get('1', 'PK_VERB_TAG_EDM', '2024-01-01', '2024-01-07') is None
+
+        cache.put('1', 'PK_VERB_15MIN', '2024-01-08', '2024-01-14', _data('ESTIMATED'))
+        assert cache.get('1', 'PK_VERB_15MIN', '2024-01-08', '2024-01-14') is None
+
+        today = datetime.date.today().isoformat()
+        cache.put('1', 'PK_VERB_15MIN', today, today, _data())
+        assert cache.get('1', 'PK_VERB_15MIN', today, today) is None
+
+        assert cache.stats() == {'entries': 1, 'bytes': cache.stats()['bytes'], 'installations': 1,
+                                 'oldest_day': '2024-01-01', 'newest_day': '2024-01-07'}
+
+
+def test_eviction(tmp_path):
+    with ResponseCache(str(tmp_path / 'cache.sqlite')) as cache:
+        for week in range(1, 5):
+            cache.put('1', 'PK_VERB_15MIN', f'2023-0{week}-01', f'2023-0{week}-07', _data(n=200))
+        entry_size = cache.stats()['bytes'] // 4
+        cache.get('1', 'PK_VERB_15MIN', '2023-01-01', '2023-01-07')  # Mark the oldest entry as recently used
+
+        assert cache.prune(max_bytes=2 * entry_size) == 2
+        assert cache.stats()['entries'] == 2
+        assert cache.get('1', 'PK_VERB_15MIN', '2023-01-01', '2023-01-07') is not None
+        assert cache.get('1', 'PK_VERB_15MIN', '2023-04-01', '2023-04-07') is not None
+
+        cache.max_bytes = entry_size  # Putting new data also enforces the limit
+        cache.put('1', 'PK_VERB_15MIN', '2023-05-01', '2023-05-07', _data(n=200))
+        assert cache.stats()['entries'] == 1
+
+        assert cache.prune(max_bytes=0) == 1
+        assert cache.stats()['entries'] == 0
@@ -0,0 +1,182 @@
+import datetime
+import json
+import random
+import subprocess
+import sys
+import time
+
+import click
+import pytest
+
+from click.testing import CliRunner
+from ekzexport.cli import (cli, daemon, export_all, load_daemon_jobs, next_run_delay, select_installations,
+                           show_installation_data)
+from ekzexport.cache import DEFAULT_MAX_BYTES
+from ekzexport.exporters.csv import read_csv
+
+
+def _contract(anlage, einzdat, auszdat=None):
+    return {'anlage': anlage, 'einzdat': einzdat, 'auszdat': auszdat}
+
+
+@pytest.fixture
+def contracts_session(fake_session_class):
+    class ContractsSession(fake_session_class):
+        def __init__(self, contracts):
+            super().__init__()
+            self.installation_selection_data = {'contracts': contracts}
+
+        def get_consumption_data(self, installation_id, data_type, date_from, date_to):
+            if installation_id == 'broken':
+                raise ValueError('no data')
+            return super().get_consumption_data(installation_id, data_type, date_from, date_to)
+    return ContractsSession
+
+
+def test_select_installations(contracts_session):
+    session = contracts_session([_contract('1', '2020-01-01', '2022-06-30'), _contract('2', '2022-07-01'),
+                                _contract('2', '2022-07-01'), _contract('3', '2024-01-01')])
+    assert select_installations(session) == ['1', '2', '3']
+    assert select_installations(session, moved_in_before=datetime.date(2023, 1, 1)) == ['1', '2']
+    assert select_installations(session, moved_out_after=datetime.date(2023, 1, 1)) == ['2', '3']
+
+
+def test_export_all(tmp_path, capsys, contracts_session):
+    session = contracts_session([_contract('1', '2020-01-01'), _contract('broken', '2020-01-01'),
+                                 _contract('3', '2020-01-01')])
+    args = ['-f', str(tmp_path / 'data-{installation}.csv')]
+    with click.Context(cli, obj=session) as ctx:
+        with pytest.raises(click.ClickException, match='Export failed for 1 of 3 installations'):
+            ctx.invoke(export_all, data_type='PK_VERB_TAG_EDM', date_from='2024-01-01', date_to='2024-01-14',
+                       limit=4, concurrency=1, workers=2, moved_in_before=None, moved_out_after=None,
+                       exporter='csv', args=tuple(args))
+
+    assert len(read_csv(str(tmp_path / 'data-1.csv'))) == len(read_csv(str(tmp_path / 'data-3.csv'))) == 14 * 24
+    assert not (tmp_path / 'data-broken.csv').exists()
+    summary = capsys.readouterr().out
+    assert 'broken' in summary and 'ValueError' in summary
+    assert summary.count('336') == 2  # Points written
+
+
+@pytest.fixture
+def show_session(fake_session_class, capsys):
+    class ShowSession(fake_session_class):
+        """Puts every other hour in HT and remembers what had been printed before each request."""
+        def __init__(self):
+            super().__init__()
+            self.printed = []
+
+        def get_consumption_data(self, installation_id, data_type, date_from, date_to):
+            self.printed.append(capsys.readouterr().out)
+            values = super().get_consumption_data(installation_id, data_type, date_from, date_to)['seriesNt']['values']
+            return {'seriesHt': {'values': values[1::2]}, 'seriesNt': {'values': values[::2]}}
+    return ShowSession()
+
+
+@pytest.mark.parametrize('output_format', ['jsonl', 'csv', 'tsv'])
+def test_show_streams_formats(capsys, show_session, run_exporter, output_format):
+    session = show_session
+    run_exporter(show_installation_data, session, '2024-01-01', '2024-01-14', data_type='PK_VERB_15MIN', limit=4,
+                 output_format=output_format)
+    lines = (''.join(session.printed) + capsys.readouterr().out).splitlines()
+
+    # The first week is printed before the second one is requested
+    assert len(session.printed) == 2 and session.printed[1].count('\n') == 7 * 24
+    if output_format == 'jsonl':
+        rows = [json.loads(line) for line in lines]
+    else:
+        delimiter = ',' if output_format == 'csv' else '\t'
+        assert lines[0] == delimiter.join(['time', 'kwh', 'tariff', 'status'])
+        rows = [dict(zip(lines[0].split(delimiter), line.split(delimiter))) for line in lines[1:]]
+    assert len(rows) == 14 * 24
+    assert rows[0] == {'time': '2024-01-01T00:00:00+01:00', 'kwh': 1.0 if output_format == 'jsonl' else '1.0',
+                       'tariff': 'NT', 'status': 'VALID'}
+    assert rows[1]['time'] == '2024-01-01T01:00:00+01:00' and rows[1]['tariff'] == 'HT'
+    assert [row['time'] for row in rows] == sorted(row['time'] for row in rows)
+
+
+def test_show_table(capsys, show_session, run_exporter):
+    run_exporter(show_installation_data, show_session, '2024-01-01', '2024-01-14', limit=4, output_format='table')
+    out = capsys.readouterr().out
+    assert '01.01.2024 00:00' in out and '14.01.2024 23:00' in out
+    assert out.count('HT') == out.count('NT') == 7 * 24
+
+
+def test_daemon(tmp_path, monkeypatch, fake_session_class):
+    class GrowingSession(fake_session_class):
+        """Data becomes available one more week with every run."""
+        def __init__(self):
+            super().__init__()
+            self.until = datetime.date(2024, 1, 14)
+
+        def get_installation_data(self, installation_id):
+            return {'status': [{'property': 'VERB_TAG_EDM', 'ab': '2024-01-01', 'bis': self.until.isoformat()}]}
+
+    jobs = tmp_path / 'jobs.json'
+    jobs.write_text(json.dumps([{'installation': '1', 'exporter': 'csv', 'args': ['-f', str(tmp_path / 'data.csv')],
+                                 'type': 'PK_VERB_TAG_EDM', 'limit': 52}]))
+    session = GrowingSession()
+    delays = []
+
+    def sleep(seconds):
+        delays.append(seconds)
+        session.until += datetime.timedelta(days=7)
+    monkeypatch.setattr(time, 'sleep', sleep)
+
+    with click.Context(cli, obj=session) as ctx:
+        ctx.invoke(daemon, jobs_file=str(jobs), interval=3600, jitter=300, min_interval=3500, runs=3)
+    assert len(delays) == 2 and all(3400 < d <= 3900 for d in delays)
+    # After the initial export, only the latest week is retrieved
+    assert session.requests == [('2024-01-01', '2024-01-14'), ('2024-01-15', '2024-01-21'),
+                                ('2024-01-22', '2024-01-28')]
+    assert len(read_csv(str(tmp_path / 'data.csv'))) == 28 * 24
+
+
+def test_load_daemon_jobs_validates(tmp_path):
+    jobs = tmp_path / 'jobs.json'
+    jobs.write_text(json.dumps([{'installation': '1', 'exporter': 'csv'}]))
+    with pytest.raises(click.BadParameter, match='Invalid job #1'):
+        load_daemon_jobs(str(jobs))
+
+
+def test_next_run_delay():
+    rng = random.Random(1)
+    delays = [next_run_delay(3600, 300, 900, 100, rng) for _ in range(100)]
+    assert all(3200 <= d <= 3800 for d in delays)
+    assert next_run_delay(600, 300, 900, 100, rng) == 800
+    assert next_run_delay(600, 300, 900, 1000, rng) == 0
+
+
+# Modules that are slow to import and only needed by some commands
+HEAVY_MODULES = {'requests', 'rich', 'bs4', 'pyotp', 'influxdb_client', 'pyarrow', 'sqlite3', 'cProfile',
+                 'concurrent.futures', 'ekzexport.session', 'ekzexport.cache', 'ekzexport.metrics',
+                 'ekzexport.exporters.csv', 'ekzexport.exporters.influxdb', 'ekzexport.exporters.parquet',
+                 'ekzexport.exporters.sqlite'}
+
+
+def _imported_modules(*args):
+    """Modules imported by running the CLI with args in a fresh interpreter."""
+    code = ('import sys\nfrom ekzexport.cli import cli\ncli.main(sys.argv[1:], standalone_mode=False)\n'
+            'print(*sys.modules, file=sys.stderr)')
+    result = subprocess.run([sys.executable, '-c', code] + list(args), capture_output=True, text=True, check=True)
+    return set(result.stderr.split())
+
+
+def test_help_imports_no_heavy_modules():
+    assert not HEAVY_MODULES & _imported_modules('--help')
+
+
+def test_exporters_are_imported_when_used():
+    modules = _imported_modules('--user', 'user', '--password', 'password',
+                                'installation', '1', 'data', 'export', 'sqlite', '--help')
+    assert {'requests', 'ekzexport.session', 'ekzexport.exporters.sqlite'} <= modules
+    assert not {'ekzexport.exporters.influxdb', 'influxdb_client', 'ekzexport.exporters.parquet', 'pyarrow'} & modules
+    # The response cache is only opened with --cache
+    assert not {'sqlite3', 'ekzexport.cache'} & _imported_modules('--user', 'user', '--password', 'password',
+                                                                  'installation', '1', 'data', 'export', 'csv',
+                                                                  '--help')
+
+
+def test_cache_size_help_matches_default():
+    output = ' '.join(CliRunner().invoke(cli, ['--help']).output.split())  # Undo the line wrapping
+    assert f'Defaults to {DEFAULT_MAX_BYTES // 1024 // 1024} MB.' in output
@@ -0,0 +1,120 @@
+import datetime
+import tracemalloc
+
+from ekzexport.exporters.csv import (cli, read_csv, read_last_row, read_present_days, write_csv, append_rows,
+                                     decode_rows, encode_rows, iter_rows, merge_rows, write_rows,
+                                     _add_to_file)
+from ekzexport.timeseries import TimeSeries
+from ekzexport.timeutil import ZRH_TZ, UTC_TZ, convert_zrh_datetime_sequence
+from ekzexport.util import DayRange
+
+CSV_HEADER = 'sep=;\nZeitraum;HT [kWh];NT [kWh]\n'
+
+
+def _write(path, rows):
+    path.write_text(CSV_HEADER + ''.join(f'{r}\n' for r in rows))
+
+
+def test_read_last_row_in_repeated_hour(tmp_path):
+    path = tmp_path / 'data.csv'
+    _write(path, ['29.10.2023 01:45;1;', '29.10.2023 02:00;2;', '29.10.2023 02:45;3;',
+                  '29.10.2023 02:00;4;', '29.10.2023 02:15;5;'])
+    last = read_last_row(str(path), chunk_size=90)
+    assert last == (1698542100, 5.0, None)
+    assert read_csv(str(path))[-1]['time'].timestamp() == 1698542100
+
+
+def test_read_present_days(tmp_path):
+    path = tmp_path / 'data.csv'
+    _write(path, ['01.01.2024 00:00;1;', '01.01.2024 12:00;;2', '02.01.2024 00:00;;',
+                  '03.01.2024 00:00;;1', '04.01.2024 00:00;1;'])
+    assert read_present_days(str(path)).ranges == [
+        DayRange(datetime.date(2024, 1, 1), datetime.date(2024, 1, 1)),
+        DayRange(datetime.date(2024, 1, 3), datetime.date(2024, 1, 4))]
+    assert read_present_days(str(tmp_path / 'missing.csv')).empty
+
+
+def test_write_and_append(tmp_path):
+    path = tmp_path / 'data.csv'
+    t = datetime.datetime(2024, 1, 1, tzinfo=ZRH_TZ)
+    write_csv(str(path), [{'time': t, 'ht': 1.0, 'nt': None}])
+    assert path.read_text() == CSV_HEADER + '01.01.2024 00:00;1.0;\n'
+    assert list(tmp_path.iterdir()) == [path]
+
+    path.write_text(path.read_text().rstrip('\n'))
+    append_rows(str(path), [(int(t.timestamp()) + 3600, None, 2.0)])
+    assert path.read_text() == CSV_HEADER + '01.01.2024 00:00;1.0;\n01.01.2024 01:00;;2.0\n'
+
+
+def test_merge_rows():
+    existing = [(0, 1.0, None), (900, None, 2.0), (2700, 3.0, None)]
+    new = [(900, 5.0, None), (1800, None, 6.0), (2700, 7.0, 8.0), (3600, 9.0, None)]
+    expected = TimeSeries.from_rows(existing)
+    expected.upsert(TimeSeries.from_rows(new))
+    assert list(merge_rows(iter(existing), iter(new))) == list(expected.rows()) == [
+        (0, 1.0, None), (900, 5.0, 2.0), (1800, None, 6.0), (2700, 7.0, 8.0), (3600, 9.0, None)]
+    assert list(merge_rows([], new)) == new
+    assert list(merge_rows(existing, [])) == existing
+
+
+def test_merge_memory_does_not_depend_on_file_size(tmp_path):
+    start = int(datetime.datetime(2020, 1, 1, tzinfo=UTC_TZ).timestamp())
+    gap = TimeSeries.from_rows((start + i * 3600, None, 0.2) for i in range(1000, 1024))
+
+    def peak_memory(years):
+        path = str(tmp_path / f'{years}.csv')
+        # Hourly values, without the repeated hour when switching to winter time which hourly rows cannot express
+        epochs = [start + i * 3600 for i in range(years * 365 * 24) if not 1000 <= i < 1024]
+        write_rows(path, ((epoch, 0.1, None) for epoch in epochs
+                          if not datetime.datetime.fromtimestamp(epoch, ZRH_TZ).fold))
+        rows = sum(1 for _ in iter_rows(path))
+        tracemalloc.start()
+        _add_to_file(path, gap, epochs[-1])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert sum(1 for _ in iter_rows(path)) == rows + len(gap)
+        return peak
+
+    small, large = peak_memory(1), peak_memory(4)
+    assert large < 256 * 1024
+    assert large < small * 1.5
+
+
+def test_export_appends_and_backfills(tmp_path, fake_session, run_exporter):
+    path = tmp_path / 'data.csv'
+    session = fake_session
+    run_exporter(cli, session, '2024-01-08', '2024-01-10', filename=str(path))
+    assert len(read_csv(str(path))) == 7 * 24  # Data is always retrieved for whole weeks
+
+    # Only the new days get added, which happens by appending
+    before = path.read_text()
+    run_exporter(cli, session, '2024-01-08', '2024-01-16', filename=str(path))
+    assert path.read_text().startswith(before)
+    assert len(read_csv(str(path))) == 14 * 24
+
+    # Backfilling earlier data requires merging it in before the existing data
+    run_exporter(cli, session, '2024-01-03', '2024-01-16', filename=str(path))
+    datapoints = read_csv(str(path))
+    assert len(datapoints) == 21 * 24
+    assert [dp['time'] for dp in datapoints] == sorted(dp['time'] for dp in datapoints)
+    assert session.requests == [('2024-01-08', '2024-01-14'), ('2024-01-15', '2024-01-21'),
+                                ('2024-01-01', '2024-01-07')]
+
+
+def test_codec_matches_datetime_parsing():
+    # A year of 15 minute values, so both DST transitions are included
+    start = datetime.datetime(2023, 1, 1, tzinfo=UTC_TZ)
+    times = [start + datetime.timedelta(minutes=15 * i) for i in range(365 * 96)]
+    lines = [t.astimezone(ZRH_TZ).strftime('%d.%m.%Y %H:%M') + f';{i % 7 or ""};{i % 5 or ""}'
+             for i, t in enumerate(times)]
+
+    expected = list(convert_zrh_datetime_sequence(lines, lambda x: x.split(';')[0], lambda dt, x: int(dt.timestamp())))
+    rows = list(decode_rows(lines))
+    assert [r[0] for r in rows] == expected == [int(t.timestamp()) for t in times]
+    assert rows[1] == (expected[1], 1.0, 1.0)
+    assert rows[5] == (expected[5], 5.0, None)
+
+    # Values are written as floats, but otherwise the rows are identical
+    assert list(encode_rows(rows)) == [
+        f"{t.astimezone(ZRH_TZ).strftime('%d.%m.%Y %H:%M')};{float(i % 7) or ''};{float(i % 5) or ''}\n"
+        for i, t in enumerate(times)]
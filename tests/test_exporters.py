@@ -0,0 +1,38 @@
+import datetime
+
+import pytest
+import requests
+
+from ekzexport.util import DayRange, DayRangeSet
+
+
+def _csv(tmp_path):
+    from ekzexport.exporters import csv
+    path = str(tmp_path / 'data.csv')
+    return csv.cli, {'filename': path}, lambda: csv.read_present_days(path)
+
+
+def _sqlite(tmp_path):
+    from ekzexport.exporters import sqlite
+    path = str(tmp_path / 'data.sqlite')
+    return sqlite.cli, {'filename': path}, lambda: sqlite.read_present_days(sqlite.connect(path), '1', 'PK_VERB_15MIN')
+
+
+def _parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+    from ekzexport.exporters import parquet
+    directory = str(tmp_path / 'data')
+
+    def read_present_days():
+        return DayRangeSet([r for path in parquet.list_partitions(directory)
+                            for r in parquet.read_partition_info(path)['present_days'].ranges])
+    return parquet.cli, {'directory': directory, 'compression': 'zstd'}, read_present_days
+
+
+@pytest.mark.parametrize('exporter', [_csv, _sqlite, _parquet])
+def test_export_keeps_retrieved_weeks_on_failure(tmp_path, failing_session, run_exporter, exporter):
+    cli, kwargs, read_present_days = exporter(tmp_path)
+    with pytest.raises(requests.HTTPError):
+        # 15 minute data is fetched week by week, the third week fails
+        run_exporter(cli, failing_session, '2024-01-01', '2024-01-21', data_type='PK_VERB_15MIN', **kwargs)
+    assert read_present_days().ranges == [DayRange(datetime.date(2024, 1, 1), datetime.date(2024, 1, 14))]
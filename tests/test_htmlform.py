@@ -0,0 +1,99 @@
+import os.path
+
+import pyotp
+import pytest
+
+from ekzexport.htmlform import find_form
+from ekzexport.session import login_flow
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+BASE = 'https://my.ekz.ch'
+ACTIONS = 'https://login.ekz.ch/auth/realms/myEKZ/login-actions'
+LOGIN_PAGE = 'https://login.ekz.ch/auth/realms/myEKZ/protocol/openid-connect/auth?client_id=cos-myekz-webapp'
+
+
+def _fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def test_find_form():
+    login = _fixture('login.html')
+    form = find_form(login, {'kc-form-login'})
+    assert form['action'] == (f'{ACTIONS}/authenticate?session_code=kR2v8tYqUe0nX3mB1cZl9wHs4DfG7jPa'
+                              '&execution=8c1e2f57-3b0a-4c4f-9b8e-2f5d6a7c9e01&client_id=cos-myekz-webapp'
+                              '&tab_id=Wv3Jb0nZ6aQ')
+    assert form['method'] == 'post'
+    assert find_form(login, {'kc-otp-login-form'}) is None
+    assert find_form(login)['id'] == 'kc-form-login'
+
+    assert find_form(_fixture('otp.html'), {'kc-sms-code-login-form', 'kc-otp-login-form'})['id'] == \
+        'kc-otp-login-form'
+    assert find_form(_fixture('sms.html'), {'kc-sms-resend-form', 'kc-sms-code-login-form'})['id'] == \
+        'kc-sms-code-login-form'
+    assert 'execution=ensu_mobile_number_config' in find_form(_fixture('mobile_number.html'))['action']
+    assert find_form(_fixture('maintenance.html')) is None
+
+
+def test_find_form_markup():
+    assert find_form('<script>var f = "<form id=\'x\' action=\'script\'>";</script><form id="x" action="page">',
+                     {'x'})['action'] == 'page'
+    assert find_form('<FORM ID=x ACTION=/a?b=1&amp;c=2 novalidate>', {'x'}) == \
+        {'id': 'x', 'action': '/a?b=1&c=2', 'novalidate': None}
+    assert find_form('<form id="x" action="a">', {'y'}) is None
+    assert find_form('') is None
+
+
+def _login(responses, token='', sms_code=None):
+    """Run login_flow, answering its requests with the given (url, text) responses, and return the requests."""
+    flow = login_flow(BASE, 'user', 'password', token, sms_code)
+    requests = [next(flow)]
+    for response in responses:
+        try:
+            requests.append(flow.send(response))
+        except StopIteration:
+            return requests
+    raise AssertionError('Login did not finish')
+
+
+def test_login_flow_with_fixtures():
+    requests = _login([(LOGIN_PAGE, _fixture('login.html')), (f'{BASE}/nutzerdaten/', 'Nutzerdaten')])
+    assert [(method, url.split('?')[0], data) for method, url, data in requests] == [
+        ('GET', f'{BASE}/nutzerdaten/', None),
+        ('POST', f'{ACTIONS}/authenticate', {'username': 'user', 'password': 'password'}),
+    ]
+
+    secret = pyotp.random_base32()
+    requests = _login([(LOGIN_PAGE, _fixture('login.html')),
+                       (f'{ACTIONS}/authenticate?execution=otp', _fixture('otp.html')),
+                       (f'{BASE}/nutzerdaten/', 'Nutzerdaten')], token=secret)
+    method, url, data = requests[-1]
+    assert url == find_form(_fixture('otp.html'))['action']
+    assert pyotp.TOTP(secret).verify(data['otp'])
+
+    requests = _login([(LOGIN_PAGE, _fixture('login.html')),
+                       (f'{ACTIONS}/authenticate?execution=sms', _fixture('sms.html')),
+                       (f'{BASE}/nutzerdaten/', 'Nutzerdaten')], sms_code=lambda: '123456')
+    assert requests[-1] == ('POST', find_form(_fixture('sms.html'), {'kc-sms-code-login-form'})['action'],
+                            {'code': '123456'})
+
+    requests = _login([(LOGIN_PAGE, _fixture('login.html')),
+                       (f'{ACTIONS}/required-action?execution=ensu_mobile_number_config&client_id=cos-myekz-webapp',
+                        _fixture('mobile_number.html')),
+                       (f'{BASE}/nutzerdaten/', 'Nutzerdaten')])
+    assert requests[-1] == ('POST', find_form(_fixture('mobile_number.html'))['action'],
+                            {'mobile_number': '', 'cancel': 'Später einrichten'})
+
+
+def test_login_flow_errors():
+    with pytest.raises(Exception, match='offline for maintenance'):
+        _login([(f'{BASE}/nutzerdaten/', _fixture('maintenance.html'))])
+    with pytest.raises(Exception, match='Login form not found'):
+        _login([(f'{BASE}/nutzerdaten/', _fixture('mobile_number.html'))])
+    with pytest.raises(Exception, match='code sent by SMS, which is not supported'):
+        _login([(LOGIN_PAGE, _fixture('login.html')), (f'{ACTIONS}/authenticate', _fixture('sms.html'))])
+    with pytest.raises(Exception, match='no token was provided'):
+        _login([(LOGIN_PAGE, _fixture('login.html')), (f'{ACTIONS}/authenticate', _fixture('otp.html'))])
+    with pytest.raises(Exception, match='expects something we can'):
+        # Wrong password, so the login form is shown again
+        _login([(LOGIN_PAGE, _fixture('login.html')), (f'{ACTIONS}/authenticate', _fixture('login.html'))])
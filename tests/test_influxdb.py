@@ -0,0 +1,65 @@
+import datetime
+
+import pytest
+
+from ekzexport.exporters.influxdb import line_protocol, read_complete_days
+from ekzexport.timeseries import TimeSeries
+from ekzexport.timeutil import zrh_day_start
+from ekzexport.util import DayRange, DayRangeSet
+
+
+def _normalize(line):
+    # Point sorts fields by name, which doesn't matter to InfluxDB
+    head, fields, time = line.rsplit(' ', 2)
+    return head, sorted(fields.split(',')), time
+
+
+def test_line_protocol_matches_point():
+    influxdb_client = pytest.importorskip('influxdb_client')
+    Point, WritePrecision = influxdb_client.Point, influxdb_client.WritePrecision
+
+    series = TimeSeries.from_rows([(1704063600, 1.0, None), (1704064500, 0.125, 2.5), (1704065400, None, 3.0)])
+    lines = list(line_protocol('ekz energy', 'energy,15=min', series))
+    expected = [Point('ekz energy').time(epoch, WritePrecision.S).field('energy,15=min', value)
+                .field('niedertarif', niedertarif).to_line_protocol()
+                for epoch, ht, nt in series.rows()
+                for niedertarif, value in ((False, ht), (True, nt)) if value is not None]
+    assert len(lines) == 4
+    assert [_normalize(line) for line in lines] == [_normalize(line) for line in expected]
+
+
+class _FakeQueryApi:
+    def __init__(self, counts):
+        self.counts = counts
+        self.queries = []
+
+    def query(self, query):
+        from influxdb_client.client.flux_table import FluxRecord, FluxTable
+        self.queries.append(query)
+        table = FluxTable()
+        for day, count in self.counts.items():
+            start = datetime.datetime.fromtimestamp(zrh_day_start(day), datetime.timezone.utc)
+            table.records.append(FluxRecord(0, {'_time': start, '_value': count}))
+        return [table]
+
+
+def test_read_complete_days():
+    pytest.importorskip('influxdb_client')
+    query_api = _FakeQueryApi({
+        datetime.date(2024, 3, 29): 96,
+        datetime.date(2024, 3, 30): 95,  # Missing a value
+        datetime.date(2024, 3, 31): 92,  # Switch to summer time
+        datetime.date(2024, 4, 1): 96,
+        datetime.date(2024, 4, 3): 96,
+    })
+    ranges = DayRangeSet([DayRange(datetime.date(2024, 3, 25), datetime.date(2024, 4, 7))])
+    complete = read_complete_days(query_api, 'bucket', 'ekz_energy', 'energy_15min', 'PK_VERB_15MIN', ranges)
+    assert complete.ranges == [DayRange(datetime.date(2024, 3, 29), datetime.date(2024, 3, 29)),
+                               DayRange(datetime.date(2024, 3, 31), datetime.date(2024, 4, 1)),
+                               DayRange(datetime.date(2024, 4, 3), datetime.date(2024, 4, 3))]
+    assert 'range(start: 2024-03-24T23:00:00Z, stop: 2024-04-07T22:00:00Z)' in query_api.queries[0]
+
+    # A single value per day is complete for daily data
+    query_api = _FakeQueryApi({datetime.date(2024, 3, 30): 1})
+    complete = read_complete_days(query_api, 'bucket', 'ekz_energy', 'energy_15min', 'PK_VERB_TAG_EDM', ranges)
+    assert complete.ranges == [DayRange(datetime.date(2024, 3, 30), datetime.date(2024, 3, 30))]
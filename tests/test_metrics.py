@@ -0,0 +1,96 @@
+import datetime
+import urllib.request
+
+from click.testing import CliRunner
+
+from ekzexport.cli import cli
+from ekzexport.metrics import Counter, ExportMetrics, Gauge, Histogram, MetricsServer
+from ekzexport.mockserver import MockServer
+
+
+def test_render():
+    counter = Counter('requests_total', 'Requests.', ['endpoint'])
+    counter.inc('a "b"\n')
+    counter.inc('a "b"\n', amount=2)
+    assert counter.render() == ('# HELP requests_total Requests.\n'
+                                '# TYPE requests_total counter\n'
+                                'requests_total{endpoint="a \\"b\\"\\n"} 3\n')
+
+    gauge = Gauge('latest', 'Latest.')
+    gauge.set(value=1.5)
+    assert gauge.render().splitlines()[-1] == 'latest 1.5'
+
+    histogram = Histogram('duration_seconds', 'Duration.', ['endpoint'], buckets=[0.1, 1])
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe('x', value=value)
+    assert histogram.render().splitlines()[2:] == [
+        'duration_seconds_bucket{endpoint="x",le="0.1"} 2',
+        'duration_seconds_bucket{endpoint="x",le="1"} 3',
+        'duration_seconds_bucket{endpoint="x",le="+Inf"} 4',
+        'duration_seconds_sum{endpoint="x"} 2.65',
+        'duration_seconds_count{endpoint="x"} 4',
+    ]
+    assert histogram.count('x') == 4
+
+
+def test_textfile_and_server(tmp_path):
+    metrics = ExportMetrics(str(tmp_path / 'metrics' / 'ekzexport.prom'))
+    metrics.points_written.inc('456', 'csv', amount=10)
+    metrics.save()
+    assert 'ekzexport_points_written_total{installation="456",sink="csv"} 10\n' in \
+        (tmp_path / 'metrics' / 'ekzexport.prom').read_text()
+    assert [p.name for p in (tmp_path / 'metrics').iterdir()] == ['ekzexport.prom']
+
+    with MetricsServer(metrics, port=0) as server:
+        with urllib.request.urlopen(server.url) as r:
+            assert r.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert r.read().decode() == metrics.render()
+
+
+def test_export_metrics(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    filename = tmp_path / 'ekzexport.prom'
+    with MockServer(end=datetime.date(2024, 3, 31)) as server:
+        for installation in (server.installations[0], '999'):
+            CliRunner().invoke(cli, [
+                '--user', 'user', '--password', 'password', '--base-url', server.base_url,
+                '--metrics-file', str(filename), 'installation', installation, 'data',
+                '--from', '2024-03-11', '--to', '2024-03-24', 'export', 'csv', '-f', str(tmp_path / 'data.csv')])
+            metrics = filename.read_text()
+            if installation == '999':
+                assert 'ekzexport_export_errors_total{installation="999",sink="csv"} 1\n' in metrics
+                assert ('ekzexport_request_errors_total{endpoint="consumption-view/v1/installation-data",'
+                        'reason="404"} 1\n') in metrics
+            else:
+                assert f'ekzexport_exports_total{{installation="{installation}",sink="csv"}} 1\n' in metrics
+                assert 'ekzexport_export_errors_total{' not in metrics
+                assert (f'ekzexport_weeks_fetched_total{{installation="{installation}",'
+                        f'data_type="PK_VERB_15MIN"}} 2\n') in metrics
+                assert f'ekzexport_points_written_total{{installation="{installation}",sink="csv"}} 1344\n' in metrics
+                # 2024-03-24 23:45 in Zurich
+                latest = int(datetime.datetime(2024, 3, 24, 22, 45, tzinfo=datetime.timezone.utc).timestamp())
+                assert (f'ekzexport_latest_data_timestamp_seconds{{installation="{installation}",'
+                        f'data_type="PK_VERB_15MIN"}} {latest}\n') in metrics
+                assert 'ekzexport_login_duration_seconds_count 1\n' in metrics
+                assert ('ekzexport_request_duration_seconds_count{endpoint="consumption-view/v1/consumption-data"} '
+                        '2\n') in metrics
+
+
+def test_latest_data_without_new_data(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    filename = tmp_path / 'ekzexport.prom'
+    latest = int(datetime.datetime(2024, 3, 24, 22, 45, tzinfo=datetime.timezone.utc).timestamp())
+    with MockServer(end=datetime.date(2024, 3, 31)) as server:
+        installation = server.installations[0]
+        for run in range(2):
+            result = CliRunner().invoke(cli, [
+                '--user', 'user', '--password', 'password', '--base-url', server.base_url,
+                '--metrics-file', str(filename), 'installation', installation, 'data',
+                '--from', '2024-03-11', '--to', '2024-03-24', 'export', 'csv', '-f', str(tmp_path / 'data.csv')])
+            assert result.exit_code == 0
+            metrics = filename.read_text()
+            # The second run has nothing to fetch, but still knows the latest data from the file
+            assert (f'ekzexport_weeks_fetched_total{{installation="{installation}",'
+                    f'data_type="PK_VERB_15MIN"}} 2\n' in metrics) == (run == 0)
+            assert (f'ekzexport_latest_data_timestamp_seconds{{installation="{installation}",'
+                    f'data_type="PK_VERB_15MIN"}} {latest}\n') in metrics
@@ -0,0 +1,106 @@
+import datetime
+import time
+
+import pyotp
+import pytest
+
+from click.testing import CliRunner
+
+from ekzexport.cli import cli
+from ekzexport.exporters import csv
+from ekzexport.mockserver import MockServer, synthetic_consumption_data, LEG_ID
+from ekzexport.ratelimit import RetryPolicy
+from ekzexport.session import Session
+from ekzexport.timeseries import TimeSeries
+
+END = datetime.date(2024, 3, 31)
+
+
+@pytest.mark.parametrize('options', [{}, {'otp_secret': pyotp.random_base32()}, {'ask_mobile_number': True}])
+def test_login_and_logout(options):
+    with MockServer(end=END, **options) as server:
+        with Session('user', 'password', options.get('otp_secret', ''), base_url=server.base_url) as session:
+            data = session.get_consumption_data(server.installations[0], 'PK_VERB_15MIN', '2024-03-30', '2024-03-31')
+            assert session.get_legs()[0]['legId'] == LEG_ID
+            assert session.get_leg_detail(LEG_ID)['kpi']['numberOfParticipants'] == 1
+        assert server.requests['login'] == 1
+        assert server.requests['otp'] == (1 if 'otp_secret' in options else 0)
+        assert server.requests['mobile_number'] == (1 if 'ask_mobile_number' in options else 0)
+        assert server.requests['logout'] == 1
+
+    # A weekend with the switch to summer time, so only NT and 92 values on Sunday
+    series = TimeSeries.from_consumption_data(data)
+    assert len(series) == 96 + 92
+    assert all(ht is None for _, ht, _ in series.rows())
+
+
+def test_wrong_credentials():
+    with MockServer(end=END, otp_secret=pyotp.random_base32()) as server:
+        with pytest.raises(Exception, match='expects something we can\'t handle'):
+            Session('user', 'wrong', login_immediately=True, base_url=server.base_url).__enter__()
+        with pytest.raises(Exception, match='no token was provided'):
+            Session('user', 'password', login_immediately=True, base_url=server.base_url).__enter__()
+
+
+def test_logout_needs_csrf_token():
+    with MockServer(end=END) as server:
+        with Session('user', 'password', login_immediately=True, base_url=server.base_url) as session:
+            r = session._session.post(f'{server.base_url}/logout', data={'_csrf': 'wrong'})
+            assert r.status_code == 403
+            assert session.get_installation_data(server.installations[0])['status']
+
+
+def test_expired_session_logs_in_again():
+    with MockServer(end=END, session_lifetime=0.2) as server:
+        with Session('user', 'password', base_url=server.base_url) as session:
+            session.get_installation_data(server.installations[0])
+            time.sleep(0.3)
+            session.get_installation_data(server.installations[0])
+        assert server.requests['login'] == 2
+
+
+def test_throttling_and_errors_are_retried():
+    with MockServer(end=END, rate=1000, burst=1, error_rate=0.3) as server:
+        with Session('user', 'password', base_url=server.base_url, retry=RetryPolicy(20, 0.001)) as session:
+            for _ in range(20):
+                session.get_installation_data(server.installations[0])
+        assert server.requests['failed'] > 0
+        assert session.retry.retried == server.requests['failed'] + server.requests['throttled']
+
+
+def test_throttling_sends_retry_after():
+    with MockServer(end=END, rate=0.001) as server:
+        with Session('user', 'password', base_url=server.base_url, retry=RetryPolicy(0)) as session:
+            session.get_installation_data(server.installations[0])
+            r = session._session.get(f'{server.base_url}/api/portal-services/csrf/v1/token')
+            assert r.status_code == 429
+            assert int(r.headers['Retry-After']) > 0
+            session._logged_in = False  # Logging out would be throttled as well
+
+
+def test_synthetic_data_is_deterministic():
+    available = (datetime.date(2024, 1, 1), END)
+    a = synthetic_consumption_data('1000000001', 'PK_VERB_15MIN', END, END, available)
+    b = synthetic_consumption_data('1000000001', 'PK_VERB_15MIN', END, END, available)
+    other = synthetic_consumption_data('1000000002', 'PK_VERB_15MIN', END, END, available)
+    assert a == b
+    assert a != other
+    daily = synthetic_consumption_data('1000000001', 'PK_VERB_TAG_EDM', datetime.date(2023, 12, 25), END, available)
+    assert [v['date'] for v in daily['seriesHt']['values']][:2] == ['01.01.2024', '02.01.2024']
+    assert len(daily['seriesNt']['values']) == 91
+
+
+def test_export_through_cli(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    filename = tmp_path / 'data.csv'
+    with MockServer(end=END) as server:
+        result = CliRunner().invoke(cli, [
+            '--user', 'user', '--password', 'password', '--base-url', server.base_url,
+            'installation', server.installations[0], 'data', '--from', '2024-03-04', '--to', '2024-03-31',
+            '-j', '2', 'export', 'csv', '-f', str(filename)])
+        assert result.exit_code == 0, result.output
+        assert server.requests['consumption_data'] == 4
+
+    series = csv.read_series(str(filename))
+    assert len(series) == 28 * 96 - 4
+    assert series.count() == len(series)
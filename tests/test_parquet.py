@@ -0,0 +1,56 @@
+import datetime
+
+import pytest
+
+from ekzexport.timeseries import TimeSeries
+from ekzexport.util import DayRange
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+from ekzexport.exporters.parquet import (cli, partition_path, list_partitions, read_partition, read_partition_info,
+                                         write_partition)
+
+
+def test_write_and_read_partition(tmp_path):
+    path = str(tmp_path / 'data.parquet')
+    series = TimeSeries.from_rows([(1704063600, 1.0, None), (1704067200, None, 2.0), (1704240000, 3.0, 4.0)])
+    write_partition(path, series)
+
+    assert list(read_partition(path).rows()) == list(series.rows())
+    table = pq.read_table(path)
+    assert table.column('ht').null_count == 1
+    assert table.schema.field('time').type.tz == 'UTC'
+
+    info = read_partition_info(path)
+    assert info['rows'] == 3
+    assert (info['min_time'], info['max_time']) == (1704063600, 1704240000)
+    assert info['present_days'].ranges == [DayRange(datetime.date(2024, 1, 1), datetime.date(2024, 1, 1)),
+                                           DayRange(datetime.date(2024, 1, 3), datetime.date(2024, 1, 3))]
+
+    # Files without our metadata are read to find the days with data
+    pq.write_table(table.replace_schema_metadata(None), path)
+    assert read_partition_info(path)['present_days'].ranges == info['present_days'].ranges
+
+
+def test_export_partitions_by_month(tmp_path, fake_session, run_exporter):
+    session = fake_session
+    run_exporter(cli, session, '2024-01-29', '2024-01-31', directory=str(tmp_path), compression='zstd')
+    # The week crosses into February, which is in Zurich time
+    assert list_partitions(str(tmp_path)) == [partition_path(str(tmp_path), 2024, 1),
+                                              partition_path(str(tmp_path), 2024, 2)]
+    assert len(read_partition(partition_path(str(tmp_path), 2024, 1))) == 3 * 24
+    assert len(read_partition(partition_path(str(tmp_path), 2024, 2))) == 4 * 24
+
+    # Appending the next week only touches February
+    january = tmp_path / 'year=2024' / 'month=01' / 'data.parquet'
+    mtime = january.stat().st_mtime_ns
+    run_exporter(cli, session, '2024-01-29', '2024-02-06', directory=str(tmp_path), compression='zstd')
+    assert january.stat().st_mtime_ns == mtime
+    assert len(read_partition(partition_path(str(tmp_path), 2024, 2))) == 11 * 24
+
+    # Backfilling retrieves only the missing week
+    run_exporter(cli, session, '2024-01-22', '2024-02-06', directory=str(tmp_path), compression='zstd')
+    assert len(read_partition(partition_path(str(tmp_path), 2024, 1))) == 10 * 24
+    assert session.requests == [('2024-01-29', '2024-02-04'), ('2024-02-05', '2024-02-11'),
+                                ('2024-01-22', '2024-01-28')]
@@ -0,0 +1,94 @@
+import json
+import random
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from ekzexport import session as session_module
+from ekzexport.ratelimit import RateLimiter, RetryPolicy, parse_retry_after
+from ekzexport.session import Session
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter():
+    clock = _Clock()
+    limiter = RateLimiter(2, burst=2, clock=clock)
+    assert [limiter.reserve() for _ in range(4)] == [0, 0, 0.5, 1.0]
+    clock.now = 10
+    assert limiter.reserve() == 0  # Refilled, but not beyond the burst
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0.5
+    assert limiter.waited == 2.0
+
+
+def test_retry_policy():
+    policy = RetryPolicy(retries=3, base_delay=1, max_delay=5, rng=random.Random(0))
+    delays = [policy.retry_delay(attempt, 503) for attempt in range(3)]
+    assert all(0 <= d <= min(5, 2 ** i) for i, d in enumerate(delays))
+    assert policy.retry_delay(3, 503) is None
+    assert policy.retry_delay(0, 404) is None
+    assert policy.retry_delay(0, None) is not None  # Connection errors are retried as well
+    assert policy.retry_delay(0, 429, '3') == 3
+    assert policy.retry_delay(0, 429, '3600') == 5
+    assert policy.retried == 6
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', now=1445412460) == 20
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+class _Adapter(BaseAdapter):
+    """Responds with the given status codes in turn, then with JSON."""
+    def __init__(self, status_codes):
+        super().__init__()
+        self.status_codes = list(status_codes)
+        self.requests = 0
+
+    def send(self, request, **kwargs):
+        self.requests += 1
+        r = requests.Response()
+        r.url = request.url
+        r.request = request
+        r.status_code = self.status_codes.pop(0) if self.status_codes else 200
+        r.headers['Content-Type'] = 'application/json'
+        if r.status_code == 429:
+            r.headers['Retry-After'] = '2'
+        r._content = json.dumps({'status': []}).encode('utf-8')
+        return r
+
+    def close(self):
+        pass
+
+
+def _session(status_codes, retries):
+    session = Session('user', 'password', base_url='https://my.ekz.test', retry=RetryPolicy(retries))
+    session._logged_in = True
+    adapter = _Adapter(status_codes)
+    session._session.mount('https://', adapter)
+    return session, adapter
+
+
+def test_session_retries(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(session_module.time, 'sleep', sleeps.append)
+
+    session, adapter = _session([503, 429], retries=2)
+    assert session.get_installation_data('1') == {'status': []}
+    assert adapter.requests == 3
+    assert sleeps[1] == 2  # Retry-After of the 429
+
+    session, adapter = _session([503, 503, 503], retries=2)
+    with pytest.raises(requests.HTTPError):
+        session.get_installation_data('1')
+    assert adapter.requests == 3
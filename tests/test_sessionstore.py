@@ -0,0 +1,53 @@
+import os
+import stat
+import time
+
+from http.cookiejar import Cookie, CookieJar
+
+from ekzexport.sessionstore import SessionStore
+
+
+def _cookie(name: str, value: str, expires=None) -> Cookie:
+    return Cookie(version=0, name=name, value=value, port=None, port_specified=False,
+                  domain='my.ekz.ch', domain_specified=False, domain_initial_dot=False,
+                  path='/', path_specified=True, secure=True, expires=expires, discard=expires is None,
+                  comment=None, comment_url=None, rest={'HttpOnly': None})
+
+
+def test_roundtrip(tmp_path):
+    jar = CookieJar()
+    jar.set_cookie(_cookie('SESSION', 'abc'))
+    jar.set_cookie(_cookie('persistent', 'def', int(time.time()) + 3600))
+    store = SessionStore('user', 'https://my.ekz.ch', str(tmp_path / 'sessions'))
+    store.save(jar)
+
+    assert stat.S_IMODE(os.stat(store.path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(tmp_path / 'sessions').st_mode) == 0o700
+
+    restored = CookieJar()
+    assert store.load(restored)
+    assert sorted((c.name, c.value, c.domain) for c in restored) == [
+        ('SESSION', 'abc', 'my.ekz.ch'), ('persistent', 'def', 'my.ekz.ch')]
+
+    store.clear()
+    assert not store.load(CookieJar())
+
+
+def test_one_file_per_account(tmp_path):
+    a = SessionStore('a', 'https://my.ekz.ch', str(tmp_path))
+    b = SessionStore('b', 'https://my.ekz.ch', str(tmp_path))
+    assert a.path != b.path
+
+
+def test_ignores_expired_and_exposed_sessions(tmp_path):
+    jar = CookieJar()
+    jar.set_cookie(_cookie('old', 'abc', int(time.time()) - 10))
+    store = SessionStore('user', 'https://my.ekz.ch', str(tmp_path))
+    store.save(jar)
+    assert not store.load(CookieJar())
+
+    jar.set_cookie(_cookie('SESSION', 'abc'))
+    store.save(jar)
+    assert store.load(CookieJar())
+    os.chmod(store.path, 0o644)
+    assert not store.load(CookieJar())
@@ -0,0 +1,33 @@
+import datetime
+
+from ekzexport.exporters.sqlite import cli, connect, read_present_days, read_last_timestamp
+from ekzexport.util import DayRange
+
+
+def test_present_days_islands(tmp_path):
+    db = connect(str(tmp_path / 'data.sqlite'))
+    db.executemany('INSERT INTO consumption VALUES (?, ?, ?, ?, ?, ?)', [
+        ('1', 'T', day * 86400 + i, 'NT', day, 1.0) for day in [19723, 19724, 19725, 19727, 19730] for i in range(3)])
+    db.execute("INSERT INTO consumption VALUES ('2', 'T', 0, 'NT', 19726, 1.0)")
+    assert read_present_days(db, '1', 'T').ranges == [
+        DayRange(datetime.date(2024, 1, 1), datetime.date(2024, 1, 3)),
+        DayRange(datetime.date(2024, 1, 5), datetime.date(2024, 1, 5)),
+        DayRange(datetime.date(2024, 1, 8), datetime.date(2024, 1, 8))]
+    assert read_present_days(db, '1', 'X').empty
+    assert read_last_timestamp(db, '1', 'T') == 19730 * 86400 + 2
+
+
+def test_export_upserts_missing_weeks(tmp_path, fake_session, run_exporter):
+    path = tmp_path / 'data.sqlite'
+    session = fake_session
+    run_exporter(cli, session, '2024-01-08', '2024-01-10', filename=str(path))
+    run_exporter(cli, session, '2024-01-01', '2024-01-16', filename=str(path))
+    run_exporter(cli, session, '2024-01-01', '2024-01-16', installation_id='2', filename=str(path))
+
+    db = connect(str(path))
+    assert db.execute("SELECT COUNT(*) FROM consumption WHERE installation = '1'").fetchone()[0] == 21 * 24
+    assert read_present_days(db, '1', 'PK_VERB_TAG_EDM').ranges == [
+        DayRange(datetime.date(2024, 1, 1), datetime.date(2024, 1, 21))]
+    assert session.requests == [('2024-01-08', '2024-01-14'), ('2024-01-01', '2024-01-07'),
+                                ('2024-01-15', '2024-01-21'), ('2024-01-01', '2024-01-21')]
+    assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
@@ -0,0 +1,52 @@
+import datetime
+import json
+import pstats
+
+from click.testing import CliRunner
+
+from ekzexport.cli import cli
+from ekzexport.mockserver import MockServer
+from ekzexport.stats import Stats, count_values
+
+
+def test_phases_and_counters():
+    stats = Stats()
+    for _ in range(3):
+        with stats.phase('parse'):
+            pass
+    stats.add_time('write', 1.5)
+    stats.count('requests')
+    stats.count('bytes_received', 100)
+    stats.count('bytes_received', 50)
+
+    summary = stats.summary()
+    assert summary['phases']['parse']['calls'] == 3
+    assert summary['phases']['write'] == {'calls': 1, 'seconds': 1.5}
+    assert summary['counters'] == {'requests': 1, 'bytes_received': 150}
+    assert summary['wall_seconds'] > 0
+
+
+def test_count_values():
+    assert count_values({'seriesHt': {'values': [{}, {}]}, 'seriesNt': {'values': [{}]}, 'series': None}) == 3
+    assert count_values({}) == 0
+
+
+def test_stats_and_profile_options(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    with MockServer(end=datetime.date(2024, 3, 31)) as server:
+        result = CliRunner().invoke(cli, [
+            '--user', 'user', '--password', 'password', '--base-url', server.base_url, '--stats',
+            '--stats-json', str(tmp_path / 'stats.json'), '--profile', str(tmp_path / 'profile'),
+            'installation', server.installations[0], 'data', '--from', '2024-03-11', '--to', '2024-03-24',
+            'export', 'csv', '-f', str(tmp_path / 'data.csv')])
+        assert result.exit_code == 0, result.output
+
+    with open(tmp_path / 'stats.json') as f:
+        summary = json.load(f)
+    assert {'login', 'request', 'decode', 'parse', 'merge', 'write'} <= set(summary['phases'])
+    assert summary['phases']['request']['calls'] == 4  # Installation data, two weeks and the CSRF token
+    assert summary['counters']['weeks_fetched'] == 2
+    assert summary['counters']['points_received'] == summary['counters']['points_written'] == 14 * 96
+    assert summary['counters']['bytes_received'] > 0
+    assert 'weeks_fetched' in result.output
+    assert pstats.Stats(str(tmp_path / 'profile')).total_calls > 0
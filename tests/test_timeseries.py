@@ -0,0 +1,55 @@
+import datetime
+
+from ekzexport.timeseries import TimeSeries
+from ekzexport.timeutil import ZRH_TZ
+from ekzexport.util import DayRange, DayRangeSet
+
+
+def _epoch(*args) -> int:
+    return int(datetime.datetime(*args, tzinfo=ZRH_TZ).timestamp())
+
+
+def _value(timestamp, value, status='VALID'):
+    return {'timestamp': timestamp, 'value': value, 'status': status}
+
+
+def test_from_consumption_data():
+    data = {
+        'seriesHt': {'values': [_value(20240101080000, 2.0), _value(20240101070000, 1.0),
+                                _value(20240101090000, 9.0, 'MISSING')]},
+        'seriesNt': {'values': [_value(20240101000000, 0.5)]},
+    }
+    series = TimeSeries.from_consumption_data(data)
+    assert list(series.rows()) == [(_epoch(2024, 1, 1, 1), None, 0.5), (_epoch(2024, 1, 1, 8), 1.0, None),
+                                   (_epoch(2024, 1, 1, 9), 2.0, None)]
+
+
+def test_upsert():
+    series = TimeSeries.from_rows([(1, 1.0, None), (3, 3.0, 3.0), (5, 5.0, None)])
+    series.upsert(TimeSeries.from_rows([(6, 6.0, None), (7, None, 7.0)]))
+    assert list(series.epochs) == [1, 3, 5, 6, 7]
+
+    series.upsert(TimeSeries.from_rows([(0, 0.0, None), (3, None, 4.0), (5, None, 5.0), (8, 8.0, 8.0)]))
+    assert list(series.rows()) == [(0, 0.0, None), (1, 1.0, None), (3, 3.0, 4.0), (5, 5.0, 5.0), (6, 6.0, None),
+                                   (7, None, 7.0), (8, 8.0, 8.0)]
+
+
+def test_slice_and_gaps_across_dst():
+    # Hourly values for the week with the switch to winter time, except for the 30th
+    rows = [(epoch, 1.0, None) for epoch in range(_epoch(2023, 10, 23), _epoch(2023, 11, 1), 3600)
+            if not _epoch(2023, 10, 30) <= epoch < _epoch(2023, 10, 31)]
+    series = TimeSeries.from_rows(rows)
+
+    day = series.slice(DayRange(datetime.date(2023, 10, 29), datetime.date(2023, 10, 29)))
+    assert len(day) == 25
+    assert day.epochs[0] == _epoch(2023, 10, 29)
+
+    assert series.days().ranges == [DayRange(datetime.date(2023, 10, 23), datetime.date(2023, 10, 29)),
+                                    DayRange(datetime.date(2023, 10, 31), datetime.date(2023, 10, 31))]
+    assert series.gaps(DayRange(datetime.date(2023, 10, 20), datetime.date(2023, 10, 31))).ranges == [
+        DayRange(datetime.date(2023, 10, 20), datetime.date(2023, 10, 22)),
+        DayRange(datetime.date(2023, 10, 30), datetime.date(2023, 10, 30))]
+
+    selected = series.select(DayRangeSet([DayRange(datetime.date(2023, 10, 23), datetime.date(2023, 10, 23)),
+                                           DayRange(datetime.date(2023, 10, 31), datetime.date(2023, 11, 5))]))
+    assert len(selected) == 48
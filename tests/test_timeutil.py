@@ -22,3 +22,38 @@ def test_convert_zrh_datetime_sequence():
         1698541260.0,  # + 60
         1698544800.0,  # + 59*60
     ]
+
+
+def test_civil_days_roundtrip():
+    for days in range(-1000, 50000, 7):
+        date = datetime.date(1970, 1, 1) + datetime.timedelta(days=days)
+        assert days_from_civil(date.year, date.month, date.day) == days
+        assert civil_from_days(days) == (date.year, date.month, date.day)
+        assert epoch_day_to_date(days) == date
+
+
+def _local_seconds(dt: datetime.datetime) -> int:
+    return days_from_civil(dt.year, dt.month, dt.day) * 86400 + dt.hour * 3600 + dt.minute * 60
+
+
+def test_zrh_local_to_epoch_matches_zoneinfo():
+    # Every 15 minutes around the DST transitions of a few years, including the skipped and repeated hours
+    for year in (1981, 2000, 2023, 2024, 2099):
+        for month in (3, 10):
+            start = datetime.datetime(year, month, 24)
+            for i in range(8 * 96):
+                naive = start + datetime.timedelta(minutes=15 * i)
+                for fold in (0, 1):
+                    epoch = int(naive.replace(tzinfo=ZRH_TZ, fold=fold).timestamp())
+                    assert zrh_local_to_epoch(_local_seconds(naive), fold) == epoch
+                    assert epoch_to_zrh_local(epoch) == _local_seconds(datetime.datetime.fromtimestamp(epoch, ZRH_TZ))
+
+
+def test_api_timestamps():
+    timestamps = [20231029003000, 20231029010000, 20231231234500, 20240101000000, 20240229120000]
+    expected = [int(datetime.datetime.strptime(str(t), '%Y%m%d%H%M%S').replace(tzinfo=UTC_TZ).timestamp())
+                for t in timestamps]
+    assert [api_timestamp_to_epoch(t) for t in timestamps] == expected
+    assert list(parse_api_timestamps({'timestamp': t, 'value': 0.0, 'status': 'VALID'} for t in timestamps)) == expected
+    assert parse_api_timestamp(20240229120000) == datetime.datetime(2024, 2, 29, 12, 0, 0)
+    assert epoch_to_zrh_date(api_timestamp_to_epoch(20231231234500)) == datetime.date(2024, 1, 1)
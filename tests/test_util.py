@@ -1,3 +1,7 @@
+import pytest
+import requests
+
+from ekzexport.planner import FetchPlanner
 from ekzexport.util import *
 
 
@@ -179,3 +183,182 @@ def test_large_intersection():
     intersection = DayRangeSet([range1, range2]).intersect(DayRangeSet([range3]))
     assert intersection.ranges == [range3]
     assert list(intersection.get_covering_weeks()) == [_r('2019-12-30 2020-01-05'), _r('2020-01-06 2020-01-12')]
+
+
+def test_dayrange_contained_range():
+    # A range contained in an earlier one must not shrink it
+    both = DayRangeSet([_r('2000-01-01 2000-01-10'), _r('2000-01-03 2000-01-04')])
+    assert both.ranges == [_r('2000-01-01 2000-01-10')]
+    assert normalize_ranges([_r('2000-01-01 2000-01-10'), _r('2000-01-03 2000-01-04')]) == both.ranges
+
+
+def _random_ranges(rng, count: int) -> List[DayRange]:
+    start = datetime.date(2000, 1, 1)
+    ranges = []
+    for _ in range(count):
+        first = start + datetime.timedelta(days=rng.randint(0, 120))
+        ranges.append(DayRange(first, first + datetime.timedelta(days=rng.randint(0, 10))))
+    return ranges
+
+
+def _days(ranges: List[DayRange]) -> set:
+    return {r.start + datetime.timedelta(days=i) for r in ranges for i in range((r.end - r.start).days + 1)}
+
+
+def test_dayrangeset_equality():
+    s = DayRangeSet([_r('2024-01-01 2024-01-07')])
+    assert s != None and s != [_r('2024-01-01 2024-01-07')]
+    assert s == DayRangeSet([_r('2024-01-01 2024-01-03'), _r('2024-01-04 2024-01-07')])
+    assert len({s, DayRangeSet(s.ranges), DayRangeSet()}) == 2
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_dayrangeset_properties(seed):
+    import random
+    rng = random.Random(seed)
+    a_ranges, b_ranges = _random_ranges(rng, rng.randint(0, 15)), _random_ranges(rng, rng.randint(0, 15))
+    a, b = DayRangeSet(a_ranges), DayRangeSet(b_ranges)
+    a_days, b_days = _days(a_ranges), _days(b_ranges)
+
+    for s, expected in ((a, a_days), (b, b_days), (a.union(b), a_days | b_days), (a.intersect(b), a_days & b_days),
+                        (a.subtract(b), a_days - b_days), (b.subtract(a), b_days - a_days)):
+        # Ranges are sorted, disjoint and separated by gaps
+        for r, following in zip(s.ranges, s.ranges[1:]):
+            assert r.start <= r.end and r.end + datetime.timedelta(days=1) < following.start
+        assert list(s.get_days()) == sorted(expected)
+        assert s == DayRangeSet(s.ranges) and hash(s) == hash(DayRangeSet(s.ranges))
+
+    within = _random_ranges(rng, 1)[0]
+    assert set(a.complement(within).get_days()) == _days([within]) - a_days
+    for day in _days([DayRange(datetime.date(1999, 12, 31), datetime.date(2000, 5, 15))]):
+        assert a.contains(day) == (day in a_days)
+    assert a.union(b) == b.union(a)
+    assert a.intersect(b) == b.intersect(a)
+    assert a.subtract(b).union(a.intersect(b)) == a
+    assert set(w.start for w in a.union(b).get_covering_weeks()) == \
+        {d - datetime.timedelta(days=d.weekday()) for d in a_days | b_days}
+
+
+def test_ordered_map_keeps_order():
+    import random
+    import time
+
+    def slow_identity(x):
+        time.sleep(random.random() / 100)
+        return x
+
+    assert list(ordered_map(slow_identity, range(50), concurrency=8)) == list(range(50))
+    assert list(ordered_map(slow_identity, range(5), concurrency=1)) == list(range(5))
+
+
+def test_ordered_map_propagates_errors():
+    def fail_on_three(x):
+        if x == 3:
+            raise ValueError(x)
+        return x
+
+    results = ordered_map(fail_on_three, range(10), concurrency=4)
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        next(results)
+
+
+def test_group_weeks():
+    weeks = list(DayRangeSet([_r('2000-01-03 2000-02-06'), _r('2000-02-21 2000-02-27')]).get_covering_weeks())
+    assert list(group_weeks(weeks, 1)) == weeks
+    assert list(group_weeks(weeks, 2)) == [_r('2000-01-03 2000-01-16'), _r('2000-01-17 2000-01-30'),
+                                           _r('2000-01-31 2000-02-06'), _r('2000-02-21 2000-02-27')]
+    assert list(group_weeks(weeks, 52)) == [_r('2000-01-03 2000-02-06'), _r('2000-02-21 2000-02-27')]
+
+
+def _http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f'{status_code} Error', response=response)
+
+
+class _DailySession:
+    """Serves one daily value per day, but refuses more than max_days with error_status and truncates to
+    truncate_days."""
+    def __init__(self, max_days=10000, truncate_days=10000, error_status=400):
+        self.max_days = max_days
+        self.truncate_days = truncate_days
+        self.error_status = error_status
+        self.requests = []
+
+    def get_consumption_data(self, installation_id, data_type, date_from, date_to):
+        start, end = parse_zrh_day(date_from), parse_zrh_day(date_to)
+        self.requests.append(DayRange(start, end))
+        if (end - start).days + 1 > self.max_days:
+            raise _http_error(self.error_status)
+        days = range(min((end - start).days + 1, self.truncate_days))
+        values = [{'timestamp': int((start + datetime.timedelta(days=d)).strftime('%Y%m%d000000')),
+                   'value': 1.0, 'status': 'VALID'} for d in days]
+        return {'seriesHt': {'values': values}, 'seriesNt': {'values': []}}
+
+
+def _fetch(session, planner, ranges):
+    data = DataSelection(session, '1', 'PK_VERB_TAG_EDM', None, None, 1000, planner=planner)
+    return [(r, len(d['seriesHt']['values'])) for r, d in data.fetch_consumption_data(data.requested_windows(ranges))]
+
+
+def test_fetch_planner_shrinks_on_errors():
+    session = _DailySession(max_days=28)
+    planner = FetchPlanner()
+    year = DayRangeSet([_r('2001-01-01 2001-12-30')])
+    assert sum(n for _, n in _fetch(session, planner, year)) == 364
+    assert planner.window_weeks('PK_VERB_TAG_EDM') == 3  # 52 -> 26 -> 13 -> 6 -> 3
+
+    # The learned window size is used right away next time
+    session.requests.clear()
+    assert _fetch(session, planner, year)[0] == (_r('2001-01-01 2001-01-21'), 21)
+    assert len(session.requests) == 18
+
+
+@pytest.mark.parametrize('status_code', [401, 403, 404, 503])
+def test_fetch_planner_keeps_window_on_other_errors(status_code):
+    session = _DailySession(max_days=28, error_status=status_code)
+    planner = FetchPlanner()
+    with pytest.raises(requests.HTTPError):
+        _fetch(session, planner, DayRangeSet([_r('2001-01-01 2001-12-30')]))
+    assert planner.window_weeks('PK_VERB_TAG_EDM') == 52
+    assert len(session.requests) == 1
+
+
+def test_fetch_planner_learned_size_expires(tmp_path):
+    now = [1000000.0]
+    planner = FetchPlanner(str(tmp_path / 'windows.json'), max_age=3600, clock=lambda: now[0])
+    planner.shrink('PK_VERB_TAG_EDM', 4)
+    assert FetchPlanner(str(tmp_path / 'windows.json'), max_age=3600, clock=lambda: now[0]).window_weeks(
+        'PK_VERB_TAG_EDM') == 4
+    now[0] += 3601
+    assert planner.window_weeks('PK_VERB_TAG_EDM') == 52
+
+    # Files written by earlier versions are ignored
+    (tmp_path / 'windows.json').write_text('{"PK_VERB_TAG_EDM": 4}')
+    assert FetchPlanner(str(tmp_path / 'windows.json')).window_weeks('PK_VERB_TAG_EDM') == 52
+
+
+def test_fetch_planner_shrinks_on_truncation(tmp_path):
+    session = _DailySession(truncate_days=91)
+    planner = FetchPlanner(str(tmp_path / 'windows.json'))
+    result = _fetch(session, planner, DayRangeSet([_r('2001-01-01 2001-12-30')]))
+    assert [n for _, n in result] == [91, 91, 91, 91]
+    assert result[0][0] == _r('2001-01-01 2001-04-01')
+    assert FetchPlanner(str(tmp_path / 'windows.json')).window_weeks('PK_VERB_TAG_EDM') == 13
+
+    # 15 minute data is still retrieved per week
+    assert planner.window_weeks('PK_VERB_15MIN') == 1
+
+
+def test_fetch_gap_is_not_truncation():
+    class GappySession(_DailySession):
+        def get_consumption_data(self, installation_id, data_type, date_from, date_to):
+            d = super().get_consumption_data(installation_id, data_type, date_from, date_to)
+            d['seriesHt']['values'] = [v for v in d['seriesHt']['values'] if v['timestamp'] < 20010301000000]
+            return d
+
+    planner = FetchPlanner()
+    result = _fetch(GappySession(), planner, DayRangeSet([_r('2001-01-01 2001-12-30')]))
+    assert sum(n for _, n in result) == 59
+    assert planner.window_weeks('PK_VERB_TAG_EDM') == 52